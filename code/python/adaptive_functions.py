@@ -0,0 +1,218 @@
+import numpy as np
+import pandas as pd
+from functions import *
+
+# race groups and outcomes reported by create_treatment_effect
+RACE_GROUPS = ["NHB", "NHW"]
+EFFECT_COLUMNS = [
+    "years_to_death",
+    "discounted_LY",
+    "QALY",
+    "discounted_QALY",
+    "cost",
+    "discounted_cost",
+    "years_sick_treated",
+    "years_sick_untreated",
+    "years_sick",
+    "was_sick",
+    "was_treated",
+]
+# outcomes computed only among those who were sick (as in create_treatment_effect)
+SICK_ONLY_COLUMNS = ["years_sick_treated", "years_sick_untreated", "years_sick"]
+EFFECT_STATISTICS = ["SC", "NT", "Diff"]
+
+
+def create_moments():
+    # Function:
+    #   Creates empty running moments (count, mean and sum of squared
+    #   deviations) of an outcome
+    # Args:
+    #   None
+    # Returns:
+    #   dictionary of running moments
+
+    return {"n": 0, "mean": 0.0, "M2": 0.0}
+
+
+def update_moments(moments, values):
+    # Function:
+    #   Adds a batch of values to running moments, combining the batch mean and
+    #   sum of squared deviations with the running ones (Chan et al.), which
+    #   is numerically stable for any number of batches
+    # Args:
+    #   moments: running moments (output from create_moments)
+    #   values: array of new values
+    # Returns:
+    #   None (moments are updated in place)
+
+    values = np.asarray(values, dtype=float)
+    n_batch = len(values)
+    if n_batch == 0:
+        return
+    batch_mean = values.mean()
+    batch_M2 = ((values - batch_mean) ** 2).sum()
+    n = moments["n"] + n_batch
+    delta = batch_mean - moments["mean"]
+    moments["mean"] = moments["mean"] + delta * n_batch / n
+    moments["M2"] = moments["M2"] + batch_M2 + delta**2 * moments["n"] * n_batch / n
+    moments["n"] = n
+
+
+def moments_std(moments):
+    # Function:
+    #   Sample standard deviation of running moments
+    # Args:
+    #   moments: running moments (output from create_moments)
+    # Returns:
+    #   standard deviation (nan with fewer than two values)
+
+    if moments["n"] < 2:
+        return np.nan
+    return np.sqrt(moments["M2"] / (moments["n"] - 1))
+
+
+def create_running_effect():
+    # Function:
+    #   Creates the running moments needed to compute the treatment effect
+    #   table of create_treatment_effect batch by batch
+    # Args:
+    #   None
+    # Returns:
+    #   dictionary mapping (race, column) to the running moments of the
+    #   standard of care, new treatment and paired difference, and the number
+    #   of individuals the difference standard error is divided by
+
+    return {
+        (r, c): {
+            "SC": create_moments(),
+            "NT": create_moments(),
+            "Diff": create_moments(),
+            "n_diff": 0,
+        }
+        for r in RACE_GROUPS
+        for c in EFFECT_COLUMNS
+    }
+
+
+def update_running_effect(running_effect, total_trace_SC, total_trace_NT):
+    # Function:
+    #   Adds one simulated batch (the same individuals under both treatments)
+    #   to the running treatment effect. Follows create_treatment_effect: the
+    #   difference pairs each individual's outcomes under the two treatments and,
+    #   for years sick, only includes individuals who were sick
+    # Args:
+    #   running_effect: running treatment effect (output from create_running_effect)
+    #   total_trace_SC: total trace of the batch under the standard of care
+    #   total_trace_NT: total trace of the batch under the new treatment
+    # Returns:
+    #   None (running_effect is updated in place)
+
+    for r in RACE_GROUPS:
+        race_SC = (total_trace_SC["race"] == r).to_numpy()
+        race_NT = (total_trace_NT["race"] == r).to_numpy()
+        sick_SC = race_SC & (total_trace_SC["was_sick"] == 1).to_numpy()
+        sick_NT = race_NT & (total_trace_NT["was_sick"] == 1).to_numpy()
+        for c in EFFECT_COLUMNS:
+            values_SC = total_trace_SC[c].to_numpy()
+            values_NT = total_trace_NT[c].to_numpy()
+            running = running_effect[(r, c)]
+            if c in SICK_ONLY_COLUMNS:
+                in_SC, in_NT, in_both = sick_SC, sick_NT, sick_SC & sick_NT
+            else:
+                in_SC, in_NT, in_both = race_SC, race_NT, race_SC & race_NT
+            update_moments(running["SC"], values_SC[in_SC])
+            update_moments(running["NT"], values_NT[in_NT])
+            update_moments(running["Diff"], values_NT[in_both] - values_SC[in_both])
+            running["n_diff"] += int(in_SC.sum())
+
+
+def running_treatment_effect(running_effect):
+    # Function:
+    #   Computes the treatment effect table from the running moments
+    # Args:
+    #   running_effect: running treatment effect (output from create_running_effect)
+    # Returns:
+    #   treatment_effect_df: pandas dataframe with the same columns as the
+    #   output of create_treatment_effect
+
+    total_arr = []
+    for r in RACE_GROUPS:
+        for c in EFFECT_COLUMNS:
+            running = running_effect[(r, c)]
+            arr = [r, c]
+            for statistic in EFFECT_STATISTICS:
+                moments = running[statistic]
+                n = running["n_diff"] if statistic == "Diff" else moments["n"]
+                arr.append(moments["mean"] if moments["n"] > 0 else np.nan)
+                arr.append(moments_std(moments) / np.sqrt(n) if n > 0 else np.nan)
+            total_arr.append(arr)
+    return pd.DataFrame(
+        total_arr,
+        columns=[
+            "race",
+            "column",
+            "SC mean",
+            "SC se",
+            "NT mean",
+            "NT se",
+            "Diff mean",
+            "Diff se",
+        ],
+    )
+
+
+def parse_target(target):
+    # Function:
+    #   Parses a precision target given as "column:statistic:threshold"
+    #   (e.g., "discounted_QALY:Diff:0.01")
+    # Args:
+    #   target: target string
+    # Returns:
+    #   dictionary with the outcome column, statistic (SC, NT or Diff) and the
+    #   largest acceptable standard error
+    #   (raises ValueError for an unknown column or statistic)
+
+    parts = target.split(":")
+    if len(parts) != 3:
+        raise ValueError(f"target '{target}' is not of the form column:statistic:se")
+    column, statistic, threshold = parts
+    if column not in EFFECT_COLUMNS:
+        raise ValueError(f"unknown outcome '{column}' in target '{target}'")
+    if statistic not in EFFECT_STATISTICS:
+        raise ValueError(
+            f"unknown statistic '{statistic}' in target '{target}' "
+            f"(expected one of {', '.join(EFFECT_STATISTICS)})"
+        )
+    return {"column": column, "statistic": statistic, "threshold": float(threshold)}
+
+
+def check_targets(treatment_effect_df, targets):
+    # Function:
+    #   Compares the standard errors of the treatment effect table with the
+    #   precision targets, in every race group
+    # Args:
+    #   treatment_effect_df: treatment effect table
+    #   targets: list of targets (output from parse_target)
+    # Returns:
+    #   pandas dataframe with the current standard error of every target and
+    #   race group and whether it is below the threshold
+
+    rows = []
+    for target in targets:
+        for r in RACE_GROUPS:
+            row = treatment_effect_df[
+                (treatment_effect_df["race"] == r)
+                & (treatment_effect_df["column"] == target["column"])
+            ].iloc[0]
+            se = row[f"{target['statistic']} se"]
+            rows.append(
+                {
+                    "race": r,
+                    "column": target["column"],
+                    "statistic": target["statistic"],
+                    "se": se,
+                    "threshold": target["threshold"],
+                    "met": bool(se < target["threshold"]),
+                }
+            )
+    return pd.DataFrame(rows)
@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+import pandas as pd
+from functions import *
+from cohort_functions import COHORT_CSV_OPTIONS
+from event_functions import trace_files
+from shard_functions import hash_scenario, MODELS, ARMS
+
+# describes the cohort and scenario of the results of a run, so later runs can
+# simulate only the individuals added to the cohort (run_model.py --append)
+RUN_MANIFEST_FILE = "run_manifest.json"
+
+
+def hash_cohort(population_df):
+    # Function:
+    #   Computes a hash of the rows of a cohort that does not depend on the
+    #   file format it was read from (csv or .npz)
+    # Args:
+    #   population_df: cohort dataframe (output from read_cohort)
+    # Returns:
+    #   hexadecimal SHA-256 digest
+
+    row_hashes = pd.util.hash_pandas_object(population_df, index=False)
+    cohort_hash = hashlib.sha256(",".join(population_df.columns).encode("utf-8"))
+    cohort_hash.update(row_hashes.to_numpy().tobytes())
+    return cohort_hash.hexdigest()
+
+
+def create_run_manifest(population_df, engine="reference", trace_format="dense"):
+    # Function:
+    #   Describes the results of a run of the whole cohort
+    # Args:
+    #   population_df: simulated cohort
+    #   engine: simulation engine of the run (a key of ENGINES)
+    #   trace_format: format of the results ("dense", "events" or "unique")
+    # Returns:
+    #   dictionary with the cohort size, last id and hash, number of cycles of
+    #   the traces, scenario hash, engine, engine version and trace format
+
+    return {
+        "cohort_size": len(population_df),
+        "id_max": int(population_df["id"].max()) if len(population_df) > 0 else None,
+        "cohort_hash": hash_cohort(population_df),
+        "cycles": trace_cycles(population_df["starting_age"]),
+        "scenario_hash": hash_scenario(),
+        "engine": engine,
+        "engine_version": ENGINE_VERSION,
+        "trace_format": trace_format,
+    }
+
+
+def write_run_manifest(results_folder, manifest):
+    # Function:
+    #   Writes the manifest of a run next to its results, through a temporary
+    #   file
+    # Args:
+    #   results_folder: results folder of the run (e.g., results/)
+    #   manifest: run manifest (output from create_run_manifest)
+    # Returns:
+    #   None
+
+    temporary_path = f"{results_folder}/{RUN_MANIFEST_FILE}.tmp"
+    with open(temporary_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(temporary_path, f"{results_folder}/{RUN_MANIFEST_FILE}")
+
+
+def read_run_manifest(results_folder):
+    # Function:
+    #   Reads the manifest of the results of a run
+    # Args:
+    #   results_folder: results folder of the run (e.g., results/)
+    # Returns:
+    #   run manifest (raises ValueError if the results have none)
+
+    manifest_path = f"{results_folder}/{RUN_MANIFEST_FILE}"
+    if not os.path.exists(manifest_path):
+        raise ValueError(
+            f"{manifest_path} not found: there are no results of run_model.py "
+            "to append to"
+        )
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+
+def appended_individuals(population_df, manifest, engine, trace_format, results_folder):
+    # Function:
+    #   Selects the individuals added to a cohort since its results were
+    #   simulated. Every trajectory depends only on the individual's seed and
+    #   characteristics, so the earlier results stay valid as long as the
+    #   cohort only grew at the end and the scenario is unchanged. Checks that
+    #   the files of every model arm are in the format of the manifest, so
+    #   nothing is written to results that cannot be appended to
+    # Args:
+    #   population_df: cohort dataframe, extended at the end (e.g., by
+    #   develop_cohort.py --append)
+    #   manifest: manifest of the earlier results (output from read_run_manifest)
+    #   engine: simulation engine of the new run (a key of ENGINES)
+    #   trace_format: format of the results of the new run
+    #   results_folder: results folder of the earlier results (e.g., results/)
+    # Returns:
+    #   cohort dataframe restricted to the new individuals
+    #   (raises ValueError if they cannot be appended to the earlier results)
+
+    for key, value in [
+        ("scenario_hash", hash_scenario()),
+        ("engine", engine),
+        ("engine_version", ENGINE_VERSION),
+        ("trace_format", trace_format),
+    ]:
+        if manifest[key] != value:
+            raise ValueError(
+                f"cannot append to results simulated with a different {key} "
+                f"({manifest[key]})"
+            )
+    for model in MODELS:
+        for arm in ARMS:
+            for file_name in trace_files(trace_format):
+                if not os.path.exists(f"{results_folder}/{model}/{arm}/{file_name}"):
+                    raise ValueError(
+                        f"{model}/{arm}/{file_name} not found: the results are "
+                        f"not all in the {trace_format} format of "
+                        f"{RUN_MANIFEST_FILE}"
+                    )
+    simulated = manifest["cohort_size"]
+    if len(population_df) <= simulated:
+        raise ValueError(
+            f"the cohort has {len(population_df)} individuals and {simulated} "
+            "were already simulated: there are no new individuals"
+        )
+    if hash_cohort(population_df.iloc[:simulated]) != manifest["cohort_hash"]:
+        raise ValueError(
+            f"the first {simulated} individuals of the cohort differ from the "
+            "simulated ones: new individuals must be added at the end"
+        )
+    # results without the number of cycles predate cohorts younger than
+    # starting_age (definitions in functions.py)
+    if trace_cycles(population_df["starting_age"]) != manifest.get("cycles", cycles):
+        raise ValueError(
+            "the new individuals are younger than the traces of the earlier "
+            "results cover: simulate the whole cohort again"
+        )
+    new_df = population_df.iloc[simulated:]
+    if manifest["id_max"] is not None and new_df["id"].min() <= manifest["id_max"]:
+        raise ValueError("the ids of the new individuals repeat simulated ids")
+    return new_df
+
+
+def read_total_traces(results_folder, model):
+    # Function:
+    #   Reads the total traces of both treatment arms of one model, with their
+    #   traces (e.g., for add_control_variates in markov_functions.py)
+    # Args:
+    #   results_folder: results folder (e.g., results/)
+    #   model: "standard" or "framework"
+    # Returns:
+    #   total traces of the standard of care and the new treatment
+
+    return tuple(
+        pd.read_csv(
+            f"{results_folder}/{model}/{arm}/total_trace.csv",
+            float_precision="round_trip",
+            **COHORT_CSV_OPTIONS,
+        )
+        for arm in ["sc", "nt"]
+    )
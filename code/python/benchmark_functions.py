@@ -0,0 +1,237 @@
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime, timezone
+import pandas as pd
+import numpy as np
+from functions import *
+from sampling_functions import *
+
+# identify overall folder directory for reading/saving files
+current_directory = os.path.dirname(__file__)
+parent_directory = os.path.dirname(current_directory)
+overall_folder = os.path.dirname(parent_directory)
+
+
+def measure_stage(function, *args, track_memory=True, **kwargs):
+    # Function:
+    #   Times one call of a pipeline stage and, in a second call under
+    #   tracemalloc, measures its peak memory. Memory is measured separately
+    #   because tracemalloc slows down the timed call
+    # Args:
+    #   function: stage to run
+    #   *args, **kwargs: arguments of the stage
+    #   track_memory: if False, skip the memory measurement
+    # Returns:
+    #   result: output of the stage
+    #   seconds: wall-clock time of the stage
+    #   peak_memory_mb: peak memory allocated by the stage in MB (None if
+    #   track_memory is False)
+
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+
+    peak_memory_mb = None
+    if track_memory:
+        tracemalloc.start()
+        function(*args, **kwargs)
+        peak_memory_mb = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    return result, seconds, peak_memory_mb
+
+
+def benchmark_record(stage, model, cohort_size, units, unit, seconds, peak_memory_mb):
+    # Function:
+    #   Creates the machine-readable record of one benchmarked stage
+    # Args:
+    #   stage: name of the stage
+    #   model: "standard", "framework" or None for stages shared by both models
+    #   cohort_size: cohort size of the benchmark run
+    #   units: amount of work done by the stage (e.g., person-cycles simulated)
+    #   unit: name of the unit of work (e.g., "person-cycles")
+    #   seconds: wall-clock time of the stage
+    #   peak_memory_mb: peak memory of the stage in MB
+    # Returns:
+    #   dictionary with the stage timing, throughput and peak memory
+
+    return {
+        "stage": stage,
+        "model": model,
+        "cohort_size": cohort_size,
+        "units": units,
+        "unit": unit,
+        "seconds": seconds,
+        "throughput": units / seconds if units and seconds > 0 else None,
+        "peak_memory_mb": peak_memory_mb,
+    }
+
+
+def tile_trace(trace, size):
+    # Function:
+    #   Repeats the rows of a simulated trace up to a given cohort size, so the
+    #   analysis and I/O stages can be benchmarked at cohort sizes that are too
+    #   large to simulate with the individual-level loop
+    # Args:
+    #   trace: pandas dataframe with one row per individual
+    #   size: number of rows of the tiled trace
+    # Returns:
+    #   pandas dataframe with `size` rows and a fresh index
+
+    repeats = int(np.ceil(size / len(trace)))
+    return pd.concat([trace] * repeats, ignore_index=True).iloc[:size]
+
+
+def time_transition_generator(generate_transitions, inputs):
+    # Function:
+    #   Calls a transition generator once for every set of inputs
+    # Args:
+    #   generate_transitions: transition probability function
+    #   (e.g., generate_transitions_HS_standard)
+    #   inputs: list of argument tuples
+    # Returns:
+    #   None
+
+    for this_input in inputs:
+        generate_transitions(*this_input)
+
+
+def time_choice_sampler(transitions, seed):
+    # Function:
+    #   Samples one state from every transition probability array with
+    #   np.random.choice, as the reference engine used to
+    # Args:
+    #   transitions: list of transition probability arrays
+    #   seed: random seed of the draws
+    # Returns:
+    #   list of the indices of the sampled states
+
+    np.random.seed(seed)
+    return [int(np.random.choice(len(x), size=1, p=x)[0]) for x in transitions]
+
+
+def time_table_sampler(table, rows, seed):
+    # Function:
+    #   Samples one state from every row of a sampling table one at a time, as
+    #   the reference engine does (definitions in sampling_functions.py)
+    # Args:
+    #   table: sampling table (output from create_sampling_table)
+    #   rows: list of row ids (output from table_row)
+    #   seed: random seed of the draws
+    # Returns:
+    #   list of the indices of the sampled states
+
+    np.random.seed(seed)
+    return [draw_state(table, row) for row in rows]
+
+
+def time_batch_sampler(table, rows, seed):
+    # Function:
+    #   Samples one state from every row of a sampling table in one batch, with
+    #   the uniform draws of time_table_sampler
+    # Args:
+    #   table: sampling table (output from create_sampling_table)
+    #   rows: list of row ids (output from table_row)
+    #   seed: random seed of the draws
+    # Returns:
+    #   list of the indices of the sampled states
+
+    uniforms = np.random.RandomState(seed).random_sample(len(rows))
+    return sample_rows(cumulative_table(table), np.array(rows), uniforms).tolist()
+
+
+def get_git_commit():
+    # Function:
+    #   Identifies the commit of the code being benchmarked
+    # Args:
+    #   None
+    # Returns:
+    #   git commit hash ("unknown" outside of a git repository)
+
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=overall_folder,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def benchmark_metadata():
+    # Function:
+    #   Describes the code and machine a benchmark ran on
+    # Args:
+    #   None
+    # Returns:
+    #   dictionary of metadata saved with the benchmark results
+
+    return {
+        "git_commit": get_git_commit(),
+        "engine_version": ENGINE_VERSION,
+        "date": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def save_benchmark(records, benchmark_folder):
+    # Function:
+    #   Saves benchmark records and metadata as a json file named after
+    #   the commit and time of the run
+    # Args:
+    #   records: list of benchmark records (output from benchmark_record)
+    #   benchmark_folder: folder to save the benchmark in
+    # Returns:
+    #   path to the saved json file
+
+    metadata = benchmark_metadata()
+    os.makedirs(benchmark_folder, exist_ok=True)
+    timestamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+    file_name = f"benchmark_{metadata['git_commit'][:7]}_{timestamp}.json"
+    path = f"{benchmark_folder}/{file_name}"
+    with open(path, "w") as f:
+        json.dump({"metadata": metadata, "records": records}, f, indent=2)
+    return path
+
+
+def load_benchmark(path):
+    # Function:
+    #   Reads the records of a saved benchmark
+    # Args:
+    #   path: path to a json file written by save_benchmark
+    # Returns:
+    #   pandas dataframe of benchmark records
+
+    with open(path, "r") as f:
+        return pd.DataFrame(json.load(f)["records"])
+
+
+def compare_benchmarks(baseline, current):
+    # Function:
+    #   Compares the stage timings of two benchmarks, e.g. from two commits
+    # Args:
+    #   baseline: pandas dataframe of baseline records (output from load_benchmark)
+    #   current: pandas dataframe of current records
+    # Returns:
+    #   pandas dataframe with the baseline and current seconds and peak memory
+    #   of every stage run in both benchmarks, and the ratio of current to
+    #   baseline seconds (> 1 is a slowdown)
+
+    keys = ["stage", "model", "cohort_size"]
+    comparison = baseline[keys + ["seconds", "peak_memory_mb"]].merge(
+        current[keys + ["seconds", "peak_memory_mb"]],
+        on=keys,
+        suffixes=(" baseline", " current"),
+    )
+    comparison["ratio"] = comparison["seconds current"] / comparison["seconds baseline"]
+    return comparison
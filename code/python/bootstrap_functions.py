@@ -0,0 +1,246 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from functions import *
+from adaptive_functions import (
+    RACE_GROUPS,
+    EFFECT_COLUMNS,
+    SICK_ONLY_COLUMNS,
+    EFFECT_STATISTICS,
+)
+
+# race group label of the racial gaps (NHB minus NHW)
+GAP_GROUP = "-".join(RACE_GROUPS)
+# incremental cost-effectiveness ratio: difference in this outcome per
+# difference in the other
+ICER_COLUMNS = ("discounted_cost", "discounted_QALY")
+# percentiles of the bootstrap confidence intervals
+BOOTSTRAP_PERCENTILES = [2.5, 97.5]
+
+
+def bootstrap_statistics():
+    # Function:
+    #   Statistics estimated by the bootstrap: the means of create_treatment_effect
+    #   for every race group, outcome and treatment (SC, NT, Diff), the ICER of
+    #   the new treatment in every race group and the racial gaps (NHB - NHW)
+    #   of all of these
+    # Args:
+    #   None
+    # Returns:
+    #   list of (race, column, statistic)
+
+    columns = EFFECT_COLUMNS + ["ICER"]
+    statistics = []
+    for r in RACE_GROUPS + [GAP_GROUP]:
+        for c in columns:
+            for s in EFFECT_STATISTICS if c != "ICER" else ["Diff"]:
+                statistics.append((r, c, s))
+    return statistics
+
+
+def bootstrap_arrays(trace):
+    # Function:
+    #   Converts a combined total trace into the per-unit arrays the bootstrap
+    #   resamples: the weighted sums and weights of every mean of
+    #   create_treatment_effect contributed by every resampling unit. Units are
+    #   individuals or, in antithetic cohorts, antithetic pairs (which are not
+    #   independent), resampled within their stratum in stratified cohorts.
+    #   Sampling weights ('weight') and rows standing for several individuals
+    #   ('count') are kept
+    # Args:
+    #   trace: combined total trace (output from combine_treatment_arms or
+    #   read_treatment_effect_trace in shard_functions.py)
+    # Returns:
+    #   dictionary with 'sums' (units by means, the weighted sum and weight of
+    #   every mean in turn), 'multiplicity' (individuals every unit stands for)
+    #   and 'strata' (list of the positions of the units of every stratum)
+
+    total_trace_SC = trace[trace["treatment_type"] == "Standard of Care"]
+    total_trace_NT = trace[trace["treatment_type"] == "New Treatment"]
+    if not total_trace_SC.index.sort_values().equals(
+        total_trace_NT.index.sort_values()
+    ):
+        raise ValueError("both treatment arms must hold the same individuals")
+    total_trace_NT = total_trace_NT.loc[total_trace_SC.index]
+    counts = trajectory_counts(total_trace_SC)
+    # weight of one of the individuals of every row
+    weights = design_weights(total_trace_SC) / counts
+    race = total_trace_SC["race"].to_numpy()
+    sick_SC = (total_trace_SC["was_sick"] == 1).to_numpy()
+    sick_NT = (total_trace_NT["was_sick"] == 1).to_numpy()
+
+    sums = []
+    for r in RACE_GROUPS:
+        in_race = race == r
+        for c in EFFECT_COLUMNS:
+            values_SC = total_trace_SC[c].to_numpy(dtype=float)
+            values_NT = total_trace_NT[c].to_numpy(dtype=float)
+            if c in SICK_ONLY_COLUMNS:
+                in_SC, in_NT = in_race & sick_SC, in_race & sick_NT
+            else:
+                in_SC, in_NT = in_race, in_race
+            in_both = in_SC & in_NT
+            for values, members in [
+                (values_SC, in_SC),
+                (values_NT, in_NT),
+                (np.where(in_both, values_NT - values_SC, 0.0), in_both),
+            ]:
+                sums.append(np.where(members, weights * values, 0.0))
+                sums.append(np.where(members, weights, 0.0))
+    sums = np.column_stack(sums)
+
+    if "antithetic_pair" in total_trace_SC.columns:
+        # every pair is drawn as a whole
+        pairs = total_trace_SC["antithetic_pair"].to_numpy()
+        first = np.unique(pairs, return_index=True)[1]
+        unit_sums = (
+            pd.DataFrame(counts[:, None] * sums).groupby(pairs).sum().to_numpy()
+        )
+        multiplicity = np.ones(len(unit_sums))
+    else:
+        unit_sums = sums
+        multiplicity = counts
+        first = np.arange(len(sums))
+    if "stratum" in total_trace_SC.columns:
+        unit_strata = total_trace_SC["stratum"].astype(str).to_numpy()[first]
+    else:
+        unit_strata = np.zeros(len(unit_sums), dtype=int)
+    codes = pd.factorize(unit_strata)[0]
+    return {
+        "sums": unit_sums,
+        "multiplicity": multiplicity,
+        "strata": [np.flatnonzero(codes == h) for h in range(codes.max() + 1)],
+    }
+
+
+def bootstrap_means(arrays, resampling_weights):
+    # Function:
+    #   Means of create_treatment_effect under resampling weights
+    # Args:
+    #   arrays: bootstrap arrays (output from bootstrap_arrays)
+    #   resampling_weights: replicates by units array of the number of times
+    #   every unit is drawn
+    # Returns:
+    #   replicates by means array (nan for empty groups)
+
+    sums = resampling_weights @ arrays["sums"]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return sums[:, 0::2] / sums[:, 1::2]
+
+
+def bootstrap_derived(means):
+    # Function:
+    #   Adds the ICERs and the racial gaps to the means, in the order of
+    #   bootstrap_statistics
+    # Args:
+    #   means: replicates by means array (output from bootstrap_means)
+    # Returns:
+    #   replicates by statistics array
+
+    per_race = means.reshape(len(means), len(RACE_GROUPS), -1)
+    diff = EFFECT_STATISTICS.index("Diff")
+    cost = EFFECT_COLUMNS.index(ICER_COLUMNS[0]) * len(EFFECT_STATISTICS) + diff
+    effect = EFFECT_COLUMNS.index(ICER_COLUMNS[1]) * len(EFFECT_STATISTICS) + diff
+    # replicates without a difference in effect have no ICER
+    with np.errstate(invalid="ignore", divide="ignore"):
+        icer = per_race[:, :, cost] / per_race[:, :, effect]
+    icer[~np.isfinite(icer)] = np.nan
+    per_race = np.concatenate([per_race, icer[:, :, None]], axis=2)
+    gap = per_race[:, 0] - per_race[:, 1]
+    return np.concatenate([per_race.reshape(len(means), -1), gap], axis=1)
+
+
+def bootstrap_block(arrays, replicates, seed_sequence):
+    # Function:
+    #   Draws a block of bootstrap replicates: multinomial resampling weights of
+    #   the units of every stratum (the number of times every unit is drawn),
+    #   and the statistics of all replicates at once with one matrix product
+    # Args:
+    #   arrays: bootstrap arrays (output from bootstrap_arrays)
+    #   replicates: number of replicates in the block
+    #   seed_sequence: numpy SeedSequence of the block
+    # Returns:
+    #   replicates by statistics array (columns of bootstrap_statistics)
+
+    rng = np.random.default_rng(seed_sequence)
+    resampling_weights = np.zeros((replicates, len(arrays["sums"])))
+    for units in arrays["strata"]:
+        multiplicity = arrays["multiplicity"][units]
+        size = int(round(multiplicity.sum()))
+        # draws the units of every replicate and counts them, which is faster
+        # than drawing the multinomial counts directly
+        if (multiplicity == 1).all():
+            draws = rng.integers(0, len(units), size=(replicates, size))
+        else:
+            draws = rng.choice(
+                len(units), size=(replicates, size), p=multiplicity / size
+            )
+        draws += len(units) * np.arange(replicates)[:, None]
+        resampling_weights[:, units] = np.bincount(
+            draws.ravel(), minlength=replicates * len(units)
+        ).reshape(replicates, len(units))
+    return bootstrap_derived(bootstrap_means(arrays, resampling_weights))
+
+
+def bootstrap_treatment_effect(
+    trace, replicates=1000, block_size=50, seed=1234, jobs=1
+):
+    # Function:
+    #   Bootstrap standard errors and percentile confidence intervals of the
+    #   treatment effect table, the ICERs and the racial gaps. Replicates are
+    #   drawn in blocks of block_size (memory grows with the block size times
+    #   the cohort size), and block b uses the b-th child of the seed, so the
+    #   results do not depend on the number of jobs
+    # Args:
+    #   trace: combined total trace (output from combine_treatment_arms or
+    #   read_treatment_effect_trace in shard_functions.py). Control variates,
+    #   if any, are not used
+    #   replicates: number of bootstrap replicates
+    #   block_size: number of replicates drawn at a time
+    #   seed: random seed of the bootstrap
+    #   jobs: number of worker processes drawing blocks
+    # Returns:
+    #   pandas dataframe with the race group (or gap), column, statistic (SC,
+    #   NT or Diff), estimate, bootstrap standard error and confidence interval
+    #   of every statistic of bootstrap_statistics
+
+    if replicates < 2 or block_size < 1 or jobs < 1:
+        raise ValueError(
+            "the bootstrap needs at least 2 replicates, and the block size and "
+            "the number of jobs must be at least 1"
+        )
+    arrays = bootstrap_arrays(trace)
+    estimate = bootstrap_derived(
+        bootstrap_means(arrays, arrays["multiplicity"][None, :])
+    )[0]
+    block_sizes = [
+        min(block_size, replicates - start)
+        for start in range(0, replicates, block_size)
+    ]
+    seed_sequences = np.random.SeedSequence(seed).spawn(len(block_sizes))
+    if jobs == 1:
+        blocks = [
+            bootstrap_block(arrays, size, seed_sequence)
+            for size, seed_sequence in zip(block_sizes, seed_sequences)
+        ]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            blocks = list(
+                executor.map(
+                    bootstrap_block,
+                    [arrays] * len(block_sizes),
+                    block_sizes,
+                    seed_sequences,
+                )
+            )
+    values = np.concatenate(blocks)
+    bootstrap_df = pd.DataFrame(
+        bootstrap_statistics(), columns=["race", "column", "statistic"]
+    )
+    bootstrap_df["estimate"] = estimate
+    with np.errstate(invalid="ignore"):
+        bootstrap_df["se"] = np.nanstd(values, axis=0, ddof=1)
+        lower, upper = np.nanpercentile(values, BOOTSTRAP_PERCENTILES, axis=0)
+    bootstrap_df["lower"] = lower
+    bootstrap_df["upper"] = upper
+    return bootstrap_df
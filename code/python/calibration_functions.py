@@ -0,0 +1,347 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from functions import *
+from markov_functions import *
+from cohort_functions import read_cohort
+from sensitivity_functions import model_parameter_overrides, model_parameters
+
+# parameters calibrated by default and the bounds they are searched within, by
+# model (the rate ratios of the uninsured only exist in the social framework)
+CALIBRATION_BOUNDS = {
+    "standard": {
+        "pHS": (0.01, 0.10),
+        "pOI": (0.01, 0.20),
+        "pDT": (0.05, 0.50),
+        "pDTUT": (0.005, 0.10),
+    },
+    "framework": {
+        "pHS": (0.01, 0.10),
+        "pOI": (0.01, 0.20),
+        "pDT": (0.05, 0.50),
+        "pDTUT": (0.005, 0.10),
+        "rrOI_no_ins": (0.05, 1.0),
+        "rrDT_no_ins": (0.05, 1.0),
+        "rrDTUT_no_ins": (1.0, 10.0),
+    },
+}
+# calibration targets: life expectancy (expected years lived from the starting
+# age, as years_to_death) and prevalence (share of the living who are sick) at
+# an age, by race group ("all" for everyone)
+TARGET_MEASURES = ["life_expectancy", "prevalence"]
+TARGET_COLUMNS = ["race", "measure", "age", "value", "se"]
+
+# model outputs already computed, by model, cohort groups and candidate
+calibration_cache = dict()
+
+
+def parse_calibration_bounds(text):
+    # Function:
+    #   Parses the bounds of one calibrated parameter
+    # Args:
+    #   text: "name=low:high" (e.g., "pHS=0.01:0.1")
+    # Returns:
+    #   (name, (low, high)) (raises ValueError if malformed)
+
+    name, _, values = text.partition("=")
+    try:
+        low, high = [float(value) for value in values.split(":")]
+    except ValueError:
+        raise ValueError(f"invalid bounds in '{text}' (expected name=low:high)")
+    if not low < high:
+        raise ValueError(f"the lower bound of {name} must be below the upper bound")
+    return name, (low, high)
+
+
+def read_calibration_targets(path):
+    # Function:
+    #   Reads calibration targets from a csv file with the TARGET_COLUMNS: one
+    #   row per race group ("NHB", "NHW" or "all") and measure (TARGET_MEASURES),
+    #   the age of prevalence targets (empty for life expectancy), the target
+    #   value and its standard error
+    # Args:
+    #   path: path to the targets csv file
+    # Returns:
+    #   pandas dataframe of targets (raises ValueError if malformed)
+
+    targets_df = pd.read_csv(path)
+    missing = [c for c in TARGET_COLUMNS if c not in targets_df.columns]
+    if missing:
+        raise ValueError(f"the targets are missing the columns {missing}")
+    unknown = set(targets_df["measure"]) - set(TARGET_MEASURES)
+    if unknown:
+        raise ValueError(f"unknown target measures {sorted(unknown)}")
+    if not set(targets_df["race"]) <= {"NHB", "NHW", "all"}:
+        raise ValueError("target race groups must be NHB, NHW or all")
+    prevalence = targets_df["measure"] == "prevalence"
+    if targets_df.loc[prevalence, "age"].isna().any():
+        raise ValueError("prevalence targets need an age")
+    if not (targets_df["se"] > 0).all():
+        raise ValueError("target standard errors must be positive")
+    return targets_df[TARGET_COLUMNS]
+
+
+def calibration_groups(model, population_df):
+    # Function:
+    #   Groups of the cohort with the same characteristics in the model
+    #   (MODEL_CHARACTERISTICS), which follow the same Markov chain
+    # Args:
+    #   model: "standard" or "framework"
+    #   population_df: cohort dataframe
+    # Returns:
+    #   tuple of (characteristics tuple, weight) pairs; the weights are the
+    #   (sampling-weighted) number of individuals of every group
+
+    characteristics = MODEL_CHARACTERISTICS[model]
+    groups_df = population_df[characteristics].astype(object)
+    groups_df["weight"] = design_weights(population_df)
+    weights = groups_df.groupby(characteristics)["weight"].sum()
+    return tuple(
+        (tuple(values), float(weight)) for values, weight in weights.items()
+    )
+
+
+def latin_hypercube(bounds, samples, rng):
+    # Function:
+    #   Draws a Latin hypercube sample: every parameter's range is split into
+    #   samples equal intervals, each used by exactly one candidate
+    # Args:
+    #   bounds: dictionary mapping parameter names to (low, high)
+    #   samples: number of candidates
+    #   rng: numpy random generator
+    # Returns:
+    #   pandas dataframe with one row per candidate and one column per parameter
+
+    candidates = dict()
+    for name, (low, high) in bounds.items():
+        u = (rng.permutation(samples) + rng.random(samples)) / samples
+        candidates[name] = low + u * (high - low)
+    return pd.DataFrame(candidates)
+
+
+def calibration_outputs(model, candidate, groups):
+    # Function:
+    #   Life expectancy and prevalence by age of every race group under the
+    #   standard of care, with the candidate parameter values. Every group's
+    #   expected state occupancy is propagated exactly through its Markov chain
+    #   (markov_transition_kernels), so candidates are compared without
+    #   simulation noise
+    # Args:
+    #   model: "standard" or "framework"
+    #   candidate: dictionary of parameter names and values
+    #   groups: cohort groups (output from calibration_groups)
+    # Returns:
+    #   pandas dataframe with the race, measure, age and value of every output
+
+    characteristics_names = MODEL_CHARACTERISTICS[model]
+    alive_states = JOINT_DNH != "D"
+    sick_states = JOINT_DNH == "S"
+    occupancy_arr = []
+    years_arr = []
+    with model_parameters(model_parameter_overrides(candidate)):
+        for values, weight in groups:
+            characteristics = dict(zip(characteristics_names, values))
+            kernels = markov_transition_kernels(model, False, characteristics)
+            if model == "standard":
+                # everyone starts healthy in the health system
+                initial_HS = "IHS"
+            else:
+                initial_HS = characteristics["place"]
+            n_cycles = len(kernels)
+            occupancy = np.zeros((n_cycles + 1, len(JOINT_STATES)))
+            occupancy[0, JOINT_STATES.index((initial_HS, "H"))] = 1
+            for t in range(n_cycles):
+                occupancy[t + 1] = occupancy[t] @ kernels[t]
+            alive = occupancy[:, alive_states].sum(axis=1)
+            for race in [characteristics["race"], "all"]:
+                occupancy_arr.append(
+                    pd.DataFrame(
+                        {
+                            "race": race,
+                            "age": characteristics["starting_age"]
+                            + np.arange(n_cycles + 1, dtype=float),
+                            "alive": weight * alive,
+                            "sick": weight * occupancy[:, sick_states].sum(axis=1),
+                        }
+                    )
+                )
+                years_arr.append([race, weight, weight * alive.sum()])
+
+    occupancy_df = (
+        pd.concat(occupancy_arr)
+        .groupby(["race", "age"], as_index=False)[["alive", "sick"]]
+        .sum()
+    )
+    occupancy_df = occupancy_df[occupancy_df["alive"] > 0]
+    prevalence_df = pd.DataFrame(
+        {
+            "race": occupancy_df["race"],
+            "measure": "prevalence",
+            "age": occupancy_df["age"],
+            "value": occupancy_df["sick"] / occupancy_df["alive"],
+        }
+    )
+    years_df = pd.DataFrame(years_arr, columns=["race", "weight", "years"])
+    years_df = years_df.groupby("race", as_index=False)[["weight", "years"]].sum()
+    life_expectancy_df = pd.DataFrame(
+        {
+            "race": years_df["race"],
+            "measure": "life_expectancy",
+            "age": np.nan,
+            "value": years_df["years"] / years_df["weight"],
+        }
+    )
+    return pd.concat([life_expectancy_df, prevalence_df], ignore_index=True)
+
+
+def cached_calibration_outputs(model, candidate, groups):
+    # Function:
+    #   calibration_outputs, memoized: candidates already evaluated on the same
+    #   cohort groups are not evaluated again
+    # Args:
+    #   same as calibration_outputs
+    # Returns:
+    #   same as calibration_outputs
+
+    key = (model, groups, tuple(sorted(candidate.items())))
+    if key not in calibration_cache:
+        calibration_cache[key] = calibration_outputs(model, candidate, groups)
+    return calibration_cache[key]
+
+
+def calibration_fit(outputs_df, targets_df):
+    # Function:
+    #   Goodness of fit of model outputs to the targets: the sum of squared
+    #   differences divided by the squared target standard errors
+    # Args:
+    #   outputs_df: model outputs (output from calibration_outputs)
+    #   targets_df: calibration targets (output from read_calibration_targets)
+    # Returns:
+    #   goodness of fit (lower is better; infinite if a target has no output)
+
+    merged = targets_df.merge(
+        outputs_df,
+        on=["race", "measure", "age"],
+        how="left",
+        suffixes=("", "_model"),
+    )
+    if merged["value_model"].isna().any():
+        return np.inf
+    residuals = (merged["value_model"] - merged["value"]) / merged["se"]
+    return float((residuals**2).sum())
+
+
+def evaluate_candidates(model, candidates_df, groups, targets_df, jobs=1):
+    # Function:
+    #   Goodness of fit of every candidate, evaluating the candidates not seen
+    #   before in parallel worker processes
+    # Args:
+    #   model: "standard" or "framework"
+    #   candidates_df: pandas dataframe of candidates (one column per parameter)
+    #   groups: cohort groups (output from calibration_groups)
+    #   targets_df: calibration targets (output from read_calibration_targets)
+    #   jobs: number of worker processes (1 evaluates in this process)
+    # Returns:
+    #   array of goodness of fit values (calibration_fit)
+
+    candidates = candidates_df.to_dict(orient="records")
+    new = [
+        candidate
+        for candidate in candidates
+        if (model, groups, tuple(sorted(candidate.items()))) not in calibration_cache
+    ]
+    if jobs > 1 and new:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            outputs = executor.map(
+                calibration_outputs,
+                [model] * len(new),
+                new,
+                [groups] * len(new),
+                chunksize=max(1, len(new) // (4 * jobs)),
+            )
+            for candidate, outputs_df in zip(new, outputs):
+                key = (model, groups, tuple(sorted(candidate.items())))
+                calibration_cache[key] = outputs_df
+    return np.array(
+        [
+            calibration_fit(
+                cached_calibration_outputs(model, candidate, groups), targets_df
+            )
+            for candidate in candidates
+        ]
+    )
+
+
+def run_calibration(
+    model,
+    targets_df,
+    bounds=None,
+    samples=1000,
+    accept=0.05,
+    rounds=1,
+    seed=1234,
+    jobs=1,
+    population_df=None,
+):
+    # Function:
+    #   Calibrates model parameters to targets by Latin hypercube sampling and
+    #   acceptance: draws candidates within the bounds, evaluates their fit and
+    #   accepts the best share of them. Every further round draws new candidates
+    #   within the range of the candidates accepted so far
+    # Args:
+    #   model: "standard" or "framework"
+    #   targets_df: calibration targets (output from read_calibration_targets)
+    #   bounds: dictionary mapping parameter names to (low, high) (defaults to
+    #   CALIBRATION_BOUNDS[model])
+    #   samples: number of candidates drawn in every round
+    #   accept: share of all candidates drawn that is accepted
+    #   rounds: number of rounds of sampling
+    #   seed: random seed of the sampling
+    #   jobs: number of worker processes evaluating candidates
+    #   population_df: cohort whose groups are averaged over (defaults to
+    #   results/cohort.csv)
+    # Returns:
+    #   pandas dataframe of every candidate (one column per parameter) with its
+    #   round, goodness of fit and whether it was accepted, best fit first
+
+    if model not in CALIBRATION_BOUNDS:
+        raise ValueError(f"unknown model '{model}' (expected standard or framework)")
+    if bounds is None:
+        bounds = CALIBRATION_BOUNDS[model]
+    unknown = set(bounds) - set(CALIBRATION_BOUNDS[model])
+    if unknown:
+        raise ValueError(
+            f"the {model} model cannot calibrate {sorted(unknown)} (parameters: "
+            f"{', '.join(CALIBRATION_BOUNDS[model])})"
+        )
+    if samples < 1 or rounds < 1 or not 0 < accept <= 1:
+        raise ValueError(
+            "the number of samples and rounds must be at least 1, and the "
+            "accepted share between 0 and 1"
+        )
+    if population_df is None:
+        population_df = read_cohort()
+    groups = calibration_groups(model, population_df)
+    rng = np.random.default_rng(seed)
+
+    candidates_arr = []
+    round_bounds = dict(bounds)
+    for r in range(rounds):
+        candidates_df = latin_hypercube(round_bounds, samples, rng)
+        candidates_df["fit"] = evaluate_candidates(
+            model, candidates_df[list(bounds)], groups, targets_df, jobs
+        )
+        candidates_df["round"] = r
+        candidates_arr.append(candidates_df)
+        all_candidates = pd.concat(candidates_arr, ignore_index=True)
+        accepted = all_candidates.nsmallest(
+            max(1, int(np.ceil(accept * len(all_candidates)))), "fit"
+        )
+        round_bounds = {
+            name: (accepted[name].min(), accepted[name].max())
+            if accepted[name].min() < accepted[name].max()
+            else bounds[name]
+            for name in bounds
+        }
+    all_candidates["accepted"] = all_candidates.index.isin(accepted.index)
+    return all_candidates.sort_values("fit", kind="stable").reset_index(drop=True)
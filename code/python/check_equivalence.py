@@ -0,0 +1,69 @@
+import json
+import os
+import sys
+from argparse import ArgumentParser
+from functions import *
+from develop_cohort import develop_cohort
+from engine_functions import *
+from equivalence_functions import *
+
+parser = ArgumentParser()
+parser.add_argument(
+    "--candidate",
+    dest="candidate",
+    required=True,
+    help=f"engine to validate against the reference ({', '.join(ENGINES)})",
+)
+parser.add_argument(
+    "--model",
+    dest="models",
+    nargs="+",
+    default=["standard", "framework"],
+    help="models to compare (standard and/or framework)",
+)
+parser.add_argument(
+    "-n", dest="cohort_size", type=int, default=2000, help="cohort size"
+)
+parser.add_argument(
+    "--alpha",
+    dest="alpha",
+    type=float,
+    default=0.05,
+    help="family-wise significance level",
+)
+
+args = parser.parse_args()
+
+# identify overall folder directory for reading/saving files
+current_directory = os.path.dirname(__file__)
+parent_directory = os.path.dirname(current_directory)
+overall_folder = os.path.dirname(parent_directory)
+
+# both engines simulate the same cohort (not saved to results/cohort.csv), the
+# candidate with its own random seeds (run_equivalence)
+population_df = develop_cohort(args.cohort_size)
+
+equivalence_folder = f"{overall_folder}/results/equivalence"
+os.makedirs(equivalence_folder, exist_ok=True)
+
+all_equivalent = True
+for model in args.models:
+    checks, summary = run_equivalence(
+        get_engine("reference", model),
+        get_engine(args.candidate, model),
+        population_df,
+        alpha=args.alpha,
+    )
+    summary["model"] = model
+    summary["candidate"] = args.candidate
+    checks.to_csv(f"{equivalence_folder}/{args.candidate}_{model}.csv", index=False)
+    with open(f"{equivalence_folder}/{args.candidate}_{model}.json", "w") as f:
+        json.dump(summary, f, indent=2)
+
+    print(json.dumps(summary, indent=2))
+    if not summary["equivalent"]:
+        print(checks[checks["failed"]].to_string(index=False))
+    all_equivalent = all_equivalent and summary["equivalent"]
+
+# a non-zero exit code marks a failed comparison (e.g., in continuous integration)
+sys.exit(0 if all_equivalent else 1)
@@ -0,0 +1,150 @@
+import json
+import os
+import shutil
+import pandas as pd
+import numpy as np
+from functions import *
+from shard_functions import hash_scenario
+
+CHECKPOINT_MANIFEST_FILE = "checkpoint.json"
+
+
+def chunk_file_name(chunk_index):
+    # Function:
+    #   Name of the checkpoint file holding one completed chunk of individuals
+    # Args:
+    #   chunk_index: position of the chunk in the cohort
+    # Returns:
+    #   file name (e.g., "chunk_00003.csv")
+
+    return f"chunk_{chunk_index:05d}.csv"
+
+
+def write_csv_atomically(df, path):
+    # Function:
+    #   Writes a dataframe as a csv file through a temporary file, so a run
+    #   interrupted while writing never leaves a partial file behind
+    # Args:
+    #   df: pandas dataframe
+    #   path: path to the csv file
+    # Returns:
+    #   None
+
+    temporary_path = path + ".tmp"
+    df.to_csv(temporary_path, index=False)
+    os.replace(temporary_path, path)
+
+
+def prepare_checkpoint_folder(checkpoint_folder, manifest, resume):
+    # Function:
+    #   Sets up the checkpoint folder of one model arm. A new run clears any
+    #   previous checkpoints; a resumed run checks that the checkpoints were
+    #   written for the same cohort, scenario, engine and chunk size
+    # Args:
+    #   checkpoint_folder: folder with the checkpoints of one model arm
+    #   manifest: dictionary describing the run
+    #   resume: if True, keep the completed chunks of a previous run
+    # Returns:
+    #   None (raises ValueError if the checkpoints belong to a different run)
+
+    manifest_path = f"{checkpoint_folder}/{CHECKPOINT_MANIFEST_FILE}"
+    if resume and os.path.exists(manifest_path):
+        with open(manifest_path, "r") as f:
+            previous_manifest = json.load(f)
+        for key, value in manifest.items():
+            if previous_manifest.get(key) != value:
+                raise ValueError(
+                    f"cannot resume from {checkpoint_folder}: the checkpoints "
+                    f"were written with a different {key}"
+                )
+        return
+
+    if os.path.exists(checkpoint_folder):
+        shutil.rmtree(checkpoint_folder)
+    os.makedirs(checkpoint_folder)
+    temporary_path = manifest_path + ".tmp"
+    with open(temporary_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(temporary_path, manifest_path)
+
+
+def run_cohort_checkpointed(
+    run_cohort,
+    new_treatment,
+    population_df,
+    checkpoint_folder,
+    checkpoint_size,
+    cohort_hash,
+    resume=False,
+    profiler=None,
+    n_cycles=None,
+):
+    # Function:
+    #   Runs a microsimulation model arm in chunks of individuals and saves
+    #   every completed chunk (its traces and outcomes) to the checkpoint
+    #   folder, so an interrupted run can resume from the last completed chunk.
+    #   Every individual is simulated with their own random seed, so the
+    #   results do not depend on where the run was interrupted
+    # Args:
+    #   run_cohort: run_cohort_standard, run_cohort_social_framework or the
+    #   function of another engine (get_engine in engine_functions.py)
+    #   new_treatment: new treatment (True or False)
+    #   population_df: cohort to simulate
+    #   checkpoint_folder: folder with the checkpoints of this model arm
+    #   checkpoint_size: number of individuals per chunk (0 disables checkpoints)
+    #   cohort_hash: hash of the cohort file (hash_file in shard_functions.py)
+    #   resume: if True, skip the chunks completed by a previous run
+    #   profiler: optional profiler passed to run_cohort (chunks completed by
+    #   a previous run are not profiled)
+    #   n_cycles: number of cycles of the traces (defaults to trace_cycles of
+    #   population_df in functions.py, so that all chunks have the same columns)
+    # Returns:
+    #   HS_state_trace_df: health system utilization trace
+    #   state_trace_df: disease natural history trace
+    #   total_trace: combination of starting patient characteristics
+    #   and the two traces (same as run_cohort)
+
+    N = len(population_df)
+    if n_cycles is None:
+        n_cycles = trace_cycles(population_df["starting_age"])
+    if checkpoint_size == 0 or N == 0:
+        return run_cohort(new_treatment, population_df, profiler, n_cycles)
+
+    manifest = {
+        "cohort_hash": cohort_hash,
+        "scenario_hash": hash_scenario(),
+        "engine_version": ENGINE_VERSION,
+        # chunks of another simulation engine (engine_functions.py) are rerun
+        "run_cohort": run_cohort.__name__,
+        "new_treatment": bool(new_treatment),
+        "checkpoint_size": checkpoint_size,
+        "cycles": n_cycles,
+        "id_min": int(population_df["id"].min()),
+        "id_max": int(population_df["id"].max()),
+        "n_individuals": N,
+    }
+    prepare_checkpoint_folder(checkpoint_folder, manifest, resume)
+
+    total_trace_chunks = []
+    for chunk_index, start in enumerate(range(0, N, checkpoint_size)):
+        chunk_path = f"{checkpoint_folder}/{chunk_file_name(chunk_index)}"
+        if os.path.exists(chunk_path):
+            # completed by a previous run
+            total_trace_chunk = pd.read_csv(
+                chunk_path, keep_default_na=False, float_precision="round_trip"
+            )
+        else:
+            HS_chunk, state_chunk, total_trace_chunk = run_cohort(
+                new_treatment,
+                population_df.iloc[start : start + checkpoint_size],
+                profiler,
+                n_cycles,
+            )
+            write_csv_atomically(total_trace_chunk, chunk_path)
+        total_trace_chunks.append(total_trace_chunk)
+
+    total_trace = pd.concat(total_trace_chunks, axis=0, ignore_index=True)
+    total_trace.index = population_df.index
+    HS_state_trace_df = total_trace[["HSYear" + str(x) for x in range(0, n_cycles + 1)]]
+    state_trace_df = total_trace[["Year" + str(x) for x in range(0, n_cycles + 1)]]
+    return HS_state_trace_df, state_trace_df, total_trace
@@ -0,0 +1,216 @@
+import os
+import numpy as np
+import pandas as pd
+
+# identify overall folder directory for reading/saving files
+current_directory = os.path.dirname(__file__)
+parent_directory = os.path.dirname(current_directory)
+overall_folder = os.path.dirname(parent_directory)
+
+# values of the categorical characteristics of the cohort (develop_cohort)
+COHORT_CATEGORIES = {
+    "race": ["NHB", "NHW"],
+    "sex": ["F", "M"],
+    "insurance": ["N", "Y"],
+    "place": ["IHS", "OHS"],
+}
+# types of the other columns of the cohort
+COHORT_DTYPES = {
+    "id": "int64",
+    "seed": "uint32",
+    "starting_age": "int16",
+    "weight": "float64",
+    "antithetic_pair": "int64",
+    "antithetic": "uint8",
+}
+# pd.read_csv options reading the categorical values as strings (e.g., "N" is
+# not a missing value)
+COHORT_CSV_OPTIONS = {
+    "dtype": {column: str for column in list(COHORT_CATEGORIES) + ["stratum"]},
+    "keep_default_na": False,
+}
+
+
+def stratum_labels():
+    # Function:
+    #   Labels of the (race, sex, insurance, place) strata, in the order of
+    #   their stratum index
+    # Args:
+    #   None
+    # Returns:
+    #   list of labels formatted as the 'stratum' column of develop_cohort
+    #   (e.g., "NHB/F/Y/IHS")
+
+    labels = [""]
+    for column, categories in COHORT_CATEGORIES.items():
+        labels = [
+            label + ("/" if label else "") + category
+            for label in labels
+            for category in categories
+        ]
+    return labels
+
+
+def typed_cohort(population_df):
+    # Function:
+    #   Converts a cohort to compact types: categorical characteristics (and
+    #   'stratum') with fixed categories and the smallest integer types that
+    #   hold the other columns
+    # Args:
+    #   population_df: cohort dataframe (e.g., read from cohort.csv)
+    # Returns:
+    #   copy of population_df with the COHORT_CATEGORIES and COHORT_DTYPES types
+    #   (raises ValueError for values that do not fit these types)
+
+    population_df = population_df.copy()
+    categories = dict(COHORT_CATEGORIES, stratum=stratum_labels())
+    for column, column_categories in categories.items():
+        if column not in population_df.columns:
+            continue
+        values = pd.Categorical(population_df[column], categories=column_categories)
+        unknown = values.codes == -1
+        if unknown.any():
+            raise ValueError(
+                f"unknown {column} values in the cohort: "
+                f"{sorted(set(population_df[column][unknown].astype(str)))}"
+            )
+        population_df[column] = values
+    for column, dtype in COHORT_DTYPES.items():
+        if column not in population_df.columns:
+            continue
+        values = population_df[column].astype(dtype)
+        if (values.to_numpy() != population_df[column].to_numpy()).any():
+            raise ValueError(f"{column} values of the cohort do not fit in {dtype}")
+        population_df[column] = values
+    return population_df
+
+
+def read_cohort(path=None):
+    # Function:
+    #   Reads a cohort as compact types, from a csv file or from its binary
+    #   equivalent (.npz, written by write_cohort)
+    # Args:
+    #   path: path to the cohort (defaults to results/cohort.csv)
+    # Returns:
+    #   cohort dataframe (output from typed_cohort)
+
+    if path is None:
+        path = f"{overall_folder}/results/cohort.csv"
+    if path.endswith(".npz"):
+        with np.load(path, allow_pickle=False) as arrays:
+            columns = arrays["columns"].tolist()
+            population_df = pd.DataFrame(
+                {
+                    column: (
+                        pd.Categorical.from_codes(
+                            arrays[column].astype(np.int8),
+                            categories=arrays[f"{column}.categories"].tolist(),
+                        )
+                        if f"{column}.categories" in arrays
+                        else arrays[column]
+                    )
+                    for column in columns
+                }
+            )
+        return typed_cohort(population_df)
+    return typed_cohort(pd.read_csv(path, **COHORT_CSV_OPTIONS))
+
+
+def cohort_file_size(path):
+    # Function:
+    #   Number of individuals in a cohort file, without loading the cohort
+    # Args:
+    #   path: path to the cohort (csv or .npz)
+    # Returns:
+    #   number of individuals
+
+    if path.endswith(".npz"):
+        with np.load(path, allow_pickle=False) as arrays:
+            return len(arrays["id"])
+    with open(path, "rb") as f:
+        return sum(1 for line in f) - 1
+
+
+def write_cohort(population_df, path, append=False):
+    # Function:
+    #   Writes a cohort to a csv file or, if the path ends with .npz, to a
+    #   binary file of contiguous arrays (categorical columns as uint8 codes)
+    # Args:
+    #   population_df: cohort dataframe
+    #   path: path to the cohort file
+    #   append: if True, adds the individuals at the end of the existing cohort
+    #   file (the rows of a csv file are appended, so its earlier bytes are kept)
+    # Returns:
+    #   None
+
+    if not path.endswith(".npz"):
+        population_df.to_csv(
+            path, index=False, mode="a" if append else "w", header=not append
+        )
+        return
+    if append:
+        population_df = pd.concat(
+            [read_cohort(path), typed_cohort(population_df)], ignore_index=True
+        )
+    population_df = typed_cohort(population_df)
+    arrays = {"columns": np.array(population_df.columns.tolist())}
+    for column in population_df.columns:
+        if isinstance(population_df[column].dtype, pd.CategoricalDtype):
+            arrays[column] = population_df[column].cat.codes.to_numpy(dtype=np.uint8)
+            arrays[f"{column}.categories"] = np.array(
+                population_df[column].cat.categories.tolist()
+            )
+        else:
+            arrays[column] = population_df[column].to_numpy()
+    np.savez(path, **arrays)
+
+
+def stratum_index(population_df):
+    # Function:
+    #   Index of the (race, sex, insurance, place) stratum of every individual
+    # Args:
+    #   population_df: cohort dataframe
+    # Returns:
+    #   array of stratum indices (positions in stratum_labels())
+
+    index = np.zeros(len(population_df), dtype=np.uint8)
+    for column, categories in COHORT_CATEGORIES.items():
+        codes = pd.Categorical(population_df[column], categories=categories).codes
+        index = index * len(categories) + codes.astype(np.uint8)
+    return index
+
+
+def stratum_characteristics(index):
+    # Function:
+    #   Characteristics of a stratum
+    # Args:
+    #   index: stratum index (output from stratum_index)
+    # Returns:
+    #   dictionary mapping race, sex, insurance and place to their values
+
+    characteristics = dict()
+    for column, categories in reversed(list(COHORT_CATEGORIES.items())):
+        characteristics[column] = categories[int(index) % len(categories)]
+        index = int(index) // len(categories)
+    return {column: characteristics[column] for column in COHORT_CATEGORIES}
+
+
+def cohort_arrays(population_df):
+    # Function:
+    #   Contiguous per-attribute arrays of a cohort, for loops over individuals
+    #   that should not index the dataframe
+    # Args:
+    #   population_df: cohort dataframe
+    # Returns:
+    #   dictionary mapping every column to a numpy array (uint8 codes for the
+    #   categorical columns) and 'stratum_index' to the stratum indices
+
+    arrays = dict()
+    for column in population_df.columns:
+        values = population_df[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            arrays[column] = values.cat.codes.to_numpy(dtype=np.uint8)
+        else:
+            arrays[column] = np.ascontiguousarray(values.to_numpy())
+    arrays["stratum_index"] = stratum_index(population_df)
+    return arrays
@@ -0,0 +1,95 @@
+import os
+from argparse import ArgumentParser
+from functions import *
+from event_functions import *
+from shard_functions import MODELS, ARMS
+from cohort_functions import read_cohort
+from append_functions import *
+
+parser = ArgumentParser()
+parser.add_argument(
+    "--to",
+    dest="trace_format",
+    required=True,
+    choices=TRACE_FORMATS,
+    help="format to convert the results of every model arm to",
+)
+parser.add_argument(
+    "--results",
+    dest="results_folder",
+    default=None,
+    help="results folder to convert (default: results)",
+)
+parser.add_argument(
+    "--cohort",
+    dest="cohort_path",
+    default=None,
+    help="cohort of the results, needed to convert unique trajectories "
+    "(default: results/cohort.csv)",
+)
+
+args = parser.parse_args()
+
+# identify overall folder directory for reading/saving files
+current_directory = os.path.dirname(__file__)
+parent_directory = os.path.dirname(current_directory)
+overall_folder = os.path.dirname(parent_directory)
+
+results_folder = args.results_folder or f"{overall_folder}/results"
+cohort_path = args.cohort_path or f"{overall_folder}/results/cohort.csv"
+
+for model in MODELS:
+    for arm, new_treatment in zip(ARMS, [False, True]):
+        arm_folder = f"{results_folder}/{model}/{arm}"
+        if os.path.exists(f"{arm_folder}/total_trace.csv"):
+            # dense traces (the cohort columns come first in the total trace,
+            # followed by the traces and outcomes)
+            total_trace = pd.read_csv(
+                f"{arm_folder}/total_trace.csv",
+                keep_default_na=False,
+                float_precision="round_trip",
+            )
+            population_df = total_trace.iloc[:, : total_trace.columns.get_loc("Year0")]
+            HS_state_trace_df = pd.read_csv(
+                f"{arm_folder}/HS_state.csv", keep_default_na=False
+            )
+            state_trace_df = pd.read_csv(
+                f"{arm_folder}/DNH_state.csv", keep_default_na=False
+            )
+        elif os.path.exists(f"{arm_folder}/{EVENT_FILE}"):
+            # event log, with outcomes computed from the events
+            events_df = read_event_log(f"{arm_folder}/{EVENT_FILE}")
+            population_df = events_df.drop(columns=EVENT_COLUMNS)
+            (
+                HS_state_trace_df,
+                state_trace_df,
+                total_trace,
+            ) = events_to_total_trace(events_df, new_treatment)
+        else:
+            # unique trajectories, expanded to the individuals of the cohort
+            population_df = read_cohort(cohort_path)
+            (
+                HS_state_trace_df,
+                state_trace_df,
+                total_trace,
+            ) = trajectories_to_total_trace(
+                read_trajectories(f"{arm_folder}/{TRAJECTORY_FILE}"),
+                population_df,
+                new_treatment,
+            )
+        write_traces(
+            arm_folder,
+            population_df,
+            HS_state_trace_df,
+            state_trace_df,
+            total_trace,
+            args.trace_format,
+        )
+        print(f"converted {arm_folder} to {args.trace_format}")
+
+# later runs appending to the results (run_model.py --append) check their format
+# in the run manifest (definitions in append_functions.py)
+if os.path.exists(f"{results_folder}/{RUN_MANIFEST_FILE}"):
+    manifest = read_run_manifest(results_folder)
+    manifest["trace_format"] = args.trace_format
+    write_run_manifest(results_folder, manifest)
@@ -4,13 +4,7 @@ import json
 from argparse import ArgumentParser
 import os
 from functions import *
-
-
-parser = ArgumentParser()
-parser.add_argument("-n", dest="cohort_size", required=True, help="cohort size")
-
-args = parser.parse_args()
-cohort_size = int(args.cohort_size)
+from cohort_functions import typed_cohort, read_cohort, write_cohort
 
 # identify overall folder directory for reading/saving files
 current_directory = os.path.dirname(__file__)
@@ -18,7 +12,151 @@ parent_directory = os.path.dirname(current_directory)
 overall_folder = os.path.dirname(parent_directory)
 
 
-def develop_cohort(cohort_size):
+def load_cohort_proportions():
+    # Function:
+    #   Reads the demographic and health system utilization proportions
+    #   estimated from NHANES 2013-2018 survey data
+    # Args:
+    #   None
+    # Returns:
+    #   dictionary of proportions (Non-Hispanic Black, female, insured by
+    #   race/ethnicity, and with a routine place for care by insurance status)
+
+    proportions = {}
+    for name, file in [
+        ("black", "prop_black"),
+        ("female", "prop_female"),
+        ("insured_NHW", "insurance_prop_NHW"),
+        ("insured_NHB", "insurance_prop_NHB"),
+        ("place_uninsured", "place_prop_uninsured"),
+        ("place_insured", "place_prop_insured"),
+    ]:
+        with open(
+            f"{overall_folder}/data_and_inputs/nhanes_inputs/{file}.json", "r"
+        ) as f:
+            proportions[name] = json.load(f)[0]
+    return proportions
+
+
+def stratum_probabilities(proportions):
+    # Function:
+    #   Computes the probability of each of the 16 (race, sex, insurance,
+    #   place) strata of the cohort
+    # Args:
+    #   proportions: cohort proportions (output from load_cohort_proportions)
+    # Returns:
+    #   pandas dataframe with columns race, sex, insurance, place, probability
+
+    race_probs = [("NHB", proportions["black"]), ("NHW", 1 - proportions["black"])]
+    sex_probs = [("F", proportions["female"]), ("M", 1 - proportions["female"])]
+    rows = []
+    for race, p_race in race_probs:
+        insured = proportions[f"insured_{race}"]
+        for sex, p_sex in sex_probs:
+            for insurance, p_insurance in [("Y", insured), ("N", 1 - insured)]:
+                if insurance == "Y":
+                    place = proportions["place_insured"]
+                else:
+                    place = proportions["place_uninsured"]
+                for HS_state, p_place in [("IHS", place), ("OHS", 1 - place)]:
+                    probability = p_race * p_sex * p_insurance * p_place
+                    rows.append([race, sex, insurance, HS_state, probability])
+    return pd.DataFrame(
+        rows, columns=["race", "sex", "insurance", "place", "probability"]
+    )
+
+
+def allocate_strata(n, probabilities):
+    # Function:
+    #   Proportional allocation of n units to strata, rounding with the
+    #   largest remainders so the allocation adds up to n. Every stratum with
+    #   a positive probability gets at least one unit (its sampling weight
+    #   carries its population share): strata rounded down to 0 get one unit
+    #   and the others share the rest
+    # Args:
+    #   n: number of units to allocate
+    #   probabilities: array of stratum probabilities
+    # Returns:
+    #   array of the number of units in each stratum
+    #   (raises ValueError if n is smaller than the number of strata with a
+    #   positive probability)
+
+    probabilities = np.asarray(probabilities, dtype=float)
+    positive = probabilities > 0
+    if n < positive.sum():
+        raise ValueError(
+            f"{n} units cannot cover the {positive.sum()} strata: a stratified "
+            "cohort needs at least one individual (or antithetic pair) per stratum"
+        )
+    minimum = np.zeros(len(probabilities), dtype=bool)
+    while True:
+        shares = np.where(minimum, 0.0, probabilities)
+        remaining = n - minimum.sum()
+        expected = remaining * shares / max(shares.sum(), 1e-300)
+        counts = np.floor(expected).astype(int)
+        remainders = expected - counts
+        counts[np.argsort(-remainders, kind="stable")[: remaining - counts.sum()]] += 1
+        empty = positive & ~minimum & (counts == 0)
+        if not empty.any():
+            return counts + minimum
+        minimum |= empty
+
+
+def parse_oversampling(rates):
+    # Function:
+    #   Parses oversampling rates given as "race/sex/insurance/place=rate",
+    #   where any characteristic can be "*" (e.g., "NHB/*/N/*=5")
+    # Args:
+    #   rates: list of oversampling rate strings
+    # Returns:
+    #   dictionary mapping each stratum pattern to its rate
+    #   (raises ValueError for a malformed pattern or a non-positive rate)
+
+    oversampling = dict()
+    for rate in rates:
+        pattern, _, value = rate.partition("=")
+        if len(pattern.split("/")) != 4 or value == "":
+            raise ValueError(
+                f"oversampling rate '{rate}' is not of the form "
+                "race/sex/insurance/place=rate"
+            )
+        if float(value) <= 0:
+            raise ValueError(f"oversampling rate '{rate}' must be positive")
+        oversampling[pattern] = float(value)
+    return oversampling
+
+
+def oversampling_rates(strata, oversampling):
+    # Function:
+    #   Oversampling rate of every stratum: the product of the rates of all
+    #   patterns matching the stratum (1 if none match)
+    # Args:
+    #   strata: pandas dataframe of strata (output from stratum_probabilities)
+    #   oversampling: dictionary mapping stratum patterns to rates
+    # Returns:
+    #   array of oversampling rates
+
+    rates = np.ones(len(strata))
+    characteristics = strata[["race", "sex", "insurance", "place"]].to_numpy()
+    for pattern, rate in oversampling.items():
+        parts = pattern.split("/")
+        matches = np.all(
+            [(p == "*") | (characteristics[:, k] == p) for k, p in enumerate(parts)],
+            axis=0,
+        )
+        rates[matches] *= rate
+    return rates
+
+
+def develop_cohort(
+    cohort_size,
+    master_seed=1234,
+    first_id=0,
+    stratified=False,
+    antithetic=False,
+    oversampling=None,
+    ages=None,
+):
     # Function:
     #   Generates a simulated cohort of individuals given a cohort size.
     #   The demographic and health system utilization characteristics
@@ -26,71 +164,100 @@ def develop_cohort(cohort_size):
     #   survey data (NHANES_parameter_inputs.qmd file)
     # Args:
     #   cohort_size: cohort size (e.g., "100000")
+    #   master_seed: random seed of the cohort (batches of a cohort generated
+    #   separately use different master seeds)
+    #   first_id: id of the first individual of the cohort
+    #   stratified: if True, the 16 (race, sex, insurance, place) strata get
+    #   their expected share of the cohort (proportional allocation) instead of
+    #   being drawn independently, and a 'stratum' column is added
+    #   antithetic: if True, individuals come in pairs with the same
+    #   characteristics and random seed, the second one using antithetic
+    #   transition draws ('antithetic_pair' and 'antithetic' columns)
+    #   oversampling: dictionary mapping stratum patterns to oversampling rates
+    #   (e.g., {"NHB/*/N/*": 5}, see parse_oversampling). Strata are allocated
+    #   in proportion to their probability times their rate, and a 'weight'
+    #   column records the sampling weight of every individual (implies stratified)
+    #   ages: (youngest, oldest) starting ages, drawn uniformly for an open
+    #   cohort with mixed starting ages; everyone starts at starting_age if None
     # Returns:
     #   pandas dataframe of simulated cohort
 
+    if antithetic and cohort_size % 2 != 0:
+        raise ValueError("an antithetic cohort needs an even cohort size")
+    if ages is not None and not 0 <= ages[0] <= ages[1] <= 100:
+        raise ValueError("starting ages must be between 0 and 100, youngest first")
+    proportions = load_cohort_proportions()
+
     # set master random seed
-    np.random.seed(1234)
-    N = cohort_size  # number of individuals
+    np.random.seed(master_seed)
+    # number of individuals (or antithetic pairs) drawn
+    N = cohort_size // 2 if antithetic else cohort_size
 
     # get a random seed for every individual
     random_seeds = np.random.randint(1, 1000000, size=N)
 
     age_values = [starting_age for x in range(N)]
 
-    # race/ethnicity is either Non-Hispanic Black (NHB) or Non-Hipsanic white (NHW)
-    race_choices = ["NHB", "NHW"]
-    with open(
-        f"{overall_folder}/data_and_inputs/nhanes_inputs/prop_black.json", "r"
-    ) as f:
-        black_prop = json.load(f)[0]
-    race_values = np.random.choice(race_choices, size=N, p=[black_prop, 1 - black_prop])
-    # sex is either female (F) or male (M)
-    with open(
-        f"{overall_folder}/data_and_inputs/nhanes_inputs/prop_female.json", "r"
-    ) as f:
-        female_prop = json.load(f)[0]
-    sex_choices = ["F", "M"]
-    sex_values = np.random.choice(sex_choices, size=N, p=[female_prop, 1 - female_prop])
-
-    # insurance is either yes (Y) or no (N)
-    insurance_values = ["Y" for x in range(N)]
-    with open(
-        f"{overall_folder}/data_and_inputs/nhanes_inputs/insurance_prop_NHW.json", "r"
-    ) as f:
-        NHW_insured_prop = json.load(f)[0]
-    with open(
-        f"{overall_folder}/data_and_inputs/nhanes_inputs/insurance_prop_NHB.json", "r"
-    ) as f:
-        NHB_insured_prop = json.load(f)[0]
-    # differential insurance rates applied by race/ethnicity
-    insured_probs = np.where(
-        np.array(race_values) == "NHB", NHB_insured_prop, NHW_insured_prop
-    )
-    random_draws = np.random.rand(len(insured_probs))
-    insurance_values = np.where(random_draws < insured_probs, "Y", "N")
-
-    # healthcare system utilization is either out of the health system (OHS)
-    # with no routine place for care or in the health system (IHS) with routine
-    # place for care
-    with open(
-        f"{overall_folder}/data_and_inputs/nhanes_inputs/place_prop_uninsured.json", "r"
-    ) as f:
-        place_uninsured_prop = json.load(f)[0]
-    with open(
-        f"{overall_folder}/data_and_inputs/nhanes_inputs/place_prop_insured.json", "r"
-    ) as f:
-        place_insured_prop = json.load(f)[0]
-    # differential rates of place for care applied by insurance status
-    initial_HS_state = ["OHS" for j in range(N)]
-    place_probs = np.where(
-        np.array(insurance_values) == "Y", place_insured_prop, place_uninsured_prop
-    )
-    random_draws = np.random.rand(len(insured_probs))
-    initial_HS_state = np.where(random_draws < place_probs, "IHS", "OHS")
+    if oversampling is not None:
+        stratified = True
+    if stratified:
+        # every stratum gets its expected number of individuals, inflated
+        # by its oversampling rate
+        strata = stratum_probabilities(proportions)
+        allocation = strata["probability"].to_numpy()
+        if oversampling is not None:
+            allocation = allocation * oversampling_rates(strata, oversampling)
+        counts = allocate_strata(N, allocation / allocation.sum())
+        # sampling weight: population share over sample share of the stratum
+        strata["weight"] = strata["probability"] / np.maximum(counts, 1) * N
+        strata = strata.loc[strata.index.repeat(counts)].reset_index(drop=True)
+        race_values = strata["race"].to_numpy()
+        sex_values = strata["sex"].to_numpy()
+        insurance_values = strata["insurance"].to_numpy()
+        initial_HS_state = strata["place"].to_numpy()
+    else:
+        # race/ethnicity is either Non-Hispanic Black (NHB) or Non-Hipsanic white (NHW)
+        race_choices = ["NHB", "NHW"]
+        black_prop = proportions["black"]
+        race_values = np.random.choice(
+            race_choices, size=N, p=[black_prop, 1 - black_prop]
+        )
+        # sex is either female (F) or male (M)
+        female_prop = proportions["female"]
+        sex_choices = ["F", "M"]
+        sex_values = np.random.choice(
+            sex_choices, size=N, p=[female_prop, 1 - female_prop]
+        )
+
+        # insurance is either yes (Y) or no (N)
+        NHW_insured_prop = proportions["insured_NHW"]
+        NHB_insured_prop = proportions["insured_NHB"]
+        # differential insurance rates applied by race/ethnicity
+        insured_probs = np.where(
+            np.array(race_values) == "NHB", NHB_insured_prop, NHW_insured_prop
+        )
+        random_draws = np.random.rand(len(insured_probs))
+        insurance_values = np.where(random_draws < insured_probs, "Y", "N")
+
+        # healthcare system utilization is either out of the health system (OHS)
+        # with no routine place for care or in the health system (IHS) with routine
+        # place for care
+        place_uninsured_prop = proportions["place_uninsured"]
+        place_insured_prop = proportions["place_insured"]
+        # differential rates of place for care applied by insurance status
+        place_probs = np.where(
+            np.array(insurance_values) == "Y", place_insured_prop, place_uninsured_prop
+        )
+        random_draws = np.random.rand(len(insured_probs))
+        initial_HS_state = np.where(random_draws < place_probs, "IHS", "OHS")
+
+    # starting ages are drawn last, so the other characteristics do not depend
+    # on them
+    if ages is not None:
+        age_values = np.random.randint(ages[0], ages[1] + 1, size=N)
 
     # define the columns in the cohort dataframe
-    population_df = pd.DataFrame(list(range(0, N)), columns=["id"])
+    population_df = pd.DataFrame(list(range(first_id, first_id + N)), columns=["id"])
     population_df["seed"] = pd.Series(random_seeds)
     population_df["starting_age"] = pd.Series(age_values)
     population_df["race"] = pd.Series(race_values)
@@ -98,13 +265,140 @@ def develop_cohort(cohort_size):
     population_df["insurance"] = pd.Series(insurance_values)
     population_df["place"] = pd.Series(initial_HS_state)
 
-    return population_df
+    if stratified:
+        population_df["stratum"] = (
+            population_df["race"]
+            + "/"
+            + population_df["sex"]
+            + "/"
+            + population_df["insurance"]
+            + "/"
+            + population_df["place"]
+        )
+    if oversampling is not None:
+        population_df["weight"] = strata["weight"].to_numpy()
+    if antithetic:
+        # both members of a pair share their characteristics and random seed
+        population_df = population_df.loc[
+            population_df.index.repeat(2)
+        ].reset_index(drop=True)
+        population_df["id"] = list(range(first_id, first_id + cohort_size))
+        population_df["antithetic_pair"] = population_df["id"].to_numpy()[::2].repeat(2)
+        population_df["antithetic"] = [0, 1] * N
+
+    return typed_cohort(population_df)
+
+
+def extend_cohort(population_df, cohort_size, master_seed=1234, **options):
+    # Function:
+    #   Generates the individuals that extend an existing cohort: the next ids,
+    #   drawn with master seed master_seed + first id (as the batches of
+    #   run_adaptive.py), so extending a cohort always adds the same individuals
+    # Args:
+    #   population_df: existing cohort dataframe
+    #   cohort_size: number of individuals to add
+    #   master_seed: master random seed of the existing cohort
+    #   options: other arguments of develop_cohort (stratified, antithetic,
+    #   oversampling), applied within the new individuals
+    # Returns:
+    #   pandas dataframe of the new individuals
+    #   (raises ValueError if they do not have the columns of the cohort)
+
+    first_id = int(population_df["id"].max()) + 1 if len(population_df) > 0 else 0
+    new_df = develop_cohort(
+        cohort_size, master_seed=master_seed + first_id, first_id=first_id, **options
+    )
+    if list(new_df.columns) != list(population_df.columns):
+        raise ValueError(
+            f"the new individuals have the columns {', '.join(new_df.columns)} but "
+            f"the cohort has {', '.join(population_df.columns)}: extend it with "
+            "the options it was developed with (--stratified, --antithetic, "
+            "--oversample)"
+        )
+    return new_df
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-n", dest="cohort_size", required=True, help="cohort size")
+    parser.add_argument(
+        "--stratified",
+        dest="stratified",
+        action="store_true",
+        help="allocate the (race, sex, insurance, place) strata proportionally",
+    )
+    parser.add_argument(
+        "--antithetic",
+        dest="antithetic",
+        action="store_true",
+        help="simulate individuals in antithetic pairs (even cohort size)",
+    )
+    parser.add_argument(
+        "--oversample",
+        dest="oversample",
+        nargs="+",
+        default=None,
+        help="oversampling rates of strata as race/sex/insurance/place=rate, "
+        "with * matching any value (e.g., NHB/*/N/*=5)",
+    )
+    parser.add_argument(
+        "--output",
+        dest="output_path",
+        default=None,
+        help="path to write the cohort to, as a csv file or a binary file of "
+        "typed arrays if it ends with .npz (default: results/cohort.csv)",
+    )
+    parser.add_argument(
+        "--append",
+        dest="append",
+        action="store_true",
+        help="add n new individuals at the end of the existing cohort at the "
+        "output path instead of replacing it (see run_model.py --append)",
+    )
+    parser.add_argument(
+        "--ages",
+        dest="ages",
+        type=int,
+        nargs=2,
+        default=None,
+        metavar=("YOUNGEST", "OLDEST"),
+        help="draw the starting ages uniformly between the youngest and oldest "
+        f"age, for an open cohort (default: everyone starts at {starting_age})",
+    )
 
+    args = parser.parse_args()
+    cohort_size = int(args.cohort_size)
 
-cohort = develop_cohort(cohort_size)
+    oversampling = None
+    if args.oversample is not None:
+        try:
+            oversampling = parse_oversampling(args.oversample)
+        except ValueError as error:
+            parser.error(str(error))
 
+    # export cohort dataframe into results folder
+    if not os.path.exists(f"{overall_folder}/results/"):
+        os.makedirs(f"{overall_folder}/results/")
+    output_path = args.output_path
+    if output_path is None:
+        output_path = f"{overall_folder}/results/cohort.csv"
 
-# export cohort dataframe into results folder
-if not os.path.exists(f"{overall_folder}/results/"):
-    os.makedirs(f"{overall_folder}/results/")
-cohort.to_csv(f"{overall_folder}/results/cohort.csv", index=False)
+    options = {
+        "stratified": args.stratified,
+        "antithetic": args.antithetic,
+        "oversampling": oversampling,
+        "ages": args.ages,
+    }
+    if args.append:
+        if not os.path.exists(output_path):
+            parser.error(f"--append needs an existing cohort at {output_path}")
+        try:
+            cohort = extend_cohort(read_cohort(output_path), cohort_size, **options)
+        except ValueError as error:
+            parser.error(str(error))
+    else:
+        try:
+            cohort = develop_cohort(cohort_size, **options)
+        except ValueError as error:
+            parser.error(str(error))
+    write_cohort(cohort, output_path, append=args.append)
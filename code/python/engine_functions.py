@@ -0,0 +1,51 @@
+from functions import *
+from model_functions_standard import run_cohort_standard
+from model_functions_social_framework import run_cohort_social_framework
+from next_event_functions import (
+    run_cohort_standard_next_event,
+    run_cohort_social_framework_next_event,
+)
+from paired_functions import (
+    run_cohort_standard_paired,
+    run_cohort_social_framework_paired,
+)
+
+# Simulation engines by name. Each engine maps the two models to a function
+# with the same arguments and outputs as run_cohort_standard:
+#   (new_treatment, population_df=None, profiler=None, n_cycles=None)
+#   -> (HS_state_trace_df, state_trace_df, total_trace)
+ENGINES = {
+    "reference": {
+        "standard": run_cohort_standard,
+        "framework": run_cohort_social_framework,
+    },
+    # samples the time to the next transition (next_event_functions.py)
+    "next_event": {
+        "standard": run_cohort_standard_next_event,
+        "framework": run_cohort_social_framework_next_event,
+    },
+    # simulates both treatment arms together, forking at the first cycle the
+    # treatment matters (paired_functions.py); same results as the reference
+    "paired": {
+        "standard": run_cohort_standard_paired,
+        "framework": run_cohort_social_framework_paired,
+    },
+}
+
+
+def get_engine(engine, model):
+    # Function:
+    #   Looks up the function running one model with one simulation engine
+    # Args:
+    #   engine: name of the engine (a key of ENGINES, e.g., "reference")
+    #   model: "standard" or "framework"
+    # Returns:
+    #   function with the arguments and outputs of run_cohort_standard
+
+    if engine not in ENGINES:
+        raise ValueError(
+            f"unknown engine '{engine}' (available: {', '.join(ENGINES)})"
+        )
+    if model not in ENGINES[engine]:
+        raise ValueError(f"engine '{engine}' does not support the {model} model")
+    return ENGINES[engine][model]
@@ -0,0 +1,238 @@
+import math
+import time
+import pandas as pd
+import numpy as np
+from functions import *
+
+DNH_STATES = ["H", "S", "D"]
+HS_STATES = ["OHS", "IHS", "DT", "DUT"]
+# added to the random seed of every individual for the candidate engine, so its
+# draws are independent of the reference engine (cohort seeds are below 10^6)
+CANDIDATE_SEED_OFFSET = 1000000
+# test reported with the results of a comparison
+EQUIVALENCE_TEST = (
+    "two-sided z-tests of no difference; a check fails when its Holm-adjusted "
+    "p-value is below alpha"
+)
+
+
+def two_sided_p_value(z):
+    # Function:
+    #   Two-sided p-value of a standard normal test statistic
+    # Args:
+    #   z: test statistic
+    # Returns:
+    #   p-value
+
+    return math.erfc(abs(z) / math.sqrt(2))
+
+
+def holm_adjust(p_values):
+    # Function:
+    #   Holm-Bonferroni adjustment of p-values for testing many occupancy
+    #   proportions and outcome means at once
+    # Args:
+    #   p_values: array of p-values
+    # Returns:
+    #   array of adjusted p-values (same order as p_values)
+
+    p_values = np.asarray(p_values, dtype=float)
+    m = len(p_values)
+    order = np.argsort(p_values)
+    adjusted = np.empty(m)
+    running_max = 0.0
+    for rank, index in enumerate(order):
+        running_max = max(running_max, (m - rank) * p_values[index])
+        adjusted[index] = min(1.0, running_max)
+    return adjusted
+
+
+def two_proportion_z(p1, n1, p2, n2):
+    # Function:
+    #   Pooled two-proportion z statistic
+    # Args:
+    #   p1, n1: proportion and sample size of the first group
+    #   p2, n2: proportion and sample size of the second group
+    # Returns:
+    #   z statistic (0 when both proportions are 0 or 1, or a group is empty)
+
+    if n1 == 0 or n2 == 0:
+        return 0.0
+    pooled = (p1 * n1 + p2 * n2) / (n1 + n2)
+    variance = pooled * (1 - pooled) * (1 / n1 + 1 / n2)
+    if variance <= 0:
+        return 0.0
+    return (p1 - p2) / math.sqrt(variance)
+
+
+def occupancy_curves(total_trace):
+    # Function:
+    #   Occupancy of every disease natural history and health system state at
+    #   every cycle (run_DNS_state_graph and run_HS_state_graph), with the
+    #   number of individuals each proportion is computed among
+    # Args:
+    #   total_trace: total trace of one model arm
+    # Returns:
+    #   pandas dataframe with columns curve, state, cycle, proportion, n
+
+    columns = trace_columns(total_trace)
+    N = len(total_trace)
+    alive_N = [int((total_trace[c] != "D").sum()) for c in columns]
+    rows = []
+    DNH_curves = run_DNS_state_graph(total_trace)
+    for state, curve in zip(DNH_STATES, DNH_curves):
+        for t, proportion in enumerate(curve):
+            rows.append(["DNH", state, t, proportion, N])
+    for state, curve in zip(HS_STATES, run_HS_state_graph(total_trace)):
+        for t, proportion in enumerate(curve):
+            rows.append(["HS", state, t, proportion, alive_N[t]])
+    return pd.DataFrame(rows, columns=["curve", "state", "cycle", "proportion", "n"])
+
+
+def compare_occupancy(reference_total_trace, candidate_total_trace, arm):
+    # Function:
+    #   Tests whether the state occupancy curves of a candidate engine match
+    #   the reference engine, with a two-proportion z-test per state and cycle
+    # Args:
+    #   reference_total_trace: total trace of the reference engine
+    #   candidate_total_trace: total trace of the candidate engine
+    #   arm: label of the model arm (e.g., "SC")
+    # Returns:
+    #   pandas dataframe with one row per state and cycle
+
+    reference = occupancy_curves(reference_total_trace)
+    candidate = occupancy_curves(candidate_total_trace)
+    comparison = reference.merge(
+        candidate,
+        on=["curve", "state", "cycle"],
+        suffixes=(" reference", " candidate"),
+    )
+    comparison["check"] = "occupancy"
+    comparison["arm"] = arm
+    comparison["difference"] = (
+        comparison["proportion candidate"] - comparison["proportion reference"]
+    )
+    comparison["z"] = [
+        two_proportion_z(p1, n1, p2, n2)
+        for p1, n1, p2, n2 in zip(
+            comparison["proportion candidate"],
+            comparison["n candidate"],
+            comparison["proportion reference"],
+            comparison["n reference"],
+        )
+    ]
+    return comparison
+
+
+def compare_outcomes(reference_effect_df, candidate_effect_df):
+    # Function:
+    #   Tests whether the outcome means of create_treatment_effect of a candidate
+    #   engine match the reference engine, with a z-test on the difference of
+    #   means using the standard errors of both engines
+    # Args:
+    #   reference_effect_df: treatment effect of the reference engine
+    #   candidate_effect_df: treatment effect of the candidate engine
+    # Returns:
+    #   pandas dataframe with one row per race, outcome and arm (SC, NT, Diff)
+
+    rows = []
+    merged = reference_effect_df.merge(
+        candidate_effect_df,
+        on=["race", "column"],
+        suffixes=(" reference", " candidate"),
+    )
+    for _, row in merged.iterrows():
+        for arm in ["SC", "NT", "Diff"]:
+            reference_mean = row[f"{arm} mean reference"]
+            candidate_mean = row[f"{arm} mean candidate"]
+            se = combine_se_errors(
+                row[f"{arm} se reference"], row[f"{arm} se candidate"]
+            )
+            difference = candidate_mean - reference_mean
+            if se > 0:
+                z = difference / se
+            else:
+                z = 0.0 if difference == 0 else math.copysign(math.inf, difference)
+            rows.append(
+                {
+                    "check": "outcome",
+                    "arm": arm,
+                    "race": row["race"],
+                    "column": row["column"],
+                    "mean reference": reference_mean,
+                    "mean candidate": candidate_mean,
+                    "difference": difference,
+                    "z": z,
+                }
+            )
+    return pd.DataFrame(rows)
+
+
+def run_equivalence(reference_engine, candidate_engine, population_df, alpha=0.05):
+    # Function:
+    #   Runs a reference and a candidate engine on the same cohort and scenario
+    #   (both treatment arms) and tests whether their results differ. The
+    #   candidate runs with the seeds offset by CANDIDATE_SEED_OFFSET, so the
+    #   estimates of both engines are independent as the tests assume. A check
+    #   fails when its Holm-adjusted p-value is below alpha (EQUIVALENCE_TEST),
+    #   so a correct candidate fails with probability at most alpha
+    # Args:
+    #   reference_engine: reference function (e.g., run_cohort_standard)
+    #   candidate_engine: candidate function with the same arguments and outputs
+    #   population_df: cohort to simulate
+    #   alpha: family-wise significance level
+    # Returns:
+    #   checks: pandas dataframe with every occupancy and outcome check
+    #   summary: dictionary with the run times, speedup ratio, number of
+    #   failed checks and whether the engines are equivalent
+
+    candidate_df = population_df.copy()
+    candidate_df["seed"] = population_df["seed"] + CANDIDATE_SEED_OFFSET
+    totals = {}
+    seconds = {}
+    for engine_name, engine, cohort_df in [
+        ("reference", reference_engine, population_df),
+        ("candidate", candidate_engine, candidate_df),
+    ]:
+        start = time.perf_counter()
+        totals[engine_name] = {
+            arm: engine(new_treatment, cohort_df)[2]
+            for arm, new_treatment in [("SC", False), ("NT", True)]
+        }
+        seconds[engine_name] = time.perf_counter() - start
+
+    occupancy = pd.concat(
+        [
+            compare_occupancy(totals["reference"][arm], totals["candidate"][arm], arm)
+            for arm in ["SC", "NT"]
+        ],
+        ignore_index=True,
+    )
+
+    outcomes = compare_outcomes(
+        create_treatment_effect(
+            combine_treatment_arms(totals["reference"]["SC"], totals["reference"]["NT"])
+        ),
+        create_treatment_effect(
+            combine_treatment_arms(totals["candidate"]["SC"], totals["candidate"]["NT"])
+        ),
+    )
+
+    checks = pd.concat([occupancy, outcomes], ignore_index=True)
+    checks["p"] = [two_sided_p_value(z) for z in checks["z"]]
+    checks["p adjusted"] = holm_adjust(checks["p"])
+    checks["failed"] = checks["p adjusted"] < alpha
+
+    summary = {
+        "individuals": len(population_df),
+        "reference_seconds": seconds["reference"],
+        "candidate_seconds": seconds["candidate"],
+        "speedup": seconds["reference"] / seconds["candidate"],
+        "candidate_seed_offset": CANDIDATE_SEED_OFFSET,
+        "test": EQUIVALENCE_TEST,
+        "alpha": alpha,
+        "checks": len(checks),
+        "failed_checks": int(checks["failed"].sum()),
+        "equivalent": bool(not checks["failed"].any()),
+    }
+    return checks, summary
@@ -0,0 +1,316 @@
+import os
+import numpy as np
+import pandas as pd
+from functions import *
+from trajectory_functions import *
+
+# event log written instead of the dense traces (run_model.py --trace-format events)
+EVENT_FILE = "events.csv"
+# a trajectory is fully determined by the initial health system state and the
+# ages of its events (missing if the event never happens): onset of sickness,
+# entry into the health system (OHS -> IHS), detection/treatment (IHS -> DT),
+# treatment discontinuation (DT -> DUT) and death
+EVENT_COLUMNS = ["initial_HS", "sick_age", "IHS_age", "DT_age", "DUT_age", "death_age"]
+EVENT_AGE_COLUMNS = EVENT_COLUMNS[1:]
+# formats of the results of a model arm (run_model.py --trace-format)
+TRACE_FORMATS = ["dense", "events", "unique"]
+
+
+def first_cycle(trace, state):
+    # Function:
+    #   Finds the first cycle every individual is in a state
+    # Args:
+    #   trace: array of states (individuals x cycles)
+    #   state: state to look for
+    # Returns:
+    #   array of cycles (-1 if the individual is never in the state)
+
+    in_state = trace == state
+    return np.where(in_state.any(axis=1), in_state.argmax(axis=1), -1)
+
+
+def traces_to_events(population_df, HS_state_trace_df, state_trace_df):
+    # Function:
+    #   Converts the dense traces of a model arm into an event log
+    # Args:
+    #   population_df: simulated cohort
+    #   HS_state_trace_df: health system utilization trace
+    #   state_trace_df: disease natural history trace
+    # Returns:
+    #   pandas dataframe with the cohort columns followed by EVENT_COLUMNS
+    #   (same index as population_df)
+
+    HS_trace = HS_state_trace_df.to_numpy()
+    DNH_trace = state_trace_df.to_numpy()
+    starting_ages = population_df["starting_age"].to_numpy()
+
+    events_df = population_df.copy()
+    events_df["initial_HS"] = HS_trace[:, 0]
+    for column, trace, state in [
+        ("sick_age", DNH_trace, "S"),
+        ("IHS_age", HS_trace, "IHS"),
+        ("DT_age", HS_trace, "DT"),
+        ("DUT_age", HS_trace, "DUT"),
+        ("death_age", DNH_trace, "D"),
+    ]:
+        cycle = first_cycle(trace, state)
+        # starting in a state is not an event
+        event = cycle > 0
+        events_df[column] = pd.array(
+            np.where(event, starting_ages + cycle, 0), dtype="Int64"
+        )
+        events_df.loc[~event, column] = pd.NA
+    return events_df
+
+
+def event_cycles(events_df, n_cycles=None):
+    # Function:
+    #   Cycles of the events of every individual of an event log
+    # Args:
+    #   events_df: event log (output from traces_to_events)
+    #   n_cycles: number of cycles of the traces (defaults to trace_cycles of
+    #   the event log, in functions.py)
+    # Returns:
+    #   dictionary mapping each event age column to an array of cycles
+    #   (n_cycles + 1, after the end of the simulation, if the event never
+    #   happens)
+
+    starting_ages = events_df["starting_age"].to_numpy()
+    if n_cycles is None:
+        n_cycles = trace_cycles(starting_ages)
+    return {
+        column: (
+            events_df[column].astype("Float64").fillna(np.inf).to_numpy(dtype=float)
+            - starting_ages
+        ).clip(max=n_cycles + 1)
+        for column in EVENT_AGE_COLUMNS
+    }
+
+
+def events_to_traces(events_df, n_cycles=None):
+    # Function:
+    #   Rebuilds the dense traces of a model arm from its event log
+    # Args:
+    #   events_df: event log (output from traces_to_events)
+    #   n_cycles: number of cycles of the traces (trace_cycles of the whole
+    #   cohort when events_df is a chunk of it); defaults to trace_cycles of
+    #   events_df
+    # Returns:
+    #   HS_state_trace_df: health system utilization trace
+    #   state_trace_df: disease natural history trace
+
+    if n_cycles is None:
+        n_cycles = trace_cycles(events_df["starting_age"])
+    event = event_cycles(events_df, n_cycles)
+    t = np.arange(n_cycles + 1)[np.newaxis, :]
+
+    DNH_trace = np.full((len(events_df), n_cycles + 1), "H", dtype="<U6")
+    DNH_trace[t >= event["sick_age"][:, np.newaxis]] = "S"
+    DNH_trace[t >= event["death_age"][:, np.newaxis]] = "D"
+
+    # health system states only progress (OHS -> IHS -> DT -> DUT)
+    HS_trace = np.repeat(
+        events_df["initial_HS"].to_numpy(dtype="<U6")[:, np.newaxis],
+        n_cycles + 1,
+        axis=1,
+    )
+    for column, state in [("IHS_age", "IHS"), ("DT_age", "DT"), ("DUT_age", "DUT")]:
+        HS_trace[t >= event[column][:, np.newaxis]] = state
+
+    HS_state_trace_df = pd.DataFrame(
+        HS_trace,
+        columns=["HSYear" + str(x) for x in range(0, n_cycles + 1)],
+        index=events_df.index,
+    )
+    state_trace_df = pd.DataFrame(
+        DNH_trace,
+        columns=["Year" + str(x) for x in range(0, n_cycles + 1)],
+        index=events_df.index,
+    )
+    return HS_state_trace_df, state_trace_df
+
+
+def compute_outcomes_from_events(events_df, new_treatment):
+    # Function:
+    #   Computes the main outcomes of every individual directly from the event
+    #   cycles (same values as compute_outcomes on the dense traces): every
+    #   outcome is a (discounted) count of cycles in an interval of cycles
+    # Args:
+    #   events_df: event log (output from traces_to_events)
+    #   new_treatment: new treatment (True or False)
+    # Returns:
+    #   pandas dataframe with the OUTCOME_COLUMNS (same index as events_df)
+
+    n_cycles = trace_cycles(events_df["starting_age"])
+    event = event_cycles(events_df, n_cycles)
+    death = event["death_age"].astype(int)
+    # sickness ends at death
+    sick = np.minimum(event["sick_age"], death).astype(int)
+    # the detected/treated state lasts from detection to discontinuation
+    treated_start = np.minimum(event["DT_age"], n_cycles + 1).astype(int)
+    treated_end = np.minimum(event["DUT_age"], n_cycles + 1).astype(int)
+    sick_treated_start = np.clip(treated_start, sick, death)
+    sick_treated_end = np.clip(treated_end, sick_treated_start, death)
+
+    # cumulative (discounted) number of cycles before every cycle
+    discounted = np.concatenate([[0], np.cumsum(v_disc)])
+    years_healthy = sick
+    years_sick = death - sick
+    years_sick_treated = sick_treated_end - sick_treated_start
+    discounted_healthy = discounted[sick]
+    discounted_sick = discounted[death] - discounted[sick]
+    discounted_sick_treated = (
+        discounted[sick_treated_end] - discounted[sick_treated_start]
+    )
+
+    COST_DT = COST_DT_NT if new_treatment else COST_DT_SC
+    outcomes = pd.DataFrame(index=events_df.index)
+    outcomes["years_to_death"] = death
+    outcomes["discounted_LY"] = discounted[death]
+    outcomes["QALY"] = QALY_H * years_healthy + QALY_S * years_sick
+    outcomes["discounted_QALY"] = QALY_H * discounted_healthy + QALY_S * discounted_sick
+    outcomes["cost"] = (
+        COST_H * years_healthy + COST_S * years_sick + COST_DT * years_sick_treated
+    )
+    outcomes["discounted_cost"] = (
+        COST_H * discounted_healthy
+        + COST_S * discounted_sick
+        + COST_DT * discounted_sick_treated
+    )
+    outcomes["death_age"] = events_df["starting_age"].to_numpy() + death
+    outcomes["years_sick"] = years_sick
+    outcomes["years_sick_treated"] = years_sick_treated
+    outcomes["years_sick_untreated"] = years_sick - years_sick_treated
+    outcomes["was_sick"] = (years_sick > 0).astype(int)
+    outcomes["was_treated"] = (treated_start <= n_cycles).astype(int)
+    return outcomes[OUTCOME_COLUMNS]
+
+
+def events_to_total_trace(events_df, new_treatment, n_cycles=None):
+    # Function:
+    #   Rebuilds the total trace of a model arm from its event log, with the
+    #   outcomes computed from the event cycles
+    # Args:
+    #   events_df: event log (output from traces_to_events)
+    #   new_treatment: new treatment (True or False)
+    #   n_cycles: number of cycles of the traces (as in events_to_traces)
+    # Returns:
+    #   HS_state_trace_df: health system utilization trace
+    #   state_trace_df: disease natural history trace
+    #   total_trace: cohort columns, both traces and the outcomes (as returned
+    #   by run_cohort_standard and run_cohort_social_framework)
+
+    HS_state_trace_df, state_trace_df = events_to_traces(events_df, n_cycles)
+    population_df = events_df.drop(columns=EVENT_COLUMNS)
+    total_trace = pd.concat(
+        [
+            population_df,
+            state_trace_df,
+            HS_state_trace_df,
+            compute_outcomes_from_events(events_df, new_treatment),
+        ],
+        axis=1,
+    )
+    return HS_state_trace_df, state_trace_df, total_trace
+
+
+def read_event_log(path):
+    # Function:
+    #   Reads an event log csv file
+    # Args:
+    #   path: path to the event log
+    # Returns:
+    #   event log with nullable integer event ages
+    #   (missing ages are events that never happen)
+
+    return pd.read_csv(
+        path,
+        keep_default_na=False,
+        na_values={column: [""] for column in EVENT_AGE_COLUMNS},
+        dtype={column: "Int64" for column in EVENT_AGE_COLUMNS},
+        float_precision="round_trip",
+    )
+
+
+def trace_files(trace_format):
+    # Function:
+    #   Result files of one model arm in a trace format
+    # Args:
+    #   trace_format: "dense" (traces and total trace), "events" (event log) or
+    #   "unique" (unique trajectories, trajectory_functions.py)
+    # Returns:
+    #   list of file names
+    #   (raises ValueError for an unknown trace format)
+
+    if trace_format == "dense":
+        return ["HS_state.csv", "DNH_state.csv", "total_trace.csv"]
+    if trace_format == "events":
+        return [EVENT_FILE]
+    if trace_format == "unique":
+        return [TRAJECTORY_FILE]
+    raise ValueError(
+        f"unknown trace format '{trace_format}' ({', '.join(TRACE_FORMATS)})"
+    )
+
+
+def write_traces(
+    arm_folder,
+    population_df,
+    HS_state_trace_df,
+    state_trace_df,
+    total_trace,
+    trace_format="dense",
+    append=False,
+):
+    # Function:
+    #   Writes the results of one model arm as dense traces (HS_state.csv,
+    #   DNH_state.csv and total_trace.csv), as an event log (events.csv) or as
+    #   unique trajectories (trajectories.csv), replacing the files of the
+    #   other formats
+    # Args:
+    #   arm_folder: folder of the model arm (e.g., results/standard/sc)
+    #   population_df: simulated cohort
+    #   HS_state_trace_df: health system utilization trace
+    #   state_trace_df: disease natural history trace
+    #   total_trace: total trace
+    #   trace_format: "dense", "events" or "unique"
+    #   append: if True, append the rows to the files of an earlier chunk of
+    #   the cohort (unique trajectories repeated across chunks are combined by
+    #   read_trajectories)
+    # Returns:
+    #   None
+
+    trace_files(trace_format)
+    os.makedirs(arm_folder, exist_ok=True)
+    mode = "a" if append else "w"
+    if trace_format == "dense":
+        for df, file_name in [
+            (HS_state_trace_df, "HS_state.csv"),
+            (state_trace_df, "DNH_state.csv"),
+            (total_trace, "total_trace.csv"),
+        ]:
+            df.to_csv(
+                f"{arm_folder}/{file_name}", index=False, mode=mode, header=not append
+            )
+    elif trace_format == "events":
+        traces_to_events(population_df, HS_state_trace_df, state_trace_df).to_csv(
+            f"{arm_folder}/{EVENT_FILE}", index=False, mode=mode, header=not append
+        )
+    else:
+        deduplicate_trajectories(
+            population_df, HS_state_trace_df, state_trace_df
+        ).to_csv(
+            f"{arm_folder}/{TRAJECTORY_FILE}",
+            index=False,
+            mode=mode,
+            header=not append,
+        )
+    if append:
+        return
+    # remove results of an earlier run in another format
+    for other_format in TRACE_FORMATS:
+        if other_format == trace_format:
+            continue
+        for file_name in trace_files(other_format):
+            if os.path.exists(f"{arm_folder}/{file_name}"):
+                os.remove(f"{arm_folder}/{file_name}")
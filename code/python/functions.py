@@ -1,6 +1,7 @@
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
+from sampling_functions import cumulative_distribution, draw_index
 
 
 def transform_lifetables(life_table):
@@ -70,7 +71,252 @@ def convert_to_prob(rate):
     return 1 - np.exp(-rate)
 
 
-def run_DNS_state_graph(trace, plot=False):
+def sample_state(states, transition, antithetic=False):
+    # Function:
+    #   Randomly samples the next state from a transition probability array.
+    #   The antithetic member of a pair of individuals sharing a random seed
+    #   uses 1 - u for every uniform draw u of the other member
+    # Args:
+    #   states: list of states
+    #   transition: transition probability array
+    #   antithetic: whether to use the antithetic draw (True or False)
+    # Returns:
+    #   next state
+
+    # inverse of the cumulative distribution, as in np.random.choice
+    # (definitions in sampling_functions.py)
+    return states[draw_index(cumulative_distribution(transition).tolist(), antithetic)]
+
+
+def individual_horizons(start_ages):
+    # Function:
+    #   Number of cycles every individual is simulated for: until age 101, by
+    #   which everyone has died
+    # Args:
+    #   start_ages: array of the individuals' starting ages
+    # Returns:
+    #   array of horizons in cycles (raises ValueError for starting ages
+    #   outside 0 to 100)
+
+    start_ages = np.asarray(start_ages, dtype=int)
+    if len(start_ages) > 0 and (start_ages.min() < 0 or start_ages.max() > 100):
+        raise ValueError(
+            "starting ages must be between 0 and 100 (found "
+            f"{start_ages.min()} to {start_ages.max()})"
+        )
+    return 101 - start_ages
+
+
+def trace_cycles(start_ages):
+    # Function:
+    #   Number of cycles of the traces of a cohort: the horizon of its youngest
+    #   starting age (individual_horizons), and at least the horizon of
+    #   starting_age (cycles), so cohorts starting at starting_age or older
+    #   all have the same trace columns. Older individuals keep their last
+    #   states after their own horizon (hold_final_states)
+    # Args:
+    #   start_ages: array of the starting ages of the whole cohort, so that
+    #   all its chunks, shards and checkpoints have the same trace columns
+    # Returns:
+    #   number of cycles (the traces have one column per cycle, plus cycle 0)
+
+    return int(max(cycles, individual_horizons(start_ages).max(initial=0)))
+
+
+def trace_columns(trace, prefix="Year"):
+    # Function:
+    #   Trace columns of a dataframe of results, whose number depends on the
+    #   youngest starting age of the cohort (trace_cycles)
+    # Args:
+    #   trace: dataframe with the Year and/or HSYear columns of every cycle
+    #   (e.g., a total trace)
+    #   prefix: "Year" (disease natural history) or "HSYear" (health system
+    #   utilization)
+    # Returns:
+    #   list of the column names of every cycle, in order
+
+    n_columns = sum(
+        str(column).startswith(prefix) and str(column)[len(prefix) :].isdigit()
+        for column in trace.columns
+    )
+    return [prefix + str(x) for x in range(0, n_columns)]
+
+
+def hold_final_states(HS_trace, DNH_trace, horizon):
+    # Function:
+    #   Fills the cycles after an individual's horizon with their last states,
+    #   as simulating them would (the dead stay in their states)
+    # Args:
+    #   HS_trace: array of the individual's health system utilization states,
+    #   filled in place
+    #   DNH_trace: array of the individual's disease natural history states,
+    #   filled in place
+    #   horizon: last simulated cycle (output from individual_horizons)
+    # Returns:
+    #   None
+
+    HS_trace[horizon + 1 :] = HS_trace[horizon]
+    DNH_trace[horizon + 1 :] = DNH_trace[horizon]
+
+
+def age_alignment(start_ages, n_cycles=None):
+    # Function:
+    #   Maps the columns of age-aligned traces (one per age from the youngest
+    #   age the traces cover, 101 - n_cycles) to the cycles of the traces (one
+    #   per year since the starting age)
+    # Args:
+    #   start_ages: array of the individuals' starting ages
+    #   n_cycles: number of cycles of the traces (defaults to trace_cycles of
+    #   start_ages)
+    # Returns:
+    #   cycle: array of the cycle of every individual at every age
+    #   (individuals x n_cycles + 1, 0 before they enter the cohort)
+    #   entered: boolean array of the ages at which every individual has
+    #   entered the cohort (individuals x n_cycles + 1)
+
+    if n_cycles is None:
+        n_cycles = trace_cycles(start_ages)
+    offsets = np.asarray(start_ages, dtype=int) - (101 - n_cycles)
+    cycle = np.arange(n_cycles + 1)[np.newaxis, :] - offsets[:, np.newaxis]
+    entered = cycle >= 0
+    return np.maximum(cycle, 0), entered
+
+
+def age_aligned_trace(trace, start_ages):
+    # Function:
+    #   Aligns a trace on age instead of years since the starting age, so
+    #   individuals with different starting ages can be aggregated by age
+    # Args:
+    #   trace: dataframe with the Year and/or HSYear columns of every cycle
+    #   (e.g., a total trace; other columns are dropped)
+    #   start_ages: array of the individuals' starting ages
+    # Returns:
+    #   dataframe with the same trace columns, whose column for cycle t holds
+    #   the state at age 101 - n_cycles + t, where n_cycles is the number of
+    #   cycles of the traces (missing before the starting age)
+
+    aligned = pd.DataFrame(index=trace.index)
+    for prefix in ["Year", "HSYear"]:
+        columns = trace_columns(trace, prefix)
+        if not columns:
+            continue
+        cycle, entered = age_alignment(start_ages, len(columns) - 1)
+        values = np.take_along_axis(
+            trace[columns].to_numpy(dtype=object), cycle, axis=1
+        )
+        values[~entered] = None
+        aligned[columns] = values
+    return aligned
+
+
+def compute_outcomes(HS_trace, DNH_trace, new_treatment, start_age):
+    # Function:
+    #   Computes the main outcomes of one individual from their traces
+    # Args:
+    #   HS_trace: array of the individual's health system utilization state every year
+    #   DNH_trace: array of the individual's disease natural history state every year
+    #   new_treatment: new treatment (True or False)
+    #   start_age: individual's starting age
+    # Returns:
+    #   tuple of the individual's outcomes, in the order of OUTCOME_COLUMNS
+
+    # discount factors of the cycles of the traces
+    discount = v_disc[: len(DNH_trace)]
+
+    # compute life years
+    DNH_state_trace_LY = np.array([mapping.get(x, x) for x in DNH_trace])
+    # discounted life years
+    LY_disc = np.dot(DNH_state_trace_LY, discount)
+
+    # compute quality-adjusted life years (QALYs)
+    DNH_state_trace_QALY = np.array([QALY_mapping.get(x, x) for x in DNH_trace])
+    QALY_val = sum(DNH_state_trace_QALY)
+    # discounted QALYs
+    QALY_disc = np.dot(DNH_state_trace_QALY, discount)
+
+    # compute costs from health states
+    DNH_state_trace_COST = np.array([COST_mapping.get(x, x) for x in DNH_trace])
+    COST_val = sum(DNH_state_trace_COST)
+    # discounted costs
+    COST_disc = np.dot(DNH_state_trace_COST, discount)
+
+    # compute additional costs from treatment
+    if new_treatment:
+        treatment_rows = np.where((HS_trace == "DT") & (DNH_trace == "S"), COST_DT_NT, 0)
+        this_treatment_COST = sum(treatment_rows)
+        this_treatment_COST_disc = np.dot(treatment_rows, discount)
+    else:
+        treatment_rows = np.where((HS_trace == "DT") & (DNH_trace == "S"), COST_DT_SC, 0)
+        this_treatment_COST = sum(treatment_rows)
+        this_treatment_COST_disc = np.dot(treatment_rows, discount)
+
+    # add treatment costs to costs from health states
+    COST_val = COST_val + this_treatment_COST
+    COST_disc = COST_disc + this_treatment_COST_disc
+
+    # compute death age
+    years_to_death = sum(DNH_state_trace_LY)
+    death_age = start_age + years_to_death
+
+    # number of years spent sick
+    sick_years = np.where(DNH_trace == "S")[0]
+    years_sick = len(sick_years)
+    # number of years on treatment
+    years_treat = np.where(HS_trace == "DT")[0]
+    overlap = [value for value in sick_years if value in years_treat]
+    # number of years sick and on treatment
+    years_sick_treated = len(overlap)
+    # number of years sick without treatment
+    years_sick_untreated = years_sick - years_sick_treated
+    # cumulative incidence of sickness
+    was_sick = 1 if years_sick > 0 else 0
+    # cumulative incidence of detected/treated
+    was_treated = 1 if len(years_treat) > 0 else 0
+
+    return (
+        years_to_death,
+        LY_disc,
+        QALY_val,
+        QALY_disc,
+        COST_val,
+        COST_disc,
+        death_age,
+        years_sick,
+        years_sick_treated,
+        years_sick_untreated,
+        was_sick,
+        was_treated,
+    )
+
+
+def proportion_se(indicator, weights, counts=None):
+    # Function:
+    #   Standard error of a (weighted) proportion. A row standing for several
+    #   individuals (unique trajectories) counts as that many individuals,
+    #   each with their share of the row's weight
+    # Args:
+    #   indicator: array of 0/1 values
+    #   weights: array of sampling weights of the rows (design_weights, which
+    #   includes their counts)
+    #   counts: array of the number of individuals every row stands for
+    #   (trajectory_counts); 1 for every row if None
+    # Returns:
+    #   standard error of the proportion (nan with fewer than two individuals)
+
+    if counts is None:
+        counts = np.ones(len(indicator))
+    n = counts.sum()
+    if n < 2:
+        return np.nan
+    proportion = (weights * indicator).sum() / weights.sum()
+    # sum over the individuals of (w * (indicator - p))^2, with w = weights / counts
+    squares = (weights * (indicator - proportion)) ** 2 / counts
+    return np.sqrt(n / (n - 1) * squares.sum()) / weights.sum()
+
+
+def run_DNS_state_graph(
+    trace, plot=False, weights=None, return_se=False, start_ages=None
+):
     # Function:
     #   Creates arrays with the proportion of individuals who are in each of the disease natural
     #   history states: healthy (H), sick (S), and dead (D)
@@ -78,38 +324,66 @@ def run_DNS_state_graph(trace, plot=False):
     # Args:
     #   trace: disease natural history trace
     #   plot: if True, plots the figure
+    #   weights: sampling weights of the individuals for population proportions
+    #   (defaults to the 'weight' column of an oversampled cohort, if any, as
+    #   run_HS_state_graph)
+    #   return_se: if True, also returns the standard errors of the proportions
+    #   start_ages: starting ages of the individuals; if given, the proportions
+    #   are by age (age_aligned_trace), among the individuals who entered the
+    #   cohort by that age, instead of by year since the starting age
     # Returns:
     #   H_arr: proportion of individuals who are in the healthy state
     #   S_arr: proportion of individuals who are in the sick state
     #   D_arr: proportion of individuals who are in the dead state
+    #   If return_se = True, followed by the standard errors H_se, S_se, D_se
     #   If plot = True, plots H_arr, S_arr, D_arr as a function of age
 
     N = len(trace)
+    if weights is None:
+        weights = design_weights(trace)
+    weights = np.asarray(weights, dtype=float)
+    counts = trajectory_counts(trace)
+    if start_ages is not None:
+        trace = age_aligned_trace(trace, start_ages)
     H_arr = []
     S_arr = []
     D_arr = []
-    for i in trace.columns:
-        H_arr.append(len(np.where(trace[i] == "H")[0]) / N)
-        S_arr.append(len(np.where(trace[i] == "S")[0]) / N)
-        D_arr.append(len(np.where(trace[i] == "D")[0]) / N)
+    H_se = []
+    S_se = []
+    D_se = []
+    for i in trace_columns(trace):
+        # individuals who entered the cohort (everyone, unless aligned on age)
+        entered = trace[i].notna().to_numpy()
+        entered_weights = weights[entered]
+        entered_counts = counts[entered]
+        total_weight = entered_weights.sum() if entered.any() else np.nan
+        states = trace[i].to_numpy()[entered]
+        H_arr.append(float(entered_weights[states == "H"].sum() / total_weight))
+        S_arr.append(float(entered_weights[states == "S"].sum() / total_weight))
+        D_arr.append(float(entered_weights[states == "D"].sum() / total_weight))
+        if return_se:
+            for state, state_se in [("H", H_se), ("S", S_se), ("D", D_se)]:
+                state_se.append(
+                    proportion_se(states == state, entered_weights, entered_counts)
+                )
     if plot == True:
+        # ages of the columns, from the youngest age the traces cover
+        ages = range(101 - len(H_arr) + 1, 101 + 1)
         plt.figure(figsize=(8, 5))
-        plt.plot(
-            range(starting_age + 0, starting_age + cycles + 1), H_arr, label="Healthy"
-        )
-        plt.plot(
-            range(starting_age + 0, starting_age + cycles + 1), S_arr, label="Sick"
-        )
-        plt.plot(
-            range(starting_age + 0, starting_age + cycles + 1), D_arr, label="Dead"
-        )
+        plt.plot(ages, H_arr, label="Healthy")
+        plt.plot(ages, S_arr, label="Sick")
+        plt.plot(ages, D_arr, label="Dead")
         plt.legend()
         plt.ylabel("State proportion")
         plt.xlabel("Age")
+    if return_se:
+        return H_arr, S_arr, D_arr, H_se, S_se, D_se
     return H_arr, S_arr, D_arr
 
 
-def run_HS_state_graph(trace, plot=False):
+def run_HS_state_graph(
+    trace, plot=False, weights=None, return_se=False, start_ages=None
+):
     # Function:
     #   Creates arrays with the proportion of individuals who are in each of the health system
     #   utilization states: out of health system (OHS), in health system (IHS),
@@ -118,62 +392,87 @@ def run_HS_state_graph(trace, plot=False):
     # Args:
     #   trace: health system utilization trace
     #   plot: if True, plots the figure
+    #   weights: sampling weights of the individuals for population proportions
+    #   (defaults to the 'weight' column of an oversampled cohort, if any)
+    #   return_se: if True, also returns the standard errors of the proportions
+    #   start_ages: starting ages of the individuals; if given, the proportions
+    #   are by age (age_aligned_trace) instead of by year since the starting age
     # Returns:
     #   OHS_arr: proportion of individuals who are in the out of health system state
     #   IHS_arr: proportion of individuals who are in the in health system state
     #   DT_arr: proportion of individuals who are in the detected state
     #   DTUT_arr: proportion of individuals who are in the detected and untreated state
+    #   If return_se = True, followed by the standard errors of the four arrays
     #   If plot = True, plots OHS_arr, IHS_arr, DT_arr, and DUT_arr as a function of age
 
     N = len(trace)
+    if weights is None:
+        weights = design_weights(trace)
+    weights = np.asarray(weights, dtype=float)
+    counts = trajectory_counts(trace)
+    if start_ages is not None:
+        trace = age_aligned_trace(trace, start_ages)
     OHS_arr = []
     IHS_arr = []
     DT_arr = []
     DUT_arr = []
-    for i in range(cycles + 1):
-        trace_alive = trace[trace["Year" + str(i)] != "D"]
-        alive_N = len(trace_alive)
+    ses = {"OHS": [], "IHS": [], "DT": [], "DUT": []}
+    for i in range(len(trace_columns(trace))):
+        # alive (and entered the cohort, if aligned on age)
+        DNH_states = trace["Year" + str(i)]
+        alive = (DNH_states.notna() & (DNH_states != "D")).to_numpy()
+        alive_N = alive.sum()
+        alive_weights = weights[alive]
+        alive_weight = alive_weights.sum()
+        HS_alive = trace["HSYear" + str(i)].to_numpy()[alive]
         if alive_N > 0:
             OHS_arr.append(
-                len(np.where(trace_alive["HSYear" + str(i)] == "OHS")[0]) / alive_N
+                float(alive_weights[HS_alive == "OHS"].sum() / alive_weight)
             )
             IHS_arr.append(
-                len(np.where(trace_alive["HSYear" + str(i)] == "IHS")[0]) / alive_N
+                float(alive_weights[HS_alive == "IHS"].sum() / alive_weight)
             )
             DT_arr.append(
-                len(np.where(trace_alive["HSYear" + str(i)] == "DT")[0]) / alive_N
+                float(alive_weights[HS_alive == "DT"].sum() / alive_weight)
             )
             DUT_arr.append(
-                len(np.where(trace_alive["HSYear" + str(i)] == "DUT")[0]) / alive_N
+                float(alive_weights[HS_alive == "DUT"].sum() / alive_weight)
             )
         else:
             OHS_arr.append(0)
             IHS_arr.append(0)
             DT_arr.append(0)
             DUT_arr.append(0)
+        if return_se:
+            for state in ses:
+                ses[state].append(
+                    proportion_se(HS_alive == state, alive_weights, counts[alive])
+                )
 
     if plot == True:
+        # ages of the columns, from the youngest age the traces cover
+        ages = range(101 - len(OHS_arr) + 1, 101 + 1)
         plt.figure(figsize=(8, 5))
         plt.plot(
-            range(starting_age + 0, starting_age + cycles + 1),
+            ages,
             OHS_arr,
             color="red",
             label="Out of Health System",
         )
         plt.plot(
-            range(starting_age + 0, starting_age + cycles + 1),
+            ages,
             IHS_arr,
             color="b",
             label="In Health System",
         )
         plt.plot(
-            range(starting_age + 0, starting_age + cycles + 1),
+            ages,
             DT_arr,
             color="green",
             label="Detected/treated",
         )
         plt.plot(
-            range(starting_age + 0, starting_age + cycles + 1),
+            ages,
             DUT_arr,
             color="orange",
             label="Detected/untreated",
@@ -181,9 +480,165 @@ def run_HS_state_graph(trace, plot=False):
         plt.legend()
         plt.ylabel("State proportion")
         plt.xlabel("Age")
+    if return_se:
+        return (OHS_arr, IHS_arr, DT_arr, DUT_arr) + tuple(ses.values())
     return OHS_arr, IHS_arr, DT_arr, DUT_arr
 
 
+def combine_treatment_arms(total_trace_SC, total_trace_NT):
+    # Function:
+    #   Labels the standard of care and new treatment total traces with their
+    #   treatment type and stacks them into the input of create_treatment_effect
+    # Args:
+    #   total_trace_SC: total trace under the standard of care
+    #   total_trace_NT: total trace under the new treatment
+    # Returns:
+    #   combined total trace with a 'treatment_type' column
+
+    total_trace_SC = total_trace_SC.copy()
+    total_trace_NT = total_trace_NT.copy()
+    total_trace_SC["treatment_type"] = "Standard of Care"
+    total_trace_NT["treatment_type"] = "New Treatment"
+    return pd.concat([total_trace_SC, total_trace_NT], axis=0)
+
+
+def trajectory_counts(group):
+    # Function:
+    #   Number of individuals every row stands for in a deduplicated trace
+    #   ('count' column, trajectory_functions.py); 1 for everyone otherwise
+    # Args:
+    #   group: rows of the total trace
+    # Returns:
+    #   array of counts
+
+    if "count" in group.columns:
+        return group["count"].to_numpy(dtype=float)
+    return np.ones(len(group))
+
+
+def design_weights(group):
+    # Function:
+    #   Sampling weights of the individuals of an oversampled cohort
+    #   ('weight' column, develop_cohort), 1 for everyone otherwise, times the
+    #   number of individuals every row stands for (trajectory_counts)
+    # Args:
+    #   group: rows of the total trace
+    # Returns:
+    #   array of sampling weights
+
+    if "weight" in group.columns:
+        return group["weight"].to_numpy(dtype=float) * trajectory_counts(group)
+    return trajectory_counts(group)
+
+
+def design_mean(values, group):
+    # Function:
+    #   Population mean estimate of values, weighted by the sampling weights
+    # Args:
+    #   values: pandas series of values of the individuals in the group
+    #   group: rows of the total trace of the same individuals
+    # Returns:
+    #   (weighted) mean of values
+
+    if len(values) == 0:
+        return np.nan
+    weights = design_weights(group.loc[values.index])
+    return (weights * values.to_numpy(dtype=float)).sum() / weights.sum()
+
+
+def design_se(values, group):
+    # Function:
+    #   Standard error of a mean under the sampling design of the cohort:
+    #   strata ('stratum' column), antithetic pairs ('antithetic_pair' column),
+    #   which are not independent, and sampling weights ('weight' column) of
+    #   oversampled strata. Uses the linearized variance of a weighted ratio
+    #   mean over pairs within strata, so pairs with only one member in the
+    #   group (e.g., sick) are handled. Rows of a deduplicated trace count as
+    #   many individuals as their 'count'
+    # Args:
+    #   values: pandas series of values of the individuals in the group
+    #   group: rows of the total trace of the same individuals
+    # Returns:
+    #   standard error of the (weighted) mean of values
+
+    values = values.astype(float)
+    group = group.loc[values.index]
+    counts = trajectory_counts(group)
+    n = counts.sum()
+    if n < 2:
+        return np.nan
+    weights = design_weights(group)
+    if "stratum" in group.columns:
+        strata = group["stratum"].to_numpy()
+    else:
+        strata = np.full(len(group), "all", dtype=object)
+    # weighted residual of every individual around the mean
+    e = weights / counts * (values.to_numpy() - design_mean(values, group))
+    if "antithetic_pair" in group.columns:
+        # residual of every pair, with the pair as the unit
+        residuals = (
+            pd.DataFrame(
+                {
+                    "e": counts * e,
+                    "unit": group["antithetic_pair"].to_numpy(),
+                    "stratum": strata,
+                }
+            )
+            .groupby("unit")
+            .agg(e=("e", "sum"), stratum=("stratum", "first"))
+        )
+        residuals["count"] = 1.0
+    else:
+        # every row stands for 'count' individuals with the same residual
+        residuals = pd.DataFrame({"e": e, "count": counts, "stratum": strata})
+    # strata with a single pair are pooled to estimate their variance
+    unit_counts = residuals.groupby("stratum")["count"].transform("sum")
+    residuals.loc[unit_counts < 2, "stratum"] = "pooled"
+    variance = 0.0
+    for _, stratum in residuals.groupby("stratum"):
+        n_h = stratum["count"].sum()
+        if n_h > 1:
+            e_h = (stratum["count"] * stratum["e"]).sum() / n_h
+            variance += (
+                n_h / (n_h - 1) * (stratum["count"] * (stratum["e"] - e_h) ** 2).sum()
+            )
+    return np.sqrt(variance) / weights.sum()
+
+
+def control_variate_values(values, controls, expected, counts=None):
+    # Function:
+    #   Adjusts values with control variates of known expected value:
+    #   values - (controls - expected) * beta, where beta is the least-squares
+    #   coefficient of the values on the controls. The mean of the adjusted
+    #   values is the control-variate estimate of the mean
+    # Args:
+    #   values: pandas series of values
+    #   controls: pandas dataframe of control variates of the same individuals
+    #   expected: pandas dataframe of the expected values of the controls
+    #   counts: number of individuals every value stands for (trajectory_counts),
+    #   1 for everyone if None
+    # Returns:
+    #   pandas series of adjusted values (same index as values)
+
+    y = values.to_numpy(dtype=float)
+    X = controls.loc[values.index].to_numpy(dtype=float)
+    M = expected.loc[values.index].to_numpy(dtype=float)
+    if counts is None:
+        counts = np.ones(len(y))
+    if counts.sum() < 2:
+        return values.astype(float)
+    # least squares with every row repeated 'count' times
+    root_counts = np.sqrt(counts)
+    X_centered = X - (counts[:, np.newaxis] * X).sum(axis=0) / counts.sum()
+    y_centered = y - (counts * y).sum() / counts.sum()
+    beta = np.linalg.lstsq(
+        X_centered * root_counts[:, np.newaxis],
+        y_centered * root_counts,
+        rcond=None,
+    )[0]
+    return pd.Series(y - (X - M) @ beta, index=values.index)
+
+
 def create_treatment_effect(trace):
     # Function:
     #   Creates dataframe with main outcomes by race and treatment (either the standard of care
@@ -192,7 +647,10 @@ def create_treatment_effect(trace):
     #   care and the new treatment
     # Args:
     #   trace: total trace (output from run_cohort_standard or run_cohort_social_framework)
-    #   which has both disease natural history and health system utilization traces
+    #   which has both disease natural history and health system utilization traces.
+    #   Stratified, antithetic or oversampled cohorts (develop_cohort) get weighted
+    #   means and design-based standard errors, and traces with control variates
+    #   (add_control_variates in markov_functions.py) get control-variate estimates
     # Returns:
     #   treatment_effect_df: a pandas dataframe on the treatment effect of the new treatment
     #   across main outcomes: life expectancy, QALYs, costs, years sick, years sick on treatment,
@@ -200,6 +658,17 @@ def create_treatment_effect(trace):
 
     total_arr = []
     race_groups = ["NHB", "NHW"]
+    # individuals of stratified, antithetic or oversampled cohorts are not
+    # independent, equally likely draws, and rows of deduplicated traces
+    # (trajectory_functions.py) stand for several individuals
+    design = any(
+        x in trace.columns for x in ["stratum", "antithetic_pair", "weight", "count"]
+    )
+    # control variates with exactly known expected values (markov_functions.py)
+    control_variates = [
+        x[len("control_") :] for x in trace.columns if x.startswith("control_")
+    ]
+    sick_only_columns = ["years_sick_treated", "years_sick_untreated", "years_sick"]
     cols_of_interest = [
         "years_to_death",
         "discounted_LY",
@@ -253,12 +722,91 @@ def create_treatment_effect(trace):
                 sc_group[c] = sc_group[c] #* 100
                 nt_group[c] = nt_group[c] #* 100
 
-            arr.append(sc_group[c].mean())
-            arr.append(sc_group[c].std() / np.sqrt(len(sc_group)))
-            arr.append(nt_group[c].mean())
-            arr.append(nt_group[c].std() / np.sqrt(len(nt_group)))
-            arr.append((nt_group[c] - sc_group[c]).mean())
-            arr.append((nt_group[c] - sc_group[c]).std() / np.sqrt(len(sc_group)))
+            if control_variates:
+                # control-variate estimator (add_control_variates in
+                # markov_functions.py), with design-based standard errors
+                if_sick = "_if_sick" if c in sick_only_columns else ""
+                controls = [f"control_{x}" for x in control_variates]
+                expected = [f"expected_{x}{if_sick}" for x in control_variates]
+                sc_adjusted = control_variate_values(
+                    sc_group[c],
+                    sc_group[controls],
+                    sc_group[expected],
+                    trajectory_counts(sc_group),
+                )
+                nt_adjusted = control_variate_values(
+                    nt_group[c],
+                    nt_group[controls],
+                    nt_group[expected],
+                    trajectory_counts(nt_group),
+                )
+                arr.append(design_mean(sc_adjusted, sc_group))
+                arr.append(design_se(sc_adjusted, sc_group))
+                arr.append(design_mean(nt_adjusted, nt_group))
+                arr.append(design_se(nt_adjusted, nt_group))
+                if c in sick_only_columns:
+                    # those sick under each treatment differ, so the difference
+                    # of the adjusted means gets a linearized standard error
+                    # over everyone in the race group (pairing both treatments)
+                    race_group = trace[
+                        (trace["treatment_type"] == "Standard of Care")
+                        & (trace["race"] == r)
+                    ]
+                    total_weight = design_weights(race_group).sum()
+                    influence = pd.Series(0.0, index=race_group.index)
+                    nt_mean = arr[4]
+                    sc_mean = arr[2]
+                    influence.loc[nt_adjusted.index] += (
+                        total_weight
+                        / design_weights(nt_group).sum()
+                        * (nt_adjusted - nt_mean)
+                    )
+                    influence.loc[sc_adjusted.index] -= (
+                        total_weight
+                        / design_weights(sc_group).sum()
+                        * (sc_adjusted - sc_mean)
+                    )
+                    arr.append(nt_mean - sc_mean)
+                    arr.append(design_se(influence, race_group))
+                else:
+                    diff_adjusted = control_variate_values(
+                        nt_group[c] - sc_group[c],
+                        pd.concat(
+                            [
+                                nt_group[controls].add_prefix("NT "),
+                                sc_group[controls].add_prefix("SC "),
+                            ],
+                            axis=1,
+                        ),
+                        pd.concat(
+                            [
+                                nt_group[expected].add_prefix("NT "),
+                                sc_group[expected].add_prefix("SC "),
+                            ],
+                            axis=1,
+                        ),
+                        trajectory_counts(sc_group),
+                    )
+                    arr.append(design_mean(diff_adjusted, sc_group))
+                    arr.append(design_se(diff_adjusted, sc_group))
+            elif design:
+                # stratified, antithetic and/or oversampled cohorts (develop_cohort)
+                diff = (nt_group[c] - sc_group[c]).dropna()
+                arr.append(design_mean(sc_group[c], sc_group))
+                arr.append(design_se(sc_group[c], sc_group))
+                arr.append(design_mean(nt_group[c], nt_group))
+                arr.append(design_se(nt_group[c], nt_group))
+                arr.append(design_mean(diff, sc_group))
+                arr.append(design_se(diff, sc_group))
+            else:
+                arr.append(sc_group[c].mean())
+                arr.append(sc_group[c].std() / np.sqrt(len(sc_group)))
+                arr.append(nt_group[c].mean())
+                arr.append(nt_group[c].std() / np.sqrt(len(nt_group)))
+                arr.append((nt_group[c] - sc_group[c]).mean())
+                arr.append(
+                    (nt_group[c] - sc_group[c]).std() / np.sqrt(len(sc_group))
+                )
             total_arr.append(arr)
     treatment_effect_df = pd.DataFrame(
         total_arr,
@@ -413,10 +961,33 @@ def format_currency(value, threshold = 100, digits=-2):
 
 
 ## PARAMETERS USED IN ANALYSES
-# cohort stage age
+# version of the simulation engine, recorded in shard manifests so that
+# results from different versions of the model code are never combined
+ENGINE_VERSION = "reference-1"
+
+# outcomes computed for every individual (compute_outcomes), in the order
+# of the columns added to the total trace
+OUTCOME_COLUMNS = [
+    "years_to_death",
+    "discounted_LY",
+    "QALY",
+    "discounted_QALY",
+    "cost",
+    "discounted_cost",
+    "death_age",
+    "years_sick",
+    "years_sick_treated",
+    "years_sick_untreated",
+    "was_sick",
+    "was_treated",
+]
+
+# cohort stage age: the starting age of develop_cohort.py (without --ages)
 starting_age = 40
 # we modeled yearly cycles up until age 101
 # all individuals died at 100
+# (traces of cohorts with younger individuals have more cycles and older
+# individuals reach age 101 in fewer cycles, see trace_cycles)
 cycles = 101 - starting_age
 
 # Hazard ratio for increased mortality risk among those uninsured
@@ -469,7 +1040,9 @@ treatment_HR_NT = 0.25
 
 # Discontinuation rates
 disc_rate = 0.03
-v_disc = 1 / (1 + disc_rate) ** np.arange(0, cycles + 1)
+# discount factors of every cycle, up to the horizon of a starting age of 0
+# (traces use the first trace_cycles + 1 of them)
+v_disc = 1 / (1 + disc_rate) ** np.arange(0, 101 + 1)
 
 # Life year (LY) mapping
 #   Healthy: 1
@@ -0,0 +1,283 @@
+import numpy as np
+import pandas as pd
+from functions import *
+from model_functions_standard import (
+    generate_transitions_HS_standard,
+    generate_transitions_DNH_standard,
+)
+from model_functions_social_framework import (
+    generate_transitions_HS_social_framework,
+    generate_transitions_DNH_social_framework,
+)
+
+HS_STATES = ["OHS", "IHS", "DT", "DUT"]
+DNH_STATES = ["H", "S", "D"]
+# joint (health system, disease natural history) states of one cycle
+JOINT_STATES = [(h, d) for h in HS_STATES for d in DNH_STATES]
+JOINT_HS = np.array([h for h, d in JOINT_STATES])
+JOINT_DNH = np.array([d for h, d in JOINT_STATES])
+
+# years spent in each state, used as control variates (their expected values
+# are known exactly from the Markov model)
+CONTROL_COLUMNS = [
+    "years_healthy",
+    "years_sick",
+    "years_OHS",
+    "years_DT",
+    "years_DUT",
+]
+# characteristics that determine the transition probabilities of each model
+MODEL_CHARACTERISTICS = {
+    "standard": ["race", "sex", "starting_age"],
+    "framework": ["race", "sex", "insurance", "place", "starting_age"],
+}
+
+# expected values already computed, by model, treatment and characteristics
+markov_cache = dict()
+
+
+def markov_transition_kernels(model, new_treatment, characteristics):
+    # Function:
+    #   Builds the transition matrix of the joint (health system, disease
+    #   natural history) state at every cycle from the transition functions
+    #   of the model. Both states are sampled from the current joint state
+    #   in the simulation loop, so the joint transition is their product
+    # Args:
+    #   model: "standard" or "framework"
+    #   new_treatment: new treatment (True or False)
+    #   characteristics: dictionary of the characteristics in
+    #   MODEL_CHARACTERISTICS[model]
+    # Returns:
+    #   array of transition matrices (n_cycles x joint states x joint states),
+    #   over the trace_cycles of the starting age (definition in functions.py)
+
+    n_cycles = trace_cycles([characteristics["starting_age"]])
+    kernels = np.zeros((n_cycles, len(JOINT_STATES), len(JOINT_STATES)))
+    for t in range(n_cycles):
+        age = characteristics["starting_age"] + t
+        for i, (h, d) in enumerate(JOINT_STATES):
+            if model == "standard":
+                HS_transition = generate_transitions_HS_standard(h, d)
+                DNH_transition = generate_transitions_DNH_standard(
+                    h,
+                    d,
+                    age,
+                    characteristics["sex"],
+                    characteristics["race"],
+                    new_treatment,
+                )
+            else:
+                HS_transition = generate_transitions_HS_social_framework(
+                    h, d, characteristics["insurance"]
+                )
+                DNH_transition = generate_transitions_DNH_social_framework(
+                    h,
+                    d,
+                    age,
+                    characteristics["sex"],
+                    characteristics["race"],
+                    characteristics["insurance"],
+                    new_treatment,
+                )
+            kernels[t, i] = np.outer(HS_transition, DNH_transition).ravel()
+    return kernels
+
+
+def state_rewards(new_treatment, n_cycles=cycles):
+    # Function:
+    #   Per-cycle value of every outcome and control variate in every joint state
+    #   (as computed by compute_outcomes)
+    # Args:
+    #   new_treatment: new treatment (True or False)
+    #   n_cycles: number of cycles
+    # Returns:
+    #   dictionary mapping each column to an array of per-cycle values
+    #   (n_cycles + 1 x joint states)
+
+    COST_DT = COST_DT_NT if new_treatment else COST_DT_SC
+    alive = (JOINT_DNH != "D").astype(float)
+    sick = (JOINT_DNH == "S").astype(float)
+    treated = (JOINT_HS == "DT").astype(float)
+    QALY = np.array([QALY_mapping[d] for d in JOINT_DNH], dtype=float)
+    COST = np.array([COST_mapping[d] for d in JOINT_DNH], dtype=float)
+    COST = COST + COST_DT * sick * treated
+    undiscounted = np.ones(n_cycles + 1)
+    discounted = v_disc[: n_cycles + 1]
+
+    rewards = dict()
+    for column, value, discount in [
+        ("years_to_death", alive, undiscounted),
+        ("discounted_LY", alive, discounted),
+        ("QALY", QALY, undiscounted),
+        ("discounted_QALY", QALY, discounted),
+        ("cost", COST, undiscounted),
+        ("discounted_cost", COST, discounted),
+        ("years_sick", sick, undiscounted),
+        ("years_sick_treated", sick * treated, undiscounted),
+        ("years_sick_untreated", sick * (1 - treated), undiscounted),
+        ("years_healthy", (JOINT_DNH == "H").astype(float), undiscounted),
+        ("years_OHS", alive * (JOINT_HS == "OHS"), undiscounted),
+        ("years_DT", alive * treated, undiscounted),
+        ("years_DUT", alive * (JOINT_HS == "DUT"), undiscounted),
+    ]:
+        rewards[column] = np.outer(discount, value)
+    return rewards
+
+
+def run_markov_model(model, new_treatment, characteristics, use_cache=True):
+    # Function:
+    #   Computes the exact expected state occupancy and outcomes of individuals
+    #   with the given characteristics. The joint state is augmented with
+    #   whether the individual was ever sick and ever detected/treated, so the
+    #   cumulative incidences and the outcomes among those who were sick
+    #   (as reported by create_treatment_effect) are exact as well
+    # Args:
+    #   model: "standard" or "framework"
+    #   new_treatment: new treatment (True or False)
+    #   characteristics: dictionary of the characteristics in
+    #   MODEL_CHARACTERISTICS[model]
+    #   use_cache: if False, neither reads nor fills markov_cache (e.g., while
+    #   model parameters are changed by calibration_functions.py)
+    # Returns:
+    #   dictionary with the expected occupancy of every disease natural history
+    #   and health system state at every cycle ("DNH_occupancy", "HS_occupancy"),
+    #   the expected outcomes and control variates ("expected") and their
+    #   expected values among those who were sick ("expected_if_sick")
+
+    key = (model, bool(new_treatment)) + tuple(
+        characteristics[c] for c in MODEL_CHARACTERISTICS[model]
+    )
+    if use_cache and key in markov_cache:
+        return markov_cache[key]
+
+    kernels = markov_transition_kernels(model, new_treatment, characteristics)
+    n_cycles = len(kernels)
+    n_states = len(JOINT_STATES)
+    # flags of the state entered by each joint state
+    enters_sick = (JOINT_DNH == "S").astype(int)
+    enters_treated = (JOINT_HS == "DT").astype(int)
+    targets = np.arange(n_states)
+
+    # forward pass: probability of every (joint state, ever sick, ever treated)
+    if model == "standard":
+        # everyone starts healthy in the health system
+        initial_HS = "IHS"
+    else:
+        initial_HS = characteristics["place"]
+    occupancy = np.zeros((n_cycles + 1, n_states, 2, 2))
+    occupancy[0, JOINT_STATES.index((initial_HS, "H")), 0, 0] = 1
+    for t in range(n_cycles):
+        for s in range(2):
+            for d in range(2):
+                flow = occupancy[t, :, s, d] @ kernels[t]
+                np.add.at(
+                    occupancy[t + 1],
+                    (targets, s | enters_sick, d | enters_treated),
+                    flow,
+                )
+
+    # backward pass: probability of being sick by the end of the simulation
+    sick_by_end = np.zeros((n_cycles + 1, n_states, 2, 2))
+    sick_by_end[n_cycles, :, 1, :] = 1
+    for t in range(n_cycles - 1, -1, -1):
+        for s in range(2):
+            for d in range(2):
+                sick_by_end[t, :, s, d] = (
+                    kernels[t]
+                    @ sick_by_end[t + 1, targets, s | enters_sick, d | enters_treated]
+                )
+
+    state_occupancy = occupancy.sum(axis=(2, 3))
+    state_occupancy_if_sick = (occupancy * sick_by_end).sum(axis=(2, 3))
+    p_sick = occupancy[n_cycles, :, 1, :].sum()
+
+    expected = dict()
+    expected_if_sick = dict()
+    for column, rewards in state_rewards(new_treatment, n_cycles).items():
+        expected[column] = (state_occupancy * rewards).sum()
+        expected_if_sick[column] = (
+            (state_occupancy_if_sick * rewards).sum() / p_sick if p_sick > 0 else np.nan
+        )
+    expected["death_age"] = characteristics["starting_age"] + expected["years_to_death"]
+    expected["was_sick"] = p_sick
+    expected["was_treated"] = occupancy[n_cycles, :, :, 1].sum()
+    expected_if_sick["was_sick"] = 1.0
+    expected_if_sick["was_treated"] = (
+        occupancy[n_cycles, :, 1, 1].sum() / p_sick if p_sick > 0 else np.nan
+    )
+
+    result = {
+        "DNH_occupancy": np.stack(
+            [state_occupancy[:, JOINT_DNH == d].sum(axis=1) for d in DNH_STATES],
+            axis=1,
+        ),
+        "HS_occupancy": np.stack(
+            [state_occupancy[:, JOINT_HS == h].sum(axis=1) for h in HS_STATES],
+            axis=1,
+        ),
+        "expected": expected,
+        "expected_if_sick": expected_if_sick,
+    }
+    if use_cache:
+        markov_cache[key] = result
+    return result
+
+
+def control_values(total_trace):
+    # Function:
+    #   Computes the control variates (years in each state) of every
+    #   individual from their traces
+    # Args:
+    #   total_trace: total trace of one model arm
+    # Returns:
+    #   pandas dataframe with the CONTROL_COLUMNS (same index as total_trace)
+
+    DNH_trace = total_trace[trace_columns(total_trace)].to_numpy()
+    HS_trace = total_trace[trace_columns(total_trace, "HSYear")].to_numpy()
+    alive = DNH_trace != "D"
+    return pd.DataFrame(
+        {
+            "years_healthy": (DNH_trace == "H").sum(axis=1),
+            "years_sick": (DNH_trace == "S").sum(axis=1),
+            "years_OHS": (alive & (HS_trace == "OHS")).sum(axis=1),
+            "years_DT": (alive & (HS_trace == "DT")).sum(axis=1),
+            "years_DUT": (alive & (HS_trace == "DUT")).sum(axis=1),
+        },
+        index=total_trace.index,
+    )
+
+
+def add_control_variates(total_trace, model, new_treatment):
+    # Function:
+    #   Adds the control variates of every individual and their exact expected
+    #   values (overall and among those who were sick) given the individual's
+    #   characteristics. create_treatment_effect uses these columns for a
+    #   control-variate estimator of the treatment effect
+    # Args:
+    #   total_trace: total trace of one model arm
+    #   model: "standard" or "framework"
+    #   new_treatment: new treatment (True or False) of the model arm
+    # Returns:
+    #   copy of total_trace with 'control_<x>', 'expected_<x>' and
+    #   'expected_<x>_if_sick' columns for every x in CONTROL_COLUMNS
+
+    if model not in MODEL_CHARACTERISTICS:
+        raise ValueError(f"unknown model '{model}' (expected standard or framework)")
+    total_trace = total_trace.copy()
+    controls = control_values(total_trace)
+    characteristics = MODEL_CHARACTERISTICS[model]
+    expected = {c: np.zeros(len(total_trace)) for c in CONTROL_COLUMNS}
+    expected_if_sick = {c: np.zeros(len(total_trace)) for c in CONTROL_COLUMNS}
+    groups = total_trace.reset_index(drop=True).groupby(characteristics).indices
+    for values, rows in groups.items():
+        result = run_markov_model(
+            model, new_treatment, dict(zip(characteristics, values))
+        )
+        for c in CONTROL_COLUMNS:
+            expected[c][rows] = result["expected"][c]
+            expected_if_sick[c][rows] = result["expected_if_sick"][c]
+    for c in CONTROL_COLUMNS:
+        total_trace[f"control_{c}"] = controls[c]
+        total_trace[f"expected_{c}"] = expected[c]
+        total_trace[f"expected_{c}_if_sick"] = expected_if_sick[c]
+    return total_trace
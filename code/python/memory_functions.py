@@ -0,0 +1,326 @@
+import json
+import os
+import resource
+import sys
+from functions import *
+from orchestration_functions import *
+from event_functions import *
+from summary_functions import *
+
+# individuals of the first chunk of a memory-bounded run; later chunks are
+# sized from the memory the earlier ones needed
+MEMORY_PILOT_SIZE = 100
+# share of the memory budget left free for allocator fragmentation and for
+# reading the results back (e.g., stream_treatment_effect)
+MEMORY_HEADROOM = 0.1
+# chunk sizes of an interrupted run, reused when it resumes from its checkpoints
+MEMORY_PLAN_FILE = "memory_plan.json"
+# peak memory report of a memory-bounded run, written next to its results
+MEMORY_REPORT_FILE = "memory.json"
+
+
+def peak_memory_mb():
+    # Function:
+    #   Peak resident memory of this process
+    # Args:
+    #   None
+    # Returns:
+    #   peak resident memory in MB
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def resident_memory_mb():
+    # Function:
+    #   Current resident memory of this process (its peak where /proc is not
+    #   available, which overestimates the memory needed per individual)
+    # Args:
+    #   None
+    # Returns:
+    #   resident memory in MB
+
+    try:
+        with open("/proc/self/statm", "r") as f:
+            pages = int(f.read().split()[1])
+    except OSError:
+        return peak_memory_mb()
+    return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def memory_chunk_size(max_memory_mb, baseline_mb, used_mb, largest_chunk, chunk_size):
+    # Function:
+    #   Size of the next chunk of a memory-bounded run. Every individual is
+    #   assumed to need the memory used so far per individual of the largest
+    #   chunk (an upper bound, since it also holds the fixed costs of a chunk),
+    #   and chunks at most double so the estimate is never extrapolated far
+    # Args:
+    #   max_memory_mb: memory budget of the run in MB (MEMORY_HEADROOM of it is
+    #   left free)
+    #   baseline_mb: resident memory before simulating (interpreter, life
+    #   tables and cohort) in MB
+    #   used_mb: growth of the peak resident memory since the run started in MB
+    #   largest_chunk: number of individuals of the largest chunk so far
+    #   chunk_size: number of individuals of the last chunk
+    # Returns:
+    #   chunk size (raises ValueError if the budget cannot fit one individual)
+
+    if used_mb <= 0:
+        # the chunks so far fit in memory freed earlier
+        return 2 * chunk_size
+    individual_mb = used_mb / largest_chunk
+    available_mb = (1 - MEMORY_HEADROOM) * max_memory_mb - baseline_mb
+    next_chunk_size = min(int(available_mb // individual_mb), 2 * chunk_size)
+    if next_chunk_size < 1:
+        raise ValueError(
+            f"a memory budget of {max_memory_mb:g} MB is too small: the run uses "
+            f"{baseline_mb:.0f} MB before simulating and {individual_mb * 1024:.0f} "
+            "KB per individual"
+        )
+    return next_chunk_size
+
+
+def read_memory_plan(checkpoints_folder, max_memory_mb, cohort_hash):
+    # Function:
+    #   Reads the chunk sizes of an interrupted memory-bounded run, so a resumed
+    #   run finds the checkpoints of the same chunks
+    # Args:
+    #   checkpoints_folder: folder with the checkpoints of the run
+    #   max_memory_mb: memory budget of the resumed run in MB
+    #   cohort_hash: hash of the cohort file (hash_file in shard_functions.py)
+    # Returns:
+    #   list of chunk sizes (empty if the run has none or they were chosen for
+    #   another budget or cohort)
+
+    plan_path = f"{checkpoints_folder}/{MEMORY_PLAN_FILE}"
+    if not os.path.exists(plan_path):
+        return []
+    with open(plan_path, "r") as f:
+        plan = json.load(f)
+    if plan["max_memory_mb"] != max_memory_mb or plan["cohort_hash"] != cohort_hash:
+        return []
+    return plan["chunk_sizes"]
+
+
+def write_memory_plan(checkpoints_folder, max_memory_mb, cohort_hash, chunk_sizes):
+    # Function:
+    #   Writes the chunk sizes of a memory-bounded run next to its checkpoints
+    # Args:
+    #   checkpoints_folder: folder with the checkpoints of the run
+    #   max_memory_mb: memory budget of the run in MB
+    #   cohort_hash: hash of the cohort file (hash_file in shard_functions.py)
+    #   chunk_sizes: list of the sizes of the chunks started so far
+    # Returns:
+    #   None
+
+    os.makedirs(checkpoints_folder, exist_ok=True)
+    plan = {
+        "max_memory_mb": max_memory_mb,
+        "cohort_hash": cohort_hash,
+        "chunk_sizes": chunk_sizes,
+    }
+    temporary_path = f"{checkpoints_folder}/{MEMORY_PLAN_FILE}.tmp"
+    with open(temporary_path, "w") as f:
+        json.dump(plan, f, indent=2)
+    os.replace(temporary_path, f"{checkpoints_folder}/{MEMORY_PLAN_FILE}")
+
+
+def run_memory_chunk(
+    engine,
+    population_df,
+    results_folder,
+    trace_format,
+    append,
+    checkpoints_folder,
+    checkpoint_size,
+    cohort_hash,
+    resume,
+    profilers,
+    n_cycles,
+):
+    # Function:
+    #   Runs the four model arms (ARM_RUNS) on one chunk of the cohort and
+    #   appends their results to the files of every model arm
+    # Args:
+    #   engine: name of the simulation engine (a key of ENGINES)
+    #   population_df: cohort chunk
+    #   results_folder: folder to write the results to (e.g., results/)
+    #   trace_format: "dense", "events" or "unique"
+    #   append: if True, append to the files of the earlier chunks
+    #   checkpoints_folder: folder with one checkpoint subfolder per model arm
+    #   checkpoint_size: number of individuals per checkpointed chunk
+    #   cohort_hash: hash of the cohort file (hash_file in shard_functions.py)
+    #   resume: if True, skip the checkpointed chunks of a previous run
+    #   profilers: optional dictionary of profilers by "model/arm"
+    #   n_cycles: number of cycles of the traces of the whole cohort
+    # Returns:
+    #   aggregate results of the chunk (output from create_summary)
+
+    arms = run_all_arms(
+        engine,
+        population_df,
+        checkpoints_folder,
+        checkpoint_size,
+        cohort_hash,
+        resume,
+        profilers,
+        1,
+        n_cycles,
+    )
+    for arm, (HS_state_trace_df, state_trace_df, total_trace) in arms.items():
+        write_traces(
+            f"{results_folder}/{arm}",
+            population_df,
+            HS_state_trace_df,
+            state_trace_df,
+            total_trace,
+            trace_format,
+            append,
+        )
+    return create_summary(population_df, arms)
+
+
+def run_cohort_within_memory(
+    engine,
+    population_df,
+    max_memory_mb,
+    results_folder,
+    trace_format="dense",
+    append=False,
+    checkpoints_folder=None,
+    checkpoint_size=0,
+    cohort_hash=None,
+    resume=False,
+    profilers=None,
+    n_cycles=None,
+):
+    # Function:
+    #   Runs the four model arms on a cohort chunk by chunk, writing the results
+    #   of every chunk before simulating the next, so memory stays under a
+    #   budget instead of growing with the cohort size. The first chunk has
+    #   MEMORY_PILOT_SIZE individuals, and the growth of the peak resident
+    #   memory after every chunk measures the memory needed per individual for
+    #   the engine and trace format, from which the next chunk is sized
+    #   (memory_chunk_size). The model arms run one after the other in this
+    #   process, since worker processes would hold copies of every chunk that
+    #   the budget does not see. Every individual has their own random seed, so
+    #   the results do not depend on the chunks
+    # Args:
+    #   engine: name of the simulation engine (a key of ENGINES)
+    #   population_df: cohort to simulate
+    #   max_memory_mb: memory budget of the run in MB
+    #   results_folder: folder to write the results to (e.g., results/)
+    #   trace_format: "dense" or "events" (unique trajectories are combined
+    #   across chunks by reading them whole, which the budget cannot bound)
+    #   append: if True, the first chunk is appended to the files of an earlier
+    #   run (run_model.py --append)
+    #   checkpoints_folder: folder with one checkpoint subfolder per chunk
+    #   checkpoint_size: number of individuals per checkpointed chunk
+    #   (0 disables checkpoints)
+    #   cohort_hash: hash of the cohort file (hash_file in shard_functions.py)
+    #   resume: if True, reuse the chunk sizes and checkpoints of an
+    #   interrupted run
+    #   profilers: optional dictionary of profilers by "model/arm"
+    #   n_cycles: number of cycles of the traces (trace_cycles in functions.py,
+    #   of the whole cohort when appending to it); defaults to trace_cycles of
+    #   population_df
+    # Returns:
+    #   summary: aggregate results of the cohort (output from create_summary)
+    #   report: dictionary with the memory budget, the chunking and the peak
+    #   resident memory of the run
+    #   (raises ValueError if the budget is too small or the trace format is
+    #   "unique")
+
+    if trace_format == "unique":
+        raise ValueError(
+            "a memory budget cannot be used with unique trajectories: their ids "
+            "grow with the cohort and are combined across chunks in memory"
+        )
+    baseline_mb = resident_memory_mb()
+    if (1 - MEMORY_HEADROOM) * max_memory_mb <= baseline_mb:
+        raise ValueError(
+            f"a memory budget of {max_memory_mb:g} MB is too small: the run uses "
+            f"{baseline_mb:.0f} MB before simulating"
+        )
+    checkpointed = checkpoints_folder is not None and checkpoint_size > 0
+    chunk_sizes = []
+    if resume and checkpointed:
+        chunk_sizes = read_memory_plan(checkpoints_folder, max_memory_mb, cohort_hash)
+
+    N = len(population_df)
+    if N == 0:
+        raise ValueError("the cohort is empty")
+    if n_cycles is None:
+        n_cycles = trace_cycles(population_df["starting_age"])
+    summary = None
+    start = 0
+    chunk_index = 0
+    while start < N:
+        if chunk_index == len(chunk_sizes):
+            if chunk_index == 0:
+                chunk_sizes.append(MEMORY_PILOT_SIZE)
+            else:
+                chunk_sizes.append(
+                    memory_chunk_size(
+                        max_memory_mb,
+                        baseline_mb,
+                        peak_memory_mb() - baseline_mb,
+                        max(chunk_sizes),
+                        chunk_sizes[-1],
+                    )
+                )
+            if checkpointed:
+                write_memory_plan(
+                    checkpoints_folder, max_memory_mb, cohort_hash, chunk_sizes
+                )
+        chunk_size = chunk_sizes[chunk_index]
+        chunk_summary = run_memory_chunk(
+            engine,
+            population_df.iloc[start : start + chunk_size],
+            results_folder,
+            trace_format,
+            append or chunk_index > 0,
+            f"{checkpoints_folder}/memory_chunk_{chunk_index:05d}"
+            if checkpoints_folder is not None
+            else None,
+            checkpoint_size,
+            cohort_hash,
+            resume,
+            profilers,
+            n_cycles,
+        )
+        # the summaries are added up as they come, since every one holds the
+        # occupancy of every cycle
+        summary = (
+            chunk_summary
+            if summary is None
+            else combine_summaries([summary, chunk_summary])
+        )
+        start += chunk_size
+        chunk_index += 1
+        print(f"simulated {min(start, N)} of {N} individuals")
+
+    used_mb = peak_memory_mb() - baseline_mb
+    report = {
+        "max_memory_mb": max_memory_mb,
+        "baseline_mb": baseline_mb,
+        "individual_kb": 1024 * max(used_mb, 0) / min(max(chunk_sizes), N),
+        "chunks": chunk_index,
+        "chunk_size": max(chunk_sizes),
+        "peak_memory_mb": peak_memory_mb(),
+    }
+    return summary, report
+
+
+def write_memory_report(path, report):
+    # Function:
+    #   Writes the memory report of a memory-bounded run to a json file
+    # Args:
+    #   path: path to the report (e.g., results/memory.json)
+    #   report: memory report (output from run_cohort_within_memory)
+    # Returns:
+    #   None
+
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
@@ -0,0 +1,66 @@
+import os
+from argparse import ArgumentParser
+from shard_functions import *
+from cohort_functions import read_cohort
+from append_functions import *
+
+parser = ArgumentParser()
+parser.add_argument(
+    "--shards",
+    dest="shards_folder",
+    default=None,
+    help="folder with one subfolder per shard (default: results/shards)",
+)
+parser.add_argument(
+    "--cohort",
+    dest="cohort_path",
+    default=None,
+    help="cohort the shards were simulated from, to let run_model.py --append "
+    "extend the merged results (default: results/cohort.csv)",
+)
+parser.add_argument(
+    "--chunk-size",
+    dest="chunk_size",
+    type=int,
+    default=None,
+    help="compute the treatment effects out of core, reading this many "
+    "individuals at a time (default: load both treatment arms at once)",
+)
+
+args = parser.parse_args()
+if args.chunk_size is not None and args.chunk_size < 1:
+    parser.error("--chunk-size must be at least 1")
+
+# identify overall folder directory for reading/saving files
+current_directory = os.path.dirname(__file__)
+parent_directory = os.path.dirname(current_directory)
+overall_folder = os.path.dirname(parent_directory)
+
+shards_folder = args.shards_folder or f"{overall_folder}/results/shards"
+results_folder = f"{overall_folder}/results"
+cohort_path = args.cohort_path or f"{overall_folder}/results/cohort.csv"
+
+# validate the shard manifests and combine the shards into results/
+try:
+    manifest = merge_shards(shards_folder, results_folder, args.chunk_size)
+except ValueError as error:
+    parser.error(str(error))
+
+# the run manifest lets later runs append new individuals to the merged
+# results (definitions in append_functions.py). It describes the cohort the
+# shards were simulated from, so it is only written when that cohort is here
+if os.path.exists(cohort_path) and hash_file(cohort_path) == manifest["cohort_hash"]:
+    write_run_manifest(
+        results_folder,
+        create_run_manifest(
+            read_cohort(cohort_path), manifest["engine"], manifest["trace_format"]
+        ),
+    )
+else:
+    # a manifest of earlier results would describe other results
+    if os.path.exists(f"{results_folder}/{RUN_MANIFEST_FILE}"):
+        os.remove(f"{results_folder}/{RUN_MANIFEST_FILE}")
+    print(
+        f"{cohort_path} is not the cohort of the shards: no {RUN_MANIFEST_FILE} "
+        "written, so run_model.py --append cannot extend these results"
+    )
@@ -2,6 +2,9 @@ import pandas as pd
 import numpy as np
 import time
 from functions import *
+from profiling_functions import *
+from sampling_functions import *
+from cohort_functions import read_cohort
 import os
 
 # identify overall folder directory for reading/saving files
@@ -49,34 +52,50 @@ def generate_transitions_HS_standard(current_state_HS, current_state_DNH):
     return transition_vec[current_state_HS]
 
 
-# Read in 2021 U.S. Life tables
-# Non-Hispanic Black (NHB)
-male_life_table_NHB = pd.read_excel(
-    f"{overall_folder}/data_and_inputs/2021_life_tables/NonHispanicBlackMale.xlsx"
-)
-female_life_table_NHB = pd.read_excel(
-    f"{overall_folder}/data_and_inputs/2021_life_tables/NonHispanicBlackFemale.xlsx"
-)
-# Non-Hispanic Black (NHW)
-male_life_table_NHW = pd.read_excel(
-    f"{overall_folder}/data_and_inputs/2021_life_tables/NonHispanicWhiteMale.xlsx"
-)
-female_life_table_NHW = pd.read_excel(
-    f"{overall_folder}/data_and_inputs/2021_life_tables/NonHispanicWhiteFemale.xlsx"
-)
-
-# Transform lifetables (definition in functions.py)
-male_life_table_NHB = transform_lifetables(male_life_table_NHB)
-female_life_table_NHB = transform_lifetables(female_life_table_NHB)
-male_life_table_NHW = transform_lifetables(male_life_table_NHW)
-female_life_table_NHW = transform_lifetables(female_life_table_NHW)
+def load_life_tables_standard():
+    # Function:
+    #   Reads in the 2021 U.S. life tables
+    # Args:
+    #   None
+    # Returns:
+    #   dictionary mapping (race, sex) to the transformed life table
+
+    # Read in 2021 U.S. Life tables
+    # Non-Hispanic Black (NHB)
+    male_life_table_NHB = pd.read_excel(
+        f"{overall_folder}/data_and_inputs/2021_life_tables/NonHispanicBlackMale.xlsx"
+    )
+    female_life_table_NHB = pd.read_excel(
+        f"{overall_folder}/data_and_inputs/2021_life_tables/NonHispanicBlackFemale.xlsx"
+    )
+    # Non-Hispanic Black (NHW)
+    male_life_table_NHW = pd.read_excel(
+        f"{overall_folder}/data_and_inputs/2021_life_tables/NonHispanicWhiteMale.xlsx"
+    )
+    female_life_table_NHW = pd.read_excel(
+        f"{overall_folder}/data_and_inputs/2021_life_tables/NonHispanicWhiteFemale.xlsx"
+    )
+
+    # Transform lifetables (definition in functions.py)
+    male_life_table_NHB = transform_lifetables(male_life_table_NHB)
+    female_life_table_NHB = transform_lifetables(female_life_table_NHB)
+    male_life_table_NHW = transform_lifetables(male_life_table_NHW)
+    female_life_table_NHW = transform_lifetables(female_life_table_NHW)
+
+    return {
+        ("NHB", "F"): female_life_table_NHB,
+        ("NHB", "M"): male_life_table_NHB,
+        ("NHW", "F"): female_life_table_NHW,
+        ("NHW", "M"): male_life_table_NHW,
+    }
+
 
 # Set-up mapping for life tables in functions
-life_table_mapping = {
-    ("NHB", "F"): female_life_table_NHB,
-    ("NHB", "M"): male_life_table_NHB,
-    ("NHW", "F"): female_life_table_NHW,
-    ("NHW", "M"): male_life_table_NHW,
+life_table_mapping = load_life_tables_standard()
+# probabilities of death indexed by age (ages 0 to 100), so the transition
+# functions do not search the life tables
+death_probability_mapping = {
+    key: life_table["qx"].to_numpy() for key, life_table in life_table_mapping.items()
 }
 
 
@@ -110,9 +129,8 @@ def generate_transitions_DNH_standard(
 
     # no one survives past age 100
     if age < 100:
-        life_table = life_table_mapping[(race, sex)]
         # obtain probability of death
-        pHD = life_table[life_table["age"] == int(age)]["qx"].iloc[0]
+        pHD = death_probability_mapping[(race, sex)][int(age)]
 
         # out of the health care system
         if current_state_HS == "OHS":
@@ -158,7 +176,9 @@ def generate_transitions_DNH_standard(
     return transition_vec[current_state_DNH]
 
 
-def run_cohort_standard(new_treatment):
+def run_cohort_standard(
+    new_treatment, population_df=None, profiler=None, n_cycles=None
+):
     # Function:
     #   Runs standard microsimulation model
     #   Returns health system utilization trace
@@ -168,6 +188,13 @@ def run_cohort_standard(new_treatment):
     #   and combination of starting patient characteristics and the two traces
     # Args:
     #   new_treatment: new treatment (True or False)
+    #   population_df: cohort to simulate (defaults to results/cohort.csv);
+    #   a subset of the cohort (e.g., one shard) keeps its original index
+    #   profiler: optional profiler (create_profiler in profiling_functions.py)
+    #   accumulating the time spent in each phase of the simulation loop
+    #   n_cycles: number of cycles of the traces (trace_cycles in functions.py,
+    #   of the whole cohort when population_df is a chunk of it); defaults to
+    #   trace_cycles of population_df
     # Returns:
     #   HS_state_trace_df: health system utilization trace
     #   state_trace_df: disease natural history trace
@@ -175,7 +202,10 @@ def run_cohort_standard(new_treatment):
     #   and health system utilization trace (HS_state_trace_df), and
     #   disease natural history trace (state_trace_df)
 
-    population_df = pd.read_csv(f"{overall_folder}/results/cohort.csv")
+    if population_df is None:
+        population_df = read_cohort()
+    if n_cycles is None:
+        n_cycles = trace_cycles(population_df["starting_age"])
     N = len(population_df)
 
     # Trace to keep track of disease natural history states
@@ -183,7 +213,7 @@ def run_cohort_standard(new_treatment):
     DNH_states = ["H", "S", "D"]
     initial_DNH_state = ["H" for j in range(N)]
     DNH_state_trace = np.array(
-        [["ToFill" for j in range(cycles + 1)] for i in range(N)]
+        [["ToFill" for j in range(n_cycles + 1)] for i in range(N)]
     )
     DNH_state_trace[:, 0] = initial_DNH_state
 
@@ -191,11 +221,25 @@ def run_cohort_standard(new_treatment):
     # Everyone starts in the health system
     HS_states = ["OHS", "IHS", "DT", "DUT"]
     initial_HS_state = ["IHS" for j in range(N)]
-    HS_state_trace = np.array([["ToFill" for j in range(cycles + 1)] for i in range(N)])
+    HS_state_trace = np.array(
+        [["ToFill" for j in range(n_cycles + 1)] for i in range(N)]
+    )
     HS_state_trace[:, 0] = initial_HS_state
 
     age_values = population_df["starting_age"].tolist()
+    # characteristics of every individual, extracted once before the loop
+    seed_values = population_df["seed"].tolist()
+    sex_values = population_df["sex"].tolist()
+    race_values = population_df["race"].tolist()
+    starting_age_values = population_df["starting_age"].tolist()
+
+    # the antithetic member of a pair uses 1 - u for every uniform draw u
+    if "antithetic" in population_df.columns:
+        antithetic_values = (population_df["antithetic"] == 1).tolist()
+    else:
+        antithetic_values = [False for i in range(N)]
 
+    profiling = profiler is not None
     start = time.time()
     years_to_death = [0 for i in range(N)]
     LY_disc = [0 for i in range(N)]
@@ -210,104 +254,98 @@ def run_cohort_standard(new_treatment):
     was_sick = [0 for i in range(N)]
     was_treated = [0 for i in range(N)]
 
+    # cumulative distributions of the transition probabilities, computed once
+    # per distinct set of arguments (definitions in sampling_functions.py)
+    HS_table = create_sampling_table(HS_states)
+    DNH_table = create_sampling_table(DNH_states)
+    # every individual is simulated until age 101 (definition in functions.py)
+    horizons = individual_horizons(starting_age_values).tolist()
+
     for i in range(N):
         # each individual has their own random seed
-        np.random.seed(population_df["seed"].iloc[i])
-        for t in range(cycles):
-            this_transition_HS = generate_transitions_HS_standard(
-                HS_state_trace[i, t], DNH_state_trace[i, t]
+        np.random.seed(seed_values[i])
+        for t in range(horizons[i]):
+            if profiling:
+                t0 = time.perf_counter()
+            HS_row = table_row(
+                HS_table,
+                generate_transitions_HS_standard,
+                HS_state_trace[i, t],
+                DNH_state_trace[i, t],
             )
+            if profiling:
+                t1 = time.perf_counter()
             # randomly sample next health system utilization state using
-            # transition probability array
-            HS_state_trace[i, t + 1] = np.random.choice(
-                HS_states, size=1, p=this_transition_HS
-            )[0]
-            this_transition_DNH = generate_transitions_DNH_standard(
+            # the row of its transition probabilities
+            HS_state_trace[i, t + 1] = HS_states[
+                draw_state(HS_table, HS_row, antithetic_values[i])
+            ]
+            if profiling:
+                t2 = time.perf_counter()
+            DNH_row = table_row(
+                DNH_table,
+                generate_transitions_DNH_standard,
                 HS_state_trace[i, t],
                 DNH_state_trace[i, t],
                 age_values[i],
-                population_df["sex"].iloc[i],
-                population_df["race"].iloc[i],
+                sex_values[i],
+                race_values[i],
                 new_treatment,
             )
+            if profiling:
+                t3 = time.perf_counter()
             # randomly sample next disease natural history state using
-            # transition probability array
-            DNH_state_trace[i, t + 1] = np.random.choice(
-                DNH_states, size=1, p=this_transition_DNH
-            )[0]
+            # the row of its transition probabilities
+            DNH_state_trace[i, t + 1] = DNH_states[
+                draw_state(DNH_table, DNH_row, antithetic_values[i])
+            ]
+            if profiling:
+                record_cycle(profiler, t0, t1, t2, t3, time.perf_counter())
             # age by one year
             age_values[i] = age_values[i] + 1
-
-        # compute life years
-        DNH_state_trace_LY = np.array([mapping.get(x, x) for x in DNH_state_trace[i]])
-        # discounted life years
-        LY_disc[i] = np.dot(DNH_state_trace_LY, v_disc)
-
-        # compute quality-adjusted life years (QALYs)
-        DNH_state_trace_QALY = np.array(
-            [QALY_mapping.get(x, x) for x in DNH_state_trace[i]]
+        # the cycles after the horizon keep the last states
+        hold_final_states(HS_state_trace[i], DNH_state_trace[i], horizons[i])
+
+        # compute the individual's outcomes (definition in functions.py)
+        if profiling:
+            t0 = time.perf_counter()
+        (
+            years_to_death[i],
+            LY_disc[i],
+            QALY_val[i],
+            QALY_disc[i],
+            COST_val[i],
+            COST_disc[i],
+            death_age[i],
+            years_sick[i],
+            years_sick_treated[i],
+            years_sick_untreated[i],
+            was_sick[i],
+            was_treated[i],
+        ) = compute_outcomes(
+            HS_state_trace[i],
+            DNH_state_trace[i],
+            new_treatment,
+            starting_age_values[i],
         )
-        QALY_val[i] = sum(DNH_state_trace_QALY)
-        # discounted QALYs
-        QALY_disc[i] = np.dot(DNH_state_trace_QALY, v_disc)
-
-        # compute costs from health states
-        DNH_state_trace_COST = np.array(
-            [COST_mapping.get(x, x) for x in DNH_state_trace[i]]
-        )
-        COST_val[i] = sum(DNH_state_trace_COST)
-        # discounted costs
-        COST_disc[i] = np.dot(DNH_state_trace_COST, v_disc)
-
-        # compute additional costs from treatment
-        if new_treatment:
-            treatment_rows = np.where(
-                (HS_state_trace[i] == "DT") & (DNH_state_trace[i] == "S"), COST_DT_NT, 0
-            )
-            this_treatment_COST = sum(treatment_rows)
-            this_treatment_COST_disc = np.dot(treatment_rows, v_disc)
-        else:
-            treatment_rows = np.where(
-                (HS_state_trace[i] == "DT") & (DNH_state_trace[i] == "S"), COST_DT_SC, 0
-            )
-            this_treatment_COST = sum(treatment_rows)
-            this_treatment_COST_disc = np.dot(treatment_rows, v_disc)
-
-        # add treatment costs to costs from health states
-        COST_val[i] = COST_val[i] + this_treatment_COST
-        COST_disc[i] = COST_disc[i] + this_treatment_COST_disc
-
-        # compute death age
-        years_to_death[i] = sum(DNH_state_trace_LY)
-        # list(DNH_state_trace[i]).index("D")
-        death_age[i] = population_df["starting_age"].iloc[i] + years_to_death[i]
-
-        # number of years spent sick
-        sick_years = np.where(DNH_state_trace[i] == "S")[0]
-        years_sick[i] = len(sick_years)
-        # number of years on treatment
-        years_treat = np.where(HS_state_trace[i] == "DT")[0]
-        overlap = [value for value in sick_years if value in years_treat]
-        # number of years sick and on treatment
-        years_sick_treated[i] = len(overlap)
-        # number of years sick without treatment
-        years_sick_untreated[i] = years_sick[i] - years_sick_treated[i]
-        # cumulative incidence of sickness
-        if years_sick[i] > 0:
-            was_sick[i] = 1
-        # cumulative incidence of detected/treated
-        if len(years_treat) > 0:
-            was_treated[i] = 1
+        if profiling:
+            record_outcomes(profiler, t0, time.perf_counter())
 
     end = time.time()
     print(end - start)
+    if profiling:
+        record_live_population(profiler, DNH_state_trace)
 
     # set up columns of health system state utilization trace
-    columns_trace = ["HSYear" + str(x) for x in range(0, cycles + 1)]
-    HS_state_trace_df = pd.DataFrame(HS_state_trace, columns=columns_trace)
+    columns_trace = ["HSYear" + str(x) for x in range(0, n_cycles + 1)]
+    HS_state_trace_df = pd.DataFrame(
+        HS_state_trace, columns=columns_trace, index=population_df.index
+    )
     # set up columns of disease natural history utlization trace
-    columns_trace2 = ["Year" + str(x) for x in range(0, cycles + 1)]
-    state_trace_df = pd.DataFrame(DNH_state_trace, columns=columns_trace2)
+    columns_trace2 = ["Year" + str(x) for x in range(0, n_cycles + 1)]
+    state_trace_df = pd.DataFrame(
+        DNH_state_trace, columns=columns_trace2, index=population_df.index
+    )
     # concat the starting population characteristics and two traces
     total_trace = pd.concat([population_df, state_trace_df, HS_state_trace_df], axis=1)
 
@@ -0,0 +1,191 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+from functions import *
+from markov_functions import *
+from event_functions import *
+from cohort_functions import *
+
+# identify overall folder directory for reading/saving files
+current_directory = os.path.dirname(__file__)
+parent_directory = os.path.dirname(current_directory)
+overall_folder = os.path.dirname(parent_directory)
+
+# transition tables already computed, by model, treatment and characteristics
+next_event_cache = dict()
+
+
+def next_event_tables(model, new_treatment, characteristics):
+    # Function:
+    #   Precomputes the tables the next-event engine samples from: the yearly
+    #   joint transition matrices and, for every joint state, the cumulative
+    #   hazard of leaving it (minus the log of the probability of staying in
+    #   the state from the first cycle up to every cycle)
+    # Args:
+    #   model: "standard" or "framework"
+    #   new_treatment: new treatment (True or False)
+    #   characteristics: dictionary of the characteristics in
+    #   MODEL_CHARACTERISTICS[model]
+    # Returns:
+    #   kernels: array of transition matrices (cycles x joint states x joint states)
+    #   cumulative_hazard: array (cycles + 1 x joint states), infinite once
+    #   leaving the state is certain (e.g., everyone alive at age 100 dies)
+
+    key = (model, bool(new_treatment)) + tuple(
+        characteristics[c] for c in MODEL_CHARACTERISTICS[model]
+    )
+    if key not in next_event_cache:
+        kernels = markov_transition_kernels(model, new_treatment, characteristics)
+        stay = np.diagonal(kernels, axis1=1, axis2=2)
+        with np.errstate(divide="ignore"):
+            hazard = -np.log(stay)
+        cumulative_hazard = np.vstack(
+            [np.zeros(len(JOINT_STATES)), np.cumsum(hazard, axis=0)]
+        )
+        next_event_cache[key] = (kernels, cumulative_hazard)
+    return next_event_cache[key]
+
+
+def simulate_next_events(kernels, cumulative_hazard, initial_HS, antithetic=False):
+    # Function:
+    #   Simulates one individual by jumping from transition to transition:
+    #   the cycle of the next transition is sampled by inverting the cumulative
+    #   hazard of leaving the current joint state, and the next joint state from
+    #   the yearly transition probabilities of that cycle, excluding staying.
+    #   This gives the same distribution as sampling every cycle
+    # Args:
+    #   kernels: yearly transition matrices (output from next_event_tables)
+    #   cumulative_hazard: cumulative hazards (output from next_event_tables)
+    #   initial_HS: initial health system state
+    #   antithetic: whether to use antithetic draws (1 - u)
+    # Returns:
+    #   dictionary mapping each event (as in EVENT_AGE_COLUMNS) to the cycle
+    #   it happens at
+
+    events = dict()
+    state = JOINT_STATES.index((initial_HS, "H"))
+    n_cycles = len(kernels)
+    t = 0
+    while t < n_cycles:
+        u = np.random.random_sample()
+        if antithetic:
+            u = 1 - u
+        # first cycle k at which the individual is no longer in the state:
+        # P(still in the state at k) = exp(-(H[k] - H[t])) < 1 - u
+        k = int(
+            cumulative_hazard[:, state].searchsorted(
+                cumulative_hazard[t, state] - np.log1p(-u), side="right"
+            )
+        )
+        if k > n_cycles:
+            break
+        transition = kernels[k - 1, state].copy()
+        transition[state] = 0
+        cdf = np.cumsum(transition)
+        u = np.random.random_sample()
+        if antithetic:
+            u = 1 - u
+        next_state = min(
+            int(cdf.searchsorted(u * cdf[-1], side="right")), len(JOINT_STATES) - 1
+        )
+        (h, d), (next_h, next_d) = JOINT_STATES[state], JOINT_STATES[next_state]
+        if next_d != d:
+            events["sick_age" if next_d == "S" else "death_age"] = k
+        if next_h != h:
+            events[f"{next_h}_age"] = k
+        state = next_state
+        t = k
+    return events
+
+
+def run_cohort_next_event(
+    model, new_treatment, population_df=None, profiler=None, n_cycles=None
+):
+    # Function:
+    #   Runs a model with the next-event engine. Instead of drawing the health
+    #   system and disease natural history states every cycle, each individual
+    #   takes two draws per transition (a handful in total), so the results
+    #   match the yearly loop in distribution but not draw for draw
+    # Args:
+    #   model: "standard" or "framework"
+    #   new_treatment: new treatment (True or False)
+    #   population_df: cohort to simulate (defaults to results/cohort.csv)
+    #   profiler: unused (the phases of the yearly loop do not apply)
+    #   n_cycles: number of cycles of the traces (as in run_cohort_standard)
+    # Returns:
+    #   HS_state_trace_df: health system utilization trace
+    #   state_trace_df: disease natural history trace
+    #   total_trace: combination of the cohort, both traces and the outcomes
+
+    if population_df is None:
+        population_df = read_cohort()
+    N = len(population_df)
+    arrays = cohort_arrays(population_df)
+    if "antithetic" in arrays:
+        antithetic_values = arrays["antithetic"] == 1
+    else:
+        antithetic_values = np.zeros(N, dtype=bool)
+
+    start = time.time()
+    event_ages = {c: [pd.NA for i in range(N)] for c in EVENT_AGE_COLUMNS}
+    initial_HS_values = np.empty(N, dtype=object)
+    # individuals of the same stratum and starting age share their tables
+    groups = pd.DataFrame(
+        {"stratum": arrays["stratum_index"], "starting_age": arrays["starting_age"]}
+    ).groupby(["stratum", "starting_age"], sort=False).indices
+    for (stratum, starting_age), group_rows in groups.items():
+        characteristics = stratum_characteristics(stratum)
+        characteristics["starting_age"] = int(starting_age)
+        kernels, cumulative_hazard = next_event_tables(
+            model, new_treatment, characteristics
+        )
+        # the standard model starts everyone in the health system
+        initial_HS = "IHS" if model == "standard" else characteristics["place"]
+        for i in group_rows:
+            initial_HS_values[i] = initial_HS
+            # each individual has their own random seed
+            np.random.seed(arrays["seed"][i])
+            events = simulate_next_events(
+                kernels, cumulative_hazard, initial_HS, antithetic_values[i]
+            )
+            for column, cycle in events.items():
+                event_ages[column][i] = int(starting_age) + cycle
+    end = time.time()
+    print(end - start)
+
+    events_df = population_df.copy()
+    events_df["initial_HS"] = initial_HS_values.tolist()
+    for column in EVENT_AGE_COLUMNS:
+        events_df[column] = pd.array(event_ages[column], dtype="Int64")
+    return events_to_total_trace(events_df, new_treatment, n_cycles)
+
+
+def run_cohort_standard_next_event(
+    new_treatment, population_df=None, profiler=None, n_cycles=None
+):
+    # Function:
+    #   Runs the standard model with the next-event engine
+    # Args:
+    #   same as run_cohort_standard
+    # Returns:
+    #   same as run_cohort_standard
+
+    return run_cohort_next_event(
+        "standard", new_treatment, population_df, profiler, n_cycles
+    )
+
+
+def run_cohort_social_framework_next_event(
+    new_treatment, population_df=None, profiler=None, n_cycles=None
+):
+    # Function:
+    #   Runs the model with our social factors framework with the next-event engine
+    # Args:
+    #   same as run_cohort_social_framework
+    # Returns:
+    #   same as run_cohort_social_framework
+
+    return run_cohort_next_event(
+        "framework", new_treatment, population_df, profiler, n_cycles
+    )
@@ -0,0 +1,142 @@
+from concurrent.futures import ProcessPoolExecutor
+from functions import *
+from checkpoint_functions import *
+from engine_functions import *
+
+# model arms written by run_model.py: (model, arm folder, new treatment)
+ARM_RUNS = [
+    ("standard", "sc", False),
+    ("standard", "nt", True),
+    ("framework", "sc", False),
+    ("framework", "nt", True),
+]
+# engines that simulate both treatment arms of a model together, so both arms
+# must run in the same process
+PAIRED_ENGINES = ["paired"]
+
+
+def arm_jobs(engine):
+    # Function:
+    #   Groups the model arms into jobs that can run in parallel: one job per
+    #   arm, or one job per model for engines in PAIRED_ENGINES
+    # Args:
+    #   engine: name of the simulation engine (a key of ENGINES)
+    # Returns:
+    #   list of jobs, each a list of (model, arm, new_treatment) of ARM_RUNS
+    #   to run one after the other
+
+    if engine in PAIRED_ENGINES:
+        models = list(dict.fromkeys(model for model, arm, nt in ARM_RUNS))
+        return [[run for run in ARM_RUNS if run[0] == model] for model in models]
+    return [[run] for run in ARM_RUNS]
+
+
+def run_arm_job(
+    engine,
+    job,
+    population_df,
+    checkpoints_folder,
+    checkpoint_size,
+    cohort_hash,
+    resume=False,
+    profilers=None,
+    n_cycles=None,
+):
+    # Function:
+    #   Runs the model arms of one job (output from arm_jobs) one after the other
+    # Args:
+    #   engine: name of the simulation engine (a key of ENGINES)
+    #   job: list of (model, arm, new_treatment)
+    #   population_df: cohort to simulate
+    #   checkpoints_folder: folder with one checkpoint subfolder per model arm
+    #   checkpoint_size: number of individuals per chunk (0 disables checkpoints)
+    #   cohort_hash: hash of the cohort file (hash_file in shard_functions.py)
+    #   resume: if True, skip the chunks completed by a previous run
+    #   profilers: optional dictionary of profilers by "model/arm"
+    #   n_cycles: number of cycles of the traces (trace_cycles in functions.py)
+    # Returns:
+    #   dictionary mapping "model/arm" to the (HS_state_trace_df,
+    #   state_trace_df, total_trace, profiler) of the arm
+
+    results = dict()
+    for model, arm, new_treatment in job:
+        profiler = profilers.get(f"{model}/{arm}") if profilers else None
+        results[f"{model}/{arm}"] = run_cohort_checkpointed(
+            get_engine(engine, model),
+            new_treatment,
+            population_df,
+            f"{checkpoints_folder}/{model}/{arm}",
+            checkpoint_size,
+            cohort_hash,
+            resume,
+            profiler,
+            n_cycles,
+        ) + (profiler,)
+    return results
+
+
+def run_all_arms(
+    engine,
+    population_df,
+    checkpoints_folder,
+    checkpoint_size,
+    cohort_hash,
+    resume=False,
+    profilers=None,
+    jobs=1,
+    n_cycles=None,
+):
+    # Function:
+    #   Runs the four model arms (ARM_RUNS) on a cohort loaded once, either one
+    #   after the other or in parallel worker processes. Every individual has
+    #   their own random seed, so the results do not depend on the number of jobs
+    # Args:
+    #   engine: name of the simulation engine (a key of ENGINES)
+    #   population_df: cohort to simulate
+    #   checkpoints_folder: folder with one checkpoint subfolder per model arm
+    #   checkpoint_size: number of individuals per chunk (0 disables checkpoints)
+    #   cohort_hash: hash of the cohort file (hash_file in shard_functions.py)
+    #   resume: if True, skip the chunks completed by a previous run
+    #   profilers: optional dictionary of profilers by "model/arm", updated with
+    #   the timings of the workers
+    #   jobs: number of worker processes (1 runs everything in this process)
+    #   n_cycles: number of cycles of the traces (trace_cycles in functions.py,
+    #   of the whole cohort when population_df is a chunk of it); defaults to
+    #   trace_cycles of population_df
+    # Returns:
+    #   dictionary mapping "model/arm" to the (HS_state_trace_df,
+    #   state_trace_df, total_trace) of the arm, in the order of ARM_RUNS
+
+    if jobs < 1:
+        raise ValueError(f"the number of jobs must be at least 1 (got {jobs})")
+    arguments = (
+        checkpoints_folder,
+        checkpoint_size,
+        cohort_hash,
+        resume,
+        profilers,
+        n_cycles,
+    )
+    results = dict()
+    if jobs == 1:
+        for job in arm_jobs(engine):
+            results.update(run_arm_job(engine, job, population_df, *arguments))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [
+                executor.submit(run_arm_job, engine, job, population_df, *arguments)
+                for job in arm_jobs(engine)
+            ]
+            for future in futures:
+                results.update(future.result())
+
+    arms = dict()
+    for model, arm, new_treatment in ARM_RUNS:
+        HS_state_trace_df, state_trace_df, total_trace, profiler = results[
+            f"{model}/{arm}"
+        ]
+        if profilers is not None:
+            # profilers of worker processes are copies
+            profilers[f"{model}/{arm}"] = profiler
+        arms[f"{model}/{arm}"] = (HS_state_trace_df, state_trace_df, total_trace)
+    return arms
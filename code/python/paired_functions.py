@@ -0,0 +1,429 @@
+import os
+import numpy as np
+import pandas as pd
+from functions import *
+from model_functions_standard import (
+    generate_transitions_HS_standard,
+    generate_transitions_DNH_standard,
+)
+from model_functions_social_framework import (
+    generate_transitions_HS_social_framework,
+    generate_transitions_DNH_social_framework,
+)
+from markov_functions import HS_STATES, DNH_STATES, MODEL_CHARACTERISTICS
+from cohort_functions import read_cohort
+from sampling_functions import *
+
+# identify overall folder directory for reading/saving files
+current_directory = os.path.dirname(__file__)
+parent_directory = os.path.dirname(current_directory)
+overall_folder = os.path.dirname(parent_directory)
+
+# (health system, disease natural history) state in which the disease natural
+# history transitions depend on the treatment (detected/treated and sick).
+# Both treatment arms are identical until an individual first reaches it
+TREATMENT_BRANCH = ("DT", "S")
+
+# arms simulated by run_cohort_paired but not requested yet, by model, treatment
+# and cohort
+paired_cache = dict()
+
+
+def generate_transitions(
+    model, HS_state, DNH_state, age, characteristics, new_treatment
+):
+    # Function:
+    #   Returns the health system utilization and disease natural history
+    #   transition probability arrays of one model
+    # Args:
+    #   model: "standard" or "framework"
+    #   HS_state: current health system utilization state
+    #   DNH_state: current disease natural history state
+    #   age: current individual's age
+    #   characteristics: dictionary of the characteristics in
+    #   MODEL_CHARACTERISTICS[model]
+    #   new_treatment: new treatment (True or False)
+    # Returns:
+    #   HS_transition: health system utilization transition probabilities
+    #   DNH_transition: disease natural history transition probabilities
+
+    if model == "standard":
+        return (
+            generate_transitions_HS_standard(HS_state, DNH_state),
+            generate_transitions_DNH_standard(
+                HS_state,
+                DNH_state,
+                age,
+                characteristics["sex"],
+                characteristics["race"],
+                new_treatment,
+            ),
+        )
+    return (
+        generate_transitions_HS_social_framework(
+            HS_state, DNH_state, characteristics["insurance"]
+        ),
+        generate_transitions_DNH_social_framework(
+            HS_state,
+            DNH_state,
+            age,
+            characteristics["sex"],
+            characteristics["race"],
+            characteristics["insurance"],
+            new_treatment,
+        ),
+    )
+
+
+def transition_rows(
+    model, tables, HS_state, DNH_state, age, characteristics, new_treatment
+):
+    # Function:
+    #   Finds the rows of the health system utilization and disease natural
+    #   history transition probabilities of one model in its sampling tables,
+    #   as generate_transitions computes them
+    # Args:
+    #   model: "standard" or "framework"
+    #   tables: dictionary of the "HS" and "DNH" sampling tables
+    #   (create_sampling_table in sampling_functions.py)
+    #   HS_state: current health system utilization state
+    #   DNH_state: current disease natural history state
+    #   age: current individual's age
+    #   characteristics: dictionary of the characteristics in
+    #   MODEL_CHARACTERISTICS[model]
+    #   new_treatment: new treatment (True or False)
+    # Returns:
+    #   HS_row: row id of the health system utilization transitions
+    #   DNH_row: row id of the disease natural history transitions
+
+    if model == "standard":
+        return (
+            table_row(
+                tables["HS"], generate_transitions_HS_standard, HS_state, DNH_state
+            ),
+            table_row(
+                tables["DNH"],
+                generate_transitions_DNH_standard,
+                HS_state,
+                DNH_state,
+                age,
+                characteristics["sex"],
+                characteristics["race"],
+                new_treatment,
+            ),
+        )
+    return (
+        table_row(
+            tables["HS"],
+            generate_transitions_HS_social_framework,
+            HS_state,
+            DNH_state,
+            characteristics["insurance"],
+        ),
+        table_row(
+            tables["DNH"],
+            generate_transitions_DNH_social_framework,
+            HS_state,
+            DNH_state,
+            age,
+            characteristics["sex"],
+            characteristics["race"],
+            characteristics["insurance"],
+            new_treatment,
+        ),
+    )
+
+
+def simulate_cycles(
+    model,
+    characteristics,
+    new_treatment,
+    HS_trace,
+    DNH_trace,
+    tables,
+    start,
+    end=cycles,
+    antithetic=False,
+    stop_at_branch=False,
+):
+    # Function:
+    #   Simulates the cycles of one individual from a starting cycle, drawing
+    #   the health system and disease natural history states in the same
+    #   order as run_cohort_standard and run_cohort_social_framework
+    # Args:
+    #   model: "standard" or "framework"
+    #   characteristics: dictionary of the characteristics in
+    #   MODEL_CHARACTERISTICS[model]
+    #   new_treatment: new treatment (True or False)
+    #   HS_trace: health system utilization trace of the individual, filled in
+    #   place from cycle start + 1
+    #   DNH_trace: disease natural history trace of the individual, filled in
+    #   place from cycle start + 1
+    #   tables: dictionary of the "HS" and "DNH" sampling tables of the run
+    #   (create_sampling_table in sampling_functions.py), shared by both arms
+    #   start: cycle of the state to simulate from
+    #   end: cycle of the last state to simulate
+    #   antithetic: whether to use antithetic draws (1 - u)
+    #   stop_at_branch: if True, stop at the first cycle in TREATMENT_BRANCH
+    #   (before drawing its transitions)
+    # Returns:
+    #   cycle the simulation stopped at (end if it ran to the end)
+
+    starting_age = characteristics["starting_age"]
+    for t in range(start, end):
+        HS_state, DNH_state = HS_trace[t], DNH_trace[t]
+        if stop_at_branch and (HS_state, DNH_state) == TREATMENT_BRANCH:
+            return t
+        HS_row, DNH_row = transition_rows(
+            model,
+            tables,
+            HS_state,
+            DNH_state,
+            starting_age + t,
+            characteristics,
+            new_treatment,
+        )
+        HS_trace[t + 1] = HS_STATES[draw_state(tables["HS"], HS_row, antithetic)]
+        DNH_trace[t + 1] = DNH_STATES[
+            draw_state(tables["DNH"], DNH_row, antithetic)
+        ]
+    return end
+
+
+def simulate_branch_cycle(model, characteristics, traces, tables, t, antithetic=False):
+    # Function:
+    #   Simulates one cycle of one individual in TREATMENT_BRANCH in both
+    #   treatment arms. Both arms use the same two uniform draws (health system
+    #   then disease natural history), which is what each arm would draw from
+    #   the same random number generator state
+    # Args:
+    #   model: "standard" or "framework"
+    #   characteristics: dictionary of the characteristics in
+    #   MODEL_CHARACTERISTICS[model]
+    #   traces: dictionary mapping new_treatment (False and True) to the
+    #   (HS_trace, DNH_trace) of the individual in that arm, filled in place at
+    #   cycle t + 1
+    #   tables: dictionary of the "HS" and "DNH" sampling tables of the run
+    #   t: cycle of the state to simulate from
+    #   antithetic: whether to use antithetic draws (1 - u)
+    # Returns:
+    #   None
+
+    u_HS = np.random.random_sample()
+    u_DNH = np.random.random_sample()
+    if antithetic:
+        u_HS, u_DNH = 1 - u_HS, 1 - u_DNH
+    for new_treatment, (HS_trace, DNH_trace) in traces.items():
+        HS_row, DNH_row = transition_rows(
+            model,
+            tables,
+            HS_trace[t],
+            DNH_trace[t],
+            characteristics["starting_age"] + t,
+            characteristics,
+            new_treatment,
+        )
+        HS_trace[t + 1] = HS_STATES[table_state(tables["HS"], HS_row, u_HS)]
+        DNH_trace[t + 1] = DNH_STATES[table_state(tables["DNH"], DNH_row, u_DNH)]
+
+
+def run_cohort_paired(model, population_df=None, n_cycles=None, profiler=None):
+    # Function:
+    #   Runs both treatment arms of a model at once. Every individual uses the
+    #   same random seed in both arms, and the treatment only changes the
+    #   transitions out of TREATMENT_BRANCH, so the common part of the two
+    #   trajectories is simulated once. In a cycle in TREATMENT_BRANCH, both
+    #   arms draw their next states from the same random number generator
+    #   state; the trajectories fork when these differ, and each arm continues
+    #   from its own generator state. Every cycle takes the same number of
+    #   draws, so both arms are the same, draw for draw, as running the model
+    #   twice
+    # Args:
+    #   model: "standard" or "framework"
+    #   population_df: cohort to simulate (defaults to results/cohort.csv)
+    #   n_cycles: number of cycles of the traces (as in run_cohort_standard)
+    #   profiler: optional profiler (profiling_functions.py), which counts the
+    #   individuals whose arms forked (the phases of both arms are interleaved
+    #   and not timed)
+    # Returns:
+    #   dictionary mapping new_treatment (False and True) to the
+    #   (HS_state_trace_df, state_trace_df, total_trace) of that arm
+
+    if population_df is None:
+        population_df = read_cohort()
+    if n_cycles is None:
+        n_cycles = trace_cycles(population_df["starting_age"])
+    N = len(population_df)
+    characteristics = MODEL_CHARACTERISTICS[model]
+    if "antithetic" in population_df.columns:
+        antithetic_values = (population_df["antithetic"] == 1).tolist()
+    else:
+        antithetic_values = [False for i in range(N)]
+
+    # Everyone starts healthy, in the health system in the standard model and
+    # according to their routine place for healthcare in the framework
+    traces = dict()
+    for new_treatment in [False, True]:
+        DNH_state_trace = np.full((N, n_cycles + 1), "ToFill")
+        DNH_state_trace[:, 0] = "H"
+        HS_state_trace = np.full((N, n_cycles + 1), "ToFill")
+        if model == "standard":
+            HS_state_trace[:, 0] = "IHS"
+        else:
+            HS_state_trace[:, 0] = population_df["place"].tolist()
+        traces[new_treatment] = (HS_state_trace, DNH_state_trace)
+
+    # cumulative distributions of the transition probabilities of both arms,
+    # computed once per distinct set of arguments (sampling_functions.py)
+    tables = {
+        "HS": create_sampling_table(HS_STATES),
+        "DNH": create_sampling_table(DNH_STATES),
+    }
+    forked = 0
+    rows = population_df[characteristics + ["seed"]].to_dict("records")
+    # every individual is simulated until age 101 (definition in functions.py)
+    horizons = individual_horizons(population_df["starting_age"]).tolist()
+    for i, row in enumerate(rows):
+        HS_SC, DNH_SC = traces[False][0][i], traces[False][1][i]
+        HS_NT, DNH_NT = traces[True][0][i], traces[True][1][i]
+        antithetic = antithetic_values[i]
+        # each individual has their own random seed
+        np.random.seed(row["seed"])
+        horizon = horizons[i]
+        t = 0
+        while t < horizon:
+            # common part of both arms (the treatment does not matter)
+            t = simulate_cycles(
+                model, row, False, HS_SC, DNH_SC, tables, t, horizon, antithetic, True
+            )
+            if t == horizon:
+                break
+            # the treatment matters in this cycle: draw it in both arms
+            HS_NT[t], DNH_NT[t] = HS_SC[t], DNH_SC[t]
+            simulate_branch_cycle(
+                model,
+                row,
+                {False: (HS_SC, DNH_SC), True: (HS_NT, DNH_NT)},
+                tables,
+                t,
+                antithetic,
+            )
+            t = t + 1
+            if (HS_NT[t], DNH_NT[t]) != (HS_SC[t], DNH_SC[t]):
+                # the arms fork: each one continues on its own, from the same
+                # random number generator state
+                forked += 1
+                random_state = np.random.get_state()
+                simulate_cycles(
+                    model, row, False, HS_SC, DNH_SC, tables, t, horizon, antithetic
+                )
+                np.random.set_state(random_state)
+                simulate_cycles(
+                    model, row, True, HS_NT, DNH_NT, tables, t, horizon, antithetic
+                )
+                break
+        # the arms are the same up to the fork (or the end of the simulation)
+        HS_NT[:t] = HS_SC[:t]
+        DNH_NT[:t] = DNH_SC[:t]
+        if t == horizon:
+            HS_NT[t], DNH_NT[t] = HS_SC[t], DNH_SC[t]
+        # the cycles after the horizon keep the last states
+        hold_final_states(HS_SC, DNH_SC, horizon)
+        hold_final_states(HS_NT, DNH_NT, horizon)
+    if profiler is not None:
+        profiler["forked"] = profiler.get("forked", 0) + forked
+
+    arms = dict()
+    starting_ages = population_df["starting_age"].tolist()
+    for new_treatment, (HS_state_trace, DNH_state_trace) in traces.items():
+        HS_state_trace_df = pd.DataFrame(
+            HS_state_trace,
+            columns=["HSYear" + str(x) for x in range(0, n_cycles + 1)],
+            index=population_df.index,
+        )
+        state_trace_df = pd.DataFrame(
+            DNH_state_trace,
+            columns=["Year" + str(x) for x in range(0, n_cycles + 1)],
+            index=population_df.index,
+        )
+        # outcomes of each arm (definition in functions.py)
+        outcomes = pd.DataFrame(
+            [
+                compute_outcomes(
+                    HS_state_trace[i],
+                    DNH_state_trace[i],
+                    new_treatment,
+                    starting_ages[i],
+                )
+                for i in range(N)
+            ],
+            columns=OUTCOME_COLUMNS,
+            index=population_df.index,
+        )
+        total_trace = pd.concat(
+            [population_df, state_trace_df, HS_state_trace_df, outcomes], axis=1
+        )
+        arms[new_treatment] = (HS_state_trace_df, state_trace_df, total_trace)
+    return arms
+
+
+def run_cohort_paired_arm(
+    model, new_treatment, population_df=None, profiler=None, n_cycles=None
+):
+    # Function:
+    #   Runs one treatment arm with the paired engine: the first arm requested
+    #   runs both arms (run_cohort_paired) and keeps the other one until it is
+    #   requested for the same cohort (e.g., the same checkpoint chunk)
+    # Args:
+    #   model: "standard" or "framework"
+    #   new_treatment: new treatment (True or False)
+    #   population_df: cohort to simulate (defaults to results/cohort.csv)
+    #   profiler: optional profiler of the arm, which counts the individuals
+    #   whose arms forked when this arm runs both (see run_cohort_paired)
+    #   n_cycles: number of cycles of the traces (as in run_cohort_standard)
+    # Returns:
+    #   HS_state_trace_df: health system utilization trace
+    #   state_trace_df: disease natural history trace
+    #   total_trace: combination of the cohort, both traces and the outcomes
+
+    if population_df is None:
+        population_df = read_cohort()
+    cohort_key = pd.util.hash_pandas_object(population_df).to_numpy().tobytes()
+    key = (model, bool(new_treatment), cohort_key, n_cycles)
+    if key not in paired_cache:
+        arms = run_cohort_paired(model, population_df, n_cycles, profiler)
+        paired_cache[(model, not new_treatment, cohort_key, n_cycles)] = arms[
+            not new_treatment
+        ]
+        return arms[new_treatment]
+    return paired_cache.pop(key)
+
+
+def run_cohort_standard_paired(
+    new_treatment, population_df=None, profiler=None, n_cycles=None
+):
+    # Function:
+    #   Runs the standard model with the paired engine
+    # Args:
+    #   same as run_cohort_standard
+    # Returns:
+    #   same as run_cohort_standard
+
+    return run_cohort_paired_arm(
+        "standard", new_treatment, population_df, profiler, n_cycles
+    )
+
+
+def run_cohort_social_framework_paired(
+    new_treatment, population_df=None, profiler=None, n_cycles=None
+):
+    # Function:
+    #   Runs the model with our social factors framework with the paired engine
+    # Args:
+    #   same as run_cohort_social_framework
+    # Returns:
+    #   same as run_cohort_social_framework
+
+    return run_cohort_paired_arm(
+        "framework", new_treatment, population_df, profiler, n_cycles
+    )
@@ -0,0 +1,332 @@
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from functions import *
+from develop_cohort import develop_cohort
+from orchestration_functions import *
+from event_functions import *
+from markov_functions import add_control_variates
+from cohort_functions import *
+from summary_functions import *
+from streaming_functions import (
+    paired_chunks,
+    create_block_effect,
+    update_block_effect,
+    block_treatment_effect,
+)
+
+# marks the end of the chunks in a queue
+END_OF_CHUNKS = None
+
+
+def generated_cohort_chunks(cohort_size, chunk_size, master_seed=1234, **options):
+    # Function:
+    #   Generates a cohort chunk by chunk. Chunk b is drawn by develop_cohort
+    #   with master seed master_seed + b and the next ids (as the batches of
+    #   run_adaptive.py), so the cohort never has to be held in memory
+    # Args:
+    #   cohort_size: number of individuals
+    #   chunk_size: number of individuals per chunk
+    #   master_seed: master random seed of the first chunk
+    #   options: other arguments of develop_cohort (stratified, antithetic,
+    #   oversampling), applied within every chunk
+    # Returns:
+    #   generator of cohort chunks (pandas dataframes)
+
+    for chunk_index, start in enumerate(range(0, cohort_size, chunk_size)):
+        population_df = develop_cohort(
+            min(chunk_size, cohort_size - start),
+            master_seed=master_seed + chunk_index,
+            first_id=start,
+            **options,
+        )
+        population_df.index = range(start, start + len(population_df))
+        yield population_df
+
+
+def csv_cohort_chunks(cohort_path, chunk_size):
+    # Function:
+    #   Reads a cohort file chunk by chunk
+    # Args:
+    #   cohort_path: path to the cohort csv file (e.g., results/cohort.csv)
+    #   chunk_size: number of individuals per chunk
+    # Returns:
+    #   generator of cohort chunks (typed_cohort dataframes indexed by row
+    #   number), with whole antithetic pairs (paired_chunks in
+    #   streaming_functions.py), so a pair may move to the next chunk
+
+    with pd.read_csv(cohort_path, chunksize=chunk_size, **COHORT_CSV_OPTIONS) as reader:
+        yield from paired_chunks(typed_cohort(df) for df in reader)
+
+
+def treatment_effect_summary(total_trace):
+    # Function:
+    #   Drops the traces of a total trace, keeping the cohort columns, outcomes
+    #   and control variates that create_treatment_effect needs
+    # Args:
+    #   total_trace: total trace of one model arm
+    # Returns:
+    #   pandas dataframe without the HSYear/Year columns
+
+    return total_trace.drop(
+        columns=trace_columns(total_trace) + trace_columns(total_trace, "HSYear")
+    )
+
+
+def simulate_chunk(engine, population_df, control_variates=False, n_cycles=cycles):
+    # Function:
+    #   Runs the four model arms (ARM_RUNS) on one cohort chunk
+    # Args:
+    #   engine: name of the simulation engine (a key of ENGINES)
+    #   population_df: cohort chunk
+    #   control_variates: if True, adds the control variates
+    #   (add_control_variates in markov_functions.py) to the summaries
+    #   n_cycles: number of cycles of the traces of the whole cohort
+    # Returns:
+    #   arms: dictionary mapping "model/arm" to the (HS_state_trace_df,
+    #   state_trace_df, total_trace) of the arm
+    #   summaries: dictionary mapping "model/arm" to the treatment effect
+    #   summary of the arm (output from treatment_effect_summary)
+    #   result_summary: aggregate results of the chunk (output from
+    #   create_summary in summary_functions.py)
+
+    arms = run_all_arms(engine, population_df, None, 0, None, n_cycles=n_cycles)
+    summaries = dict()
+    for model, arm, new_treatment in ARM_RUNS:
+        total_trace = arms[f"{model}/{arm}"][2]
+        if control_variates:
+            total_trace = add_control_variates(total_trace, model, new_treatment)
+        summaries[f"{model}/{arm}"] = treatment_effect_summary(total_trace)
+    return arms, summaries, create_summary(population_df, arms)
+
+
+def start_stage(target, *args):
+    # Function:
+    #   Runs one stage of the pipeline in a background thread
+    # Args:
+    #   target: function of the stage
+    #   args: arguments of the function
+    # Returns:
+    #   thread and list that receives the exception of the stage, if any
+
+    errors = []
+
+    def run_stage():
+        try:
+            target(*args)
+        except BaseException as error:
+            errors.append(error)
+
+    thread = threading.Thread(target=run_stage, daemon=True)
+    thread.start()
+    return thread, errors
+
+
+def put_chunks(chunks, cohort_queue):
+    # Function:
+    #   Generator stage: puts the cohort chunks into a bounded queue (blocking
+    #   while it is full) followed by END_OF_CHUNKS
+    # Args:
+    #   chunks: iterable of cohort chunks
+    #   cohort_queue: bounded queue.Queue read by the simulation stage
+    # Returns:
+    #   None
+
+    try:
+        for population_df in chunks:
+            cohort_queue.put(population_df)
+    finally:
+        cohort_queue.put(END_OF_CHUNKS)
+
+
+def write_chunks(
+    result_queue, results_folder, trace_format, cohort_path, summaries, result_summaries
+):
+    # Function:
+    #   Writer stage: appends the results of every simulated chunk, in cohort
+    #   order, to the files of its model arm and adds the chunk to the running
+    #   treatment effects and aggregate results, so nothing per individual is
+    #   kept once a chunk is written
+    # Args:
+    #   result_queue: bounded queue.Queue of (population_df, arms, summaries)
+    #   filled by the simulation stage, ending with END_OF_CHUNKS
+    #   results_folder: folder to write the results to (e.g., results/)
+    #   trace_format: "dense", "events" or "unique"
+    #   cohort_path: path to write the generated cohort to (None if the cohort
+    #   was read from a file)
+    #   summaries: dictionary filled with the running treatment effect of every
+    #   model (create_block_effect in streaming_functions.py: running moments
+    #   of independent individuals, design sums of stratified, antithetic or
+    #   oversampled cohorts, or control-variate sums)
+    #   result_summaries: list holding the aggregate results of the chunks
+    #   written so far (create_summary in summary_functions.py), added up as
+    #   they come
+    # Returns:
+    #   None
+
+    chunk_index = 0
+    while True:
+        result = result_queue.get()
+        if result is END_OF_CHUNKS:
+            break
+        population_df, arms, chunk_summaries, result_summary = result
+        # every summary holds the occupancy of every cycle, so they are added up
+        if result_summaries:
+            result_summary = combine_summaries([result_summaries.pop(), result_summary])
+        result_summaries.append(result_summary)
+        append = chunk_index > 0
+        if cohort_path is not None:
+            population_df.to_csv(
+                cohort_path, index=False, mode="a" if append else "w", header=not append
+            )
+        for arm, (HS_state_trace_df, state_trace_df, total_trace) in arms.items():
+            write_traces(
+                f"{results_folder}/{arm}",
+                population_df,
+                HS_state_trace_df,
+                state_trace_df,
+                total_trace,
+                trace_format,
+                append,
+            )
+        for model in ["standard", "framework"]:
+            summary_SC = chunk_summaries[f"{model}/sc"]
+            summary_NT = chunk_summaries[f"{model}/nt"]
+            if model not in summaries:
+                summaries[model] = create_block_effect(summary_SC)
+            update_block_effect(summaries[model], summary_SC, summary_NT)
+        print(f"wrote chunk {chunk_index} ({len(population_df)} individuals)")
+        chunk_index += 1
+
+
+def run_pipeline(
+    chunks,
+    results_folder,
+    engine="reference",
+    trace_format="dense",
+    jobs=1,
+    queue_depth=2,
+    cohort_path=None,
+    control_variates=False,
+    n_cycles=cycles,
+):
+    # Function:
+    #   Runs the model as a pipeline: a generator thread puts cohort chunks into
+    #   a bounded queue, worker processes simulate the four model arms of every
+    #   chunk, and a writer thread appends the finished chunks to the result
+    #   files. At most queue_depth chunks wait in each queue and queue_depth
+    #   chunks are simulated at a time, so memory depends on the chunk size
+    #   and queue depth instead of the cohort size, and simulation overlaps
+    #   with reading and writing. The aggregate results of the chunks are
+    #   written to results_folder/summary.json at the end
+    # Args:
+    #   chunks: iterable of cohort chunks (generated_cohort_chunks or
+    #   csv_cohort_chunks)
+    #   results_folder: folder to write the results to (e.g., results/)
+    #   engine: name of the simulation engine (a key of ENGINES)
+    #   trace_format: "dense", "events" or "unique"
+    #   jobs: number of worker processes simulating chunks
+    #   queue_depth: maximum number of chunks waiting in each queue
+    #   cohort_path: path to write the generated cohort to (None if the cohort
+    #   is read from a file)
+    #   control_variates: if True, estimates the treatment effects with control
+    #   variates (add_control_variates in markov_functions.py). The treatment
+    #   effects are accumulated chunk by chunk either way
+    #   (create_block_effect in streaming_functions.py)
+    #   n_cycles: number of cycles of the traces of every chunk (trace_cycles
+    #   in functions.py of the whole cohort, known before its chunks are read
+    #   or generated); the default covers cohorts starting at starting_age or
+    #   older
+    # Returns:
+    #   dictionary mapping each model to its treatment effect dataframe
+
+    if jobs < 1 or queue_depth < 1:
+        raise ValueError("the number of jobs and the queue depth must be at least 1")
+    trace_files(trace_format)
+    summaries = dict()
+    result_summaries = []
+    cohort_queue = queue.Queue(maxsize=queue_depth)
+    result_queue = queue.Queue(maxsize=queue_depth)
+    generator, generator_errors = start_stage(put_chunks, chunks, cohort_queue)
+    writer, writer_errors = start_stage(
+        write_chunks,
+        result_queue,
+        results_folder,
+        trace_format,
+        cohort_path,
+        summaries,
+        result_summaries,
+    )
+
+    def put_result(future, population_df):
+        # the writer stopping early (e.g., a full disk) must not block the workers
+        while True:
+            if writer_errors:
+                raise writer_errors[0]
+            try:
+                result_queue.put((population_df,) + future.result(), timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    failed = True
+    try:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            # chunks being simulated, in cohort order
+            pending = deque()
+            while True:
+                population_df = cohort_queue.get()
+                if population_df is END_OF_CHUNKS:
+                    break
+                pending.append(
+                    (
+                        executor.submit(
+                            simulate_chunk,
+                            engine,
+                            population_df,
+                            control_variates,
+                            n_cycles,
+                        ),
+                        population_df,
+                    )
+                )
+                if len(pending) >= max(jobs, queue_depth):
+                    put_result(*pending.popleft())
+            while pending:
+                put_result(*pending.popleft())
+        failed = False
+    finally:
+        # the writer finishes the chunks already in its queue
+        while writer.is_alive():
+            try:
+                result_queue.put(END_OF_CHUNKS, timeout=1)
+                break
+            except queue.Full:
+                continue
+        writer.join()
+        if not failed:
+            generator.join()
+    for errors in [generator_errors, writer_errors]:
+        if errors:
+            raise errors[0]
+    if not summaries:
+        raise ValueError("the cohort is empty")
+
+    if trace_format == "unique":
+        # trajectories found in several chunks are combined
+        for model, arm, new_treatment in ARM_RUNS:
+            trajectory_path = f"{results_folder}/{model}/{arm}/{TRAJECTORY_FILE}"
+            read_trajectories(trajectory_path).to_csv(trajectory_path, index=False)
+
+    treatment_effects = {
+        model: block_treatment_effect(summaries[model])
+        for model in ["standard", "framework"]
+    }
+    write_summary(
+        f"{results_folder}/{SUMMARY_FILE}", result_summaries[0], treatment_effects
+    )
+    return treatment_effects
@@ -0,0 +1,139 @@
+import json
+import time
+import numpy as np
+from functions import *
+
+# phases of the simulation loop timed by the profiler
+PROFILE_PHASES = [
+    "HS_transition_build",
+    "HS_sampling",
+    "DNH_transition_build",
+    "DNH_sampling",
+    "outcome_computation",
+]
+
+
+def create_profiler(n_cycles=cycles):
+    # Function:
+    #   Creates an empty profiler to pass to run_cohort_standard or
+    #   run_cohort_social_framework. Without a profiler, the simulation loop
+    #   skips all timing
+    # Args:
+    #   n_cycles: number of cycles of the traces (trace_cycles in functions.py)
+    # Returns:
+    #   dictionary accumulating the time and number of calls of every phase,
+    #   the number of simulated individuals, and the number of individuals
+    #   alive at every cycle
+
+    return {
+        "seconds": {phase: 0.0 for phase in PROFILE_PHASES},
+        "calls": {phase: 0 for phase in PROFILE_PHASES},
+        "individuals": 0,
+        "live_population": np.zeros(n_cycles + 1, dtype=np.int64),
+    }
+
+
+def record_cycle(profiler, t0, t1, t2, t3, t4):
+    # Function:
+    #   Adds the phase times of one simulated cycle of one individual
+    # Args:
+    #   profiler: profiler (output from create_profiler)
+    #   t0, t1, t2, t3, t4: time.perf_counter() before building the health
+    #   system transition, before sampling the health system state, before
+    #   building the disease natural history transition, before sampling the
+    #   disease natural history state, and at the end of the cycle
+    # Returns:
+    #   None
+
+    seconds = profiler["seconds"]
+    calls = profiler["calls"]
+    seconds["HS_transition_build"] += t1 - t0
+    seconds["HS_sampling"] += t2 - t1
+    seconds["DNH_transition_build"] += t3 - t2
+    seconds["DNH_sampling"] += t4 - t3
+    calls["HS_transition_build"] += 1
+    calls["HS_sampling"] += 1
+    calls["DNH_transition_build"] += 1
+    calls["DNH_sampling"] += 1
+
+
+def record_outcomes(profiler, t0, t1):
+    # Function:
+    #   Adds the time of computing the outcomes of one individual
+    # Args:
+    #   profiler: profiler (output from create_profiler)
+    #   t0, t1: time.perf_counter() before and after computing the outcomes
+    # Returns:
+    #   None
+
+    profiler["seconds"]["outcome_computation"] += t1 - t0
+    profiler["calls"]["outcome_computation"] += 1
+    profiler["individuals"] += 1
+
+
+def record_live_population(profiler, DNH_state_trace):
+    # Function:
+    #   Adds the number of individuals alive at every cycle of a simulated
+    #   disease natural history trace
+    # Args:
+    #   profiler: profiler (output from create_profiler)
+    #   DNH_state_trace: array of disease natural history states
+    #   (individuals x cycles)
+    # Returns:
+    #   None
+
+    profiler["live_population"] += (DNH_state_trace != "D").sum(axis=0)
+
+
+def profile_report(profiler):
+    # Function:
+    #   Summarizes a profiler into a json-serializable report
+    # Args:
+    #   profiler: profiler (output from create_profiler)
+    # Returns:
+    #   dictionary with the total time, number of calls, mean time per call
+    #   and share of the loop time of every phase, the live population at
+    #   every age, and the number of forked individuals of the paired engine
+
+    total_seconds = sum(profiler["seconds"].values())
+    phases = {}
+    for phase in PROFILE_PHASES:
+        seconds = profiler["seconds"][phase]
+        calls = profiler["calls"][phase]
+        phases[phase] = {
+            "seconds": seconds,
+            "calls": calls,
+            "microseconds_per_call": 1e6 * seconds / calls if calls > 0 else None,
+            "share": seconds / total_seconds if total_seconds > 0 else None,
+        }
+    # ages from the youngest age the traces cover (trace_cycles in functions.py)
+    first_age = 101 - (len(profiler["live_population"]) - 1)
+    report = {
+        "individuals": profiler["individuals"],
+        "person_cycles": profiler["calls"]["DNH_sampling"],
+        "seconds": total_seconds,
+        "phases": phases,
+        "live_population": [
+            {"cycle": t, "age": first_age + t, "alive": int(alive)}
+            for t, alive in enumerate(profiler["live_population"])
+        ],
+    }
+    if "forked" in profiler:
+        # individuals whose treatment arms forked (paired engine)
+        report["forked"] = profiler["forked"]
+    return report
+
+
+def write_profile_report(path, profilers):
+    # Function:
+    #   Writes the profile reports of several model arms as one json file
+    # Args:
+    #   path: path to the json file
+    #   profilers: dictionary mapping a model arm (e.g., "standard/sc")
+    #   to its profiler
+    # Returns:
+    #   None
+
+    report = {arm: profile_report(profiler) for arm, profiler in profilers.items()}
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
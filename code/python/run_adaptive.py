@@ -0,0 +1,125 @@
+import json
+import os
+from argparse import ArgumentParser
+from functions import *
+from develop_cohort import develop_cohort
+from engine_functions import *
+from adaptive_functions import *
+
+parser = ArgumentParser()
+parser.add_argument(
+    "--target",
+    dest="targets",
+    nargs="+",
+    default=["discounted_QALY:Diff:0.01"],
+    help="precision targets as column:statistic:se, met in every race group "
+    "(e.g., discounted_QALY:Diff:0.01)",
+)
+parser.add_argument(
+    "--batch-size",
+    dest="batch_size",
+    type=int,
+    default=1000,
+    help="individuals simulated before checking the targets",
+)
+parser.add_argument(
+    "--min-batches",
+    dest="min_batches",
+    type=int,
+    default=2,
+    help="batches simulated before the targets may stop the run",
+)
+parser.add_argument(
+    "--max-size",
+    dest="max_size",
+    type=int,
+    default=1000000,
+    help="largest cohort size simulated when the targets are not met",
+)
+parser.add_argument(
+    "--model",
+    dest="model",
+    default="standard",
+    help="model to simulate (standard or framework)",
+)
+parser.add_argument(
+    "--engine",
+    dest="engine",
+    default="reference",
+    help=f"simulation engine ({', '.join(ENGINES)})",
+)
+
+args = parser.parse_args()
+if args.batch_size <= 0:
+    parser.error("--batch-size must be positive")
+if args.min_batches <= 0:
+    parser.error("--min-batches must be positive")
+if args.max_size <= 0:
+    parser.error("--max-size must be positive")
+try:
+    targets = [parse_target(target) for target in args.targets]
+except ValueError as error:
+    parser.error(str(error))
+run_cohort = get_engine(args.engine, args.model)
+
+# identify overall folder directory for reading/saving files
+current_directory = os.path.dirname(__file__)
+parent_directory = os.path.dirname(current_directory)
+overall_folder = os.path.dirname(parent_directory)
+
+adaptive_folder = f"{overall_folder}/results/adaptive"
+os.makedirs(adaptive_folder, exist_ok=True)
+
+# Simulates the cohort batch by batch. Batch b is generated with master seed
+# 1234 + b and ids starting at b * batch_size, so the first batch is the cohort
+# of develop_cohort.py and the batches together form one cohort with unique ids
+running_effect = create_running_effect()
+cohort_batches = []
+cohort_size = 0
+batch = 0
+targets_met = False
+while not targets_met and cohort_size < args.max_size:
+    batch_size = min(args.batch_size, args.max_size - cohort_size)
+    population_df = develop_cohort(
+        batch_size, master_seed=1234 + batch, first_id=cohort_size
+    )
+    _, _, total_trace_SC = run_cohort(False, population_df)
+    _, _, total_trace_NT = run_cohort(True, population_df)
+    update_running_effect(running_effect, total_trace_SC, total_trace_NT)
+    cohort_batches.append(population_df)
+    cohort_size += batch_size
+    batch += 1
+
+    treatment_effect_df = running_treatment_effect(running_effect)
+    target_check = check_targets(treatment_effect_df, targets)
+    targets_met = batch >= args.min_batches and bool(target_check["met"].all())
+    print(
+        f"{cohort_size} individuals: largest se / threshold "
+        f"{(target_check['se'] / target_check['threshold']).max():.3f}"
+    )
+
+# export the simulated cohort, the treatment effect and the target check
+pd.concat(cohort_batches, ignore_index=True).to_csv(
+    f"{adaptive_folder}/cohort.csv", index=False
+)
+treatment_effect_df.to_csv(
+    f"{adaptive_folder}/{args.model}_treatment_effect.csv", index=False
+)
+target_check.to_csv(f"{adaptive_folder}/{args.model}_targets.csv", index=False)
+report = {
+    "model": args.model,
+    "engine": args.engine,
+    "engine_version": ENGINE_VERSION,
+    "targets": args.targets,
+    "targets_met": targets_met,
+    "batch_size": args.batch_size,
+    "batches": batch,
+    "individuals": cohort_size,
+}
+with open(f"{adaptive_folder}/{args.model}_report.json", "w") as f:
+    json.dump(report, f, indent=2)
+
+if targets_met:
+    print(f"targets met with {cohort_size} individuals")
+else:
+    print(f"targets not met with the largest cohort size ({cohort_size} individuals)")
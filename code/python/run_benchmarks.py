@@ -0,0 +1,373 @@
+import os
+import tempfile
+from argparse import ArgumentParser
+from functions import *
+from model_functions_social_framework import *
+from model_functions_standard import *
+from develop_cohort import develop_cohort
+from paired_functions import run_cohort_paired
+from benchmark_functions import *
+
+parser = ArgumentParser()
+parser.add_argument(
+    "--sizes",
+    dest="sizes",
+    type=int,
+    nargs="+",
+    default=[1000, 10000, 100000, 1000000, 10000000],
+    help="cohort sizes to benchmark",
+)
+parser.add_argument(
+    "--max-simulated",
+    dest="max_simulated",
+    type=int,
+    default=1000,
+    help="largest number of individuals to simulate; larger cohort sizes "
+    "benchmark the analysis and I/O stages on the simulated traces repeated "
+    "up to the cohort size",
+)
+parser.add_argument(
+    "--transition-calls",
+    dest="transition_calls",
+    type=int,
+    default=10000,
+    help="number of calls used to benchmark each transition generator",
+)
+parser.add_argument(
+    "--no-memory",
+    dest="track_memory",
+    action="store_false",
+    help="skip the peak memory measurements",
+)
+parser.add_argument(
+    "--compare",
+    dest="compare",
+    default=None,
+    help="saved benchmark (json) to compare the timings against",
+)
+
+args = parser.parse_args()
+
+# identify overall folder directory for reading/saving files
+current_directory = os.path.dirname(__file__)
+parent_directory = os.path.dirname(current_directory)
+overall_folder = os.path.dirname(parent_directory)
+
+models = {
+    "standard": {
+        "load_life_tables": load_life_tables_standard,
+        "generate_transitions_HS": generate_transitions_HS_standard,
+        "generate_transitions_DNH": generate_transitions_DNH_standard,
+        "run_cohort": run_cohort_standard,
+    },
+    "framework": {
+        "load_life_tables": load_life_tables_social_framework,
+        "generate_transitions_HS": generate_transitions_HS_social_framework,
+        "generate_transitions_DNH": generate_transitions_DNH_social_framework,
+        "run_cohort": run_cohort_social_framework,
+    },
+}
+DNH_trace_columns = ["Year" + str(x) for x in range(0, cycles + 1)]
+HS_trace_columns = ["HSYear" + str(x) for x in range(0, cycles + 1)]
+
+
+def compute_cohort_outcomes(total_trace, new_treatment):
+    # Function:
+    #   Computes the outcomes of every individual of a simulated total trace
+    # Args:
+    #   total_trace: total trace (output from run_cohort_standard or
+    #   run_cohort_social_framework)
+    #   new_treatment: new treatment (True or False)
+    # Returns:
+    #   list of outcome tuples (output from compute_outcomes)
+
+    HS_state_trace = total_trace[HS_trace_columns].to_numpy()
+    DNH_state_trace = total_trace[DNH_trace_columns].to_numpy()
+    start_ages = total_trace["starting_age"].to_numpy()
+    return [
+        compute_outcomes(
+            HS_state_trace[i], DNH_state_trace[i], new_treatment, start_ages[i]
+        )
+        for i in range(len(total_trace))
+    ]
+
+
+# random but fixed inputs for the transition generators
+rng = np.random.RandomState(1234)
+HS_inputs = list(
+    zip(
+        rng.choice(["OHS", "IHS", "DT", "DUT"], size=args.transition_calls),
+        rng.choice(["H", "S", "D"], size=args.transition_calls),
+    )
+)
+ages = [int(x) for x in rng.randint(starting_age, 101, size=args.transition_calls)]
+sexes = rng.choice(["F", "M"], size=args.transition_calls)
+races = rng.choice(["NHB", "NHW"], size=args.transition_calls)
+insurances = rng.choice(["Y", "N"], size=args.transition_calls)
+treatments = rng.choice([False, True], size=args.transition_calls)
+transition_inputs = {
+    "standard": {
+        "generate_transitions_HS": HS_inputs,
+        "generate_transitions_DNH": [
+            (hs, dnh, age, sex, race, nt)
+            for (hs, dnh), age, sex, race, nt in zip(
+                HS_inputs, ages, sexes, races, treatments
+            )
+        ],
+    },
+    "framework": {
+        "generate_transitions_HS": [
+            (hs, dnh, ins) for (hs, dnh), ins in zip(HS_inputs, insurances)
+        ],
+        "generate_transitions_DNH": [
+            (hs, dnh, age, sex, race, ins, nt)
+            for (hs, dnh), age, sex, race, ins, nt in zip(
+                HS_inputs, ages, sexes, races, insurances, treatments
+            )
+        ],
+    },
+}
+
+records = []
+
+# stages that do not depend on the cohort size
+for model, model_functions in models.items():
+    life_tables, seconds, memory = measure_stage(
+        model_functions["load_life_tables"], track_memory=args.track_memory
+    )
+    records.append(
+        benchmark_record(
+            "load_life_tables", model, None, 4, "life tables", seconds, memory
+        )
+    )
+    for generator in ["generate_transitions_HS", "generate_transitions_DNH"]:
+        result, seconds, memory = measure_stage(
+            time_transition_generator,
+            model_functions[generator],
+            transition_inputs[model][generator],
+            track_memory=args.track_memory,
+        )
+        records.append(
+            benchmark_record(
+                generator, model, None, args.transition_calls, "calls", seconds, memory
+            )
+        )
+
+    # sampling the next disease natural history state: np.random.choice on the
+    # transition probabilities of every call, as the reference engine used to,
+    # against the sampling table it uses now (sampling_functions.py), with the
+    # transition probabilities computed beforehand
+    generate_transitions = model_functions["generate_transitions_DNH"]
+    inputs = transition_inputs[model]["generate_transitions_DNH"]
+    table = create_sampling_table(["H", "S", "D"])
+    rows = [table_row(table, generate_transitions, *x) for x in inputs]
+    transitions = [generate_transitions(*x) for x in inputs]
+    draws = dict()
+    for sampler, sample, sample_args in [
+        ("sample_choice", time_choice_sampler, (transitions,)),
+        ("sample_table", time_table_sampler, (table, rows)),
+        ("sample_batch", time_batch_sampler, (table, rows)),
+    ]:
+        draws[sampler], seconds, memory = measure_stage(
+            sample, *sample_args, 1234, track_memory=args.track_memory
+        )
+        records.append(
+            benchmark_record(
+                sampler, model, None, args.transition_calls, "calls", seconds, memory
+            )
+        )
+    if not draws["sample_choice"] == draws["sample_table"] == draws["sample_batch"]:
+        raise ValueError(f"the samplers of the {model} model draw different states")
+
+simulated = {}
+with tempfile.TemporaryDirectory() as temporary_folder:
+    for size in args.sizes:
+        cohort, seconds, memory = measure_stage(
+            develop_cohort, size, track_memory=args.track_memory
+        )
+        records.append(
+            benchmark_record(
+                "develop_cohort", None, size, size, "individuals", seconds, memory
+            )
+        )
+
+        for model, model_functions in models.items():
+            # simulate up to max_simulated individuals of the cohort
+            n_simulated = min(size, args.max_simulated)
+            # person-cycles: individuals times the cycles of their traces,
+            # the same definition in every stage
+            simulated_person_cycles = n_simulated * (cycles + 1)
+            if simulated.get(model, (0,))[0] != n_simulated:
+                totals = {}
+                for arm, new_treatment in [("sc", False), ("nt", True)]:
+                    result, seconds, memory = measure_stage(
+                        model_functions["run_cohort"],
+                        new_treatment,
+                        cohort.iloc[:n_simulated],
+                        track_memory=args.track_memory,
+                    )
+                    totals[arm] = result[2]
+                    records.append(
+                        benchmark_record(
+                            f"cycle_loop_{arm}",
+                            model,
+                            size,
+                            simulated_person_cycles,
+                            "person-cycles",
+                            seconds,
+                            memory,
+                        )
+                    )
+                    result, seconds, memory = measure_stage(
+                        compute_cohort_outcomes,
+                        totals[arm],
+                        new_treatment,
+                        track_memory=args.track_memory,
+                    )
+                    records.append(
+                        benchmark_record(
+                            f"outcome_computation_{arm}",
+                            model,
+                            size,
+                            simulated_person_cycles,
+                            "person-cycles",
+                            seconds,
+                            memory,
+                        )
+                    )
+                # both arms at once with the paired engine (paired_functions.py)
+                result, seconds, memory = measure_stage(
+                    run_cohort_paired,
+                    model,
+                    cohort.iloc[:n_simulated],
+                    track_memory=args.track_memory,
+                )
+                records.append(
+                    benchmark_record(
+                        "cycle_loop_paired",
+                        model,
+                        size,
+                        2 * simulated_person_cycles,
+                        "person-cycles",
+                        seconds,
+                        memory,
+                    )
+                )
+                simulated[model] = (n_simulated, totals)
+
+            # analysis and I/O stages on traces of the full cohort size
+            totals = simulated[model][1]
+            total_trace_SC = tile_trace(totals["sc"], size)
+            total_trace_NT = tile_trace(totals["nt"], size)
+            person_cycles = size * (cycles + 1)
+
+            result, seconds, memory = measure_stage(
+                create_treatment_effect,
+                combine_treatment_arms(total_trace_SC, total_trace_NT),
+                track_memory=args.track_memory,
+            )
+            records.append(
+                benchmark_record(
+                    "create_treatment_effect",
+                    model,
+                    size,
+                    2 * person_cycles,
+                    "person-cycles",
+                    seconds,
+                    memory,
+                )
+            )
+            result, seconds, memory = measure_stage(
+                run_DNS_state_graph,
+                total_trace_SC[DNH_trace_columns],
+                track_memory=args.track_memory,
+            )
+            records.append(
+                benchmark_record(
+                    "run_DNS_state_graph",
+                    model,
+                    size,
+                    person_cycles,
+                    "person-cycles",
+                    seconds,
+                    memory,
+                )
+            )
+            result, seconds, memory = measure_stage(
+                run_HS_state_graph, total_trace_SC, track_memory=args.track_memory
+            )
+            records.append(
+                benchmark_record(
+                    "run_HS_state_graph",
+                    model,
+                    size,
+                    person_cycles,
+                    "person-cycles",
+                    seconds,
+                    memory,
+                )
+            )
+
+            path = f"{temporary_folder}/total_trace.csv"
+            result, seconds, memory = measure_stage(
+                total_trace_SC.to_csv,
+                path,
+                index=False,
+                track_memory=args.track_memory,
+            )
+            records.append(
+                benchmark_record(
+                    "write_results",
+                    model,
+                    size,
+                    person_cycles,
+                    "person-cycles",
+                    seconds,
+                    memory,
+                )
+            )
+            result, seconds, memory = measure_stage(
+                pd.read_csv, path, track_memory=args.track_memory
+            )
+            records.append(
+                benchmark_record(
+                    "read_results",
+                    model,
+                    size,
+                    person_cycles,
+                    "person-cycles",
+                    seconds,
+                    memory,
+                )
+            )
+
+path = save_benchmark(records, f"{overall_folder}/results/benchmarks")
+print(pd.DataFrame(records).to_string(index=False))
+# speedup of the sampling tables over np.random.choice
+records_df = pd.DataFrame(records)
+for model in models:
+    seconds = records_df[records_df["model"] == model].set_index("stage")["seconds"]
+    print(
+        f"{model} sampling speedup over np.random.choice: "
+        f"{seconds['sample_choice'] / seconds['sample_table']:.1f}x (one at a time), "
+        f"{seconds['sample_choice'] / seconds['sample_batch']:.1f}x (batched)"
+    )
+print(f"benchmark saved to {path}")
+
+# the paired engine simulates the cycles both arms share once; compare it with
+# running the two arms with the reference engine
+for (model, size), stages in records_df.groupby(["model", "cohort_size"]):
+    seconds = stages.set_index("stage")["seconds"]
+    if "cycle_loop_paired" not in seconds:
+        continue
+    reference_seconds = seconds["cycle_loop_sc"] + seconds["cycle_loop_nt"]
+    print(
+        f"{model} paired engine (cohort size {int(size)}): "
+        f"{seconds['cycle_loop_paired']:.2f} s for both arms "
+        f"(reference engine: {reference_seconds:.2f} s, "
+        f"{reference_seconds / seconds['cycle_loop_paired']:.1f}x)"
+    )
+
+if args.compare is not None:
+    comparison = compare_benchmarks(load_benchmark(args.compare), load_benchmark(path))
+    print(comparison.to_string(index=False))
@@ -0,0 +1,64 @@
+import os
+from argparse import ArgumentParser
+from functions import *
+from event_functions import *
+from shard_functions import *
+from bootstrap_functions import *
+
+parser = ArgumentParser()
+parser.add_argument(
+    "--replicates",
+    dest="replicates",
+    type=int,
+    default=1000,
+    help="number of bootstrap replicates",
+)
+parser.add_argument(
+    "--block-size",
+    dest="block_size",
+    type=int,
+    default=50,
+    help="replicates drawn at a time (memory grows with the block size times "
+    "the cohort size)",
+)
+parser.add_argument(
+    "--seed",
+    dest="seed",
+    type=int,
+    default=1234,
+    help="random seed of the bootstrap",
+)
+parser.add_argument(
+    "--jobs",
+    dest="jobs",
+    type=int,
+    default=1,
+    help="number of worker processes drawing blocks of replicates",
+)
+parser.add_argument(
+    "--trace-format",
+    dest="trace_format",
+    choices=TRACE_FORMATS,
+    default="dense",
+    help="format of the results written by run_model.py",
+)
+
+args = parser.parse_args()
+if args.replicates < 2:
+    parser.error("--replicates must be at least 2")
+if args.block_size < 1 or args.jobs < 1:
+    parser.error("--block-size and --jobs must be at least 1")
+
+# identify overall folder directory for reading/saving files
+current_directory = os.path.dirname(__file__)
+parent_directory = os.path.dirname(current_directory)
+overall_folder = os.path.dirname(parent_directory)
+
+results_folder = f"{overall_folder}/results"
+for model in MODELS:
+    trace = read_treatment_effect_trace(results_folder, model, args.trace_format)
+    bootstrap_df = bootstrap_treatment_effect(
+        trace, args.replicates, args.block_size, args.seed, args.jobs
+    )
+    bootstrap_df.to_csv(f"{results_folder}/{model}/bootstrap.csv", index=False)
+    print(f"wrote {model}/bootstrap.csv ({args.replicates} replicates)")
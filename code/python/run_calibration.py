@@ -0,0 +1,126 @@
+import os
+from argparse import ArgumentParser
+from functions import *
+from cohort_functions import read_cohort
+from calibration_functions import *
+
+parser = ArgumentParser()
+parser.add_argument(
+    "--targets",
+    dest="targets_path",
+    required=True,
+    help="csv file of calibration targets with the columns race, measure "
+    "(life_expectancy or prevalence), age, value and se",
+)
+parser.add_argument(
+    "--model",
+    dest="model",
+    choices=list(CALIBRATION_BOUNDS),
+    default="framework",
+    help="model to calibrate",
+)
+parser.add_argument(
+    "--parameter",
+    dest="parameters",
+    nargs="+",
+    default=None,
+    help="parameters to calibrate and their bounds as name=low:high (default: "
+    "every parameter of CALIBRATION_BOUNDS in calibration_functions.py)",
+)
+parser.add_argument(
+    "--samples",
+    dest="samples",
+    type=int,
+    default=1000,
+    help="candidates drawn by Latin hypercube sampling in every round",
+)
+parser.add_argument(
+    "--rounds",
+    dest="rounds",
+    type=int,
+    default=1,
+    help="rounds of sampling, each within the range of the accepted candidates",
+)
+parser.add_argument(
+    "--accept",
+    dest="accept",
+    type=float,
+    default=0.05,
+    help="share of the candidates with the best fit that is accepted",
+)
+parser.add_argument(
+    "--seed",
+    dest="seed",
+    type=int,
+    default=1234,
+    help="random seed of the sampling",
+)
+parser.add_argument(
+    "--jobs",
+    dest="jobs",
+    type=int,
+    default=1,
+    help="number of worker processes evaluating candidates",
+)
+parser.add_argument(
+    "--cohort",
+    dest="cohort_path",
+    default=None,
+    help="cohort whose characteristics are averaged over (default: "
+    "results/cohort.csv)",
+)
+
+args = parser.parse_args()
+if args.samples < 1 or args.rounds < 1 or args.jobs < 1:
+    parser.error("--samples, --rounds and --jobs must be at least 1")
+if not 0 < args.accept <= 1:
+    parser.error("--accept must be between 0 and 1")
+try:
+    targets_df = read_calibration_targets(args.targets_path)
+    bounds = None
+    if args.parameters is not None:
+        bounds = dict(parse_calibration_bounds(text) for text in args.parameters)
+except ValueError as error:
+    parser.error(str(error))
+if bounds is not None:
+    unknown = [name for name in bounds if name not in CALIBRATION_BOUNDS[args.model]]
+    if unknown:
+        parser.error(
+            f"the {args.model} model cannot calibrate {', '.join(unknown)} "
+            f"(parameters: {', '.join(CALIBRATION_BOUNDS[args.model])})"
+        )
+
+# identify overall folder directory for reading/saving files
+current_directory = os.path.dirname(__file__)
+parent_directory = os.path.dirname(current_directory)
+overall_folder = os.path.dirname(parent_directory)
+
+calibration_folder = f"{overall_folder}/results/calibration"
+os.makedirs(calibration_folder, exist_ok=True)
+
+population_df = read_cohort(args.cohort_path)
+candidates_df = run_calibration(
+    args.model,
+    targets_df,
+    bounds,
+    args.samples,
+    args.accept,
+    args.rounds,
+    args.seed,
+    args.jobs,
+    population_df,
+)
+candidates_df.to_csv(f"{calibration_folder}/{args.model}_candidates.csv", index=False)
+
+# outputs of the best candidate next to the targets
+parameters = [c for c in candidates_df.columns if c not in ["fit", "round", "accepted"]]
+best = candidates_df.iloc[0][parameters].to_dict()
+fit_df = targets_df.merge(
+    calibration_outputs(
+        args.model, best, calibration_groups(args.model, population_df)
+    ).rename(columns={"value": "model"}),
+    on=["race", "measure", "age"],
+    how="left",
+)
+fit_df.to_csv(f"{calibration_folder}/{args.model}_fit.csv", index=False)
+print(f"best fit {candidates_df['fit'].iloc[0]:.4g}: {best}")
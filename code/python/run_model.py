@@ -1,89 +1,326 @@
 import os
+import shutil
+from argparse import ArgumentParser
 from functions import *
 from model_functions_social_framework import *
 from model_functions_standard import *
+from shard_functions import *
+from checkpoint_functions import *
+from profiling_functions import *
+from markov_functions import *
+from event_functions import *
+from engine_functions import *
+from orchestration_functions import *
+from cohort_functions import *
+from summary_functions import *
+from append_functions import *
+from memory_functions import *
 
-# identify overall folder directory for reading/saving files
-current_directory = os.path.dirname(__file__)
-parent_directory = os.path.dirname(current_directory)
-overall_folder = os.path.dirname(parent_directory)
-
-# Runs the standard model with the standard of care
-# These functions are defined in model_functions_standard
-# SC: standard of care
-HS_state_trace_df_standard_SC, state_trace_df_standard_SC, total_trace_standard_SC = (
-    run_cohort_standard(False)
-)
-# Runs the standard model with the new treatment
-HS_state_trace_df_standard_NT, state_trace_df_standard_NT, total_trace_standard_NT = (
-    run_cohort_standard(True)
-)
-
-# make sure that results/standard folders exist
-if not os.path.exists(f"{overall_folder}/results/standard"):
-    os.makedirs(f"{overall_folder}/results/standard")
-    os.makedirs(f"{overall_folder}/results/standard/sc")
-    os.makedirs(f"{overall_folder}/results/standard/nt")
-
-# export the standard of care results (SC) as csv files into results/standard/sc
-HS_state_trace_df_standard_SC.to_csv(
-    f"{overall_folder}/results/standard/sc/HS_state.csv", index=False
+parser = ArgumentParser()
+parser.add_argument(
+    "--cohort",
+    dest="cohort_path",
+    default=None,
+    help="cohort to simulate, as a csv file or its binary equivalent (.npz, "
+    "see develop_cohort.py) (default: results/cohort.csv)",
 )
-state_trace_df_standard_SC.to_csv(
-    f"{overall_folder}/results/standard/sc/DNH_state.csv", index=False
+parser.add_argument(
+    "--shard-index",
+    dest="shard_index",
+    type=int,
+    default=None,
+    help="index k of the shard to run (0 to K - 1)",
 )
-total_trace_standard_SC.to_csv(
-    f"{overall_folder}/results/standard/sc/total_trace.csv", index=False
+parser.add_argument(
+    "--shard-count",
+    dest="shard_count",
+    type=int,
+    default=None,
+    help="total number of shards K the cohort is split into",
 )
-
-# export the new treatment results (NT) as csv files into results/standard/nt
-HS_state_trace_df_standard_NT.to_csv(
-    f"{overall_folder}/results/standard/nt/HS_state.csv", index=False
+parser.add_argument(
+    "--checkpoint-size",
+    dest="checkpoint_size",
+    type=int,
+    default=0,
+    help="save the completed chunks of this many individuals of every model arm "
+    "so an interrupted run can be resumed with --resume (default: 0, no "
+    "checkpoints)",
 )
-state_trace_df_standard_NT.to_csv(
-    f"{overall_folder}/results/standard/nt/DNH_state.csv", index=False
+parser.add_argument(
+    "--resume",
+    dest="resume",
+    action="store_true",
+    help="resume an interrupted run from its completed chunks",
 )
-total_trace_standard_NT.to_csv(
-    f"{overall_folder}/results/standard/nt/total_trace.csv", index=False
+parser.add_argument(
+    "--profile",
+    dest="profile",
+    action="store_true",
+    help="time each phase of the simulation loop and write results/profile.json",
 )
-
-# make sure that results/framework folders exist
-if not os.path.exists(f"{overall_folder}/results/framework"):
-    os.makedirs(f"{overall_folder}/results/framework")
-    os.makedirs(f"{overall_folder}/results/framework/sc")
-    os.makedirs(f"{overall_folder}/results/framework/nt")
-
-# Runs the model with our social factors framework and the standard of care 
-# These functions are defined in model_functions_social_framework
-(
-    HS_state_trace_df_social_framework_SC,
-    state_trace_df_social_framework_SC,
-    total_trace_social_framework_SC,
-) = run_cohort_social_framework(False)
-# Runs the model with our social factors framework and the new treatment
-(
-    HS_state_trace_df_social_framework_NT,
-    state_trace_df_social_framework_NT,
-    total_trace_social_framework_NT,
-) = run_cohort_social_framework(True)
-
-# export the standard of care results (SC) as csv files into Results/Standard/SC
-HS_state_trace_df_social_framework_SC.to_csv(
-    f"{overall_folder}/results/framework/sc/HS_state.csv", index=False
+parser.add_argument(
+    "--engine",
+    dest="engine",
+    default="reference",
+    help=f"simulation engine ({', '.join(ENGINES)})",
 )
-state_trace_df_social_framework_SC.to_csv(
-    f"{overall_folder}/results/framework/sc/DNH_state.csv", index=False
+parser.add_argument(
+    "--jobs",
+    dest="jobs",
+    type=int,
+    default=1,
+    help="number of model arms to run in parallel worker processes",
 )
-total_trace_social_framework_SC.to_csv(
-    f"{overall_folder}/results/framework/sc/total_trace.csv", index=False
+parser.add_argument(
+    "--trace-format",
+    dest="trace_format",
+    choices=TRACE_FORMATS,
+    default="dense",
+    help="write dense traces (HS_state.csv, DNH_state.csv, total_trace.csv), "
+    "an event log (events.csv) or unique trajectories with their counts "
+    "(trajectories.csv) for every model arm",
 )
-# export the new treatment results (NT) as csv files into Results/Standard/NT
-HS_state_trace_df_social_framework_NT.to_csv(
-    f"{overall_folder}/results/framework/nt/HS_state.csv", index=False
+parser.add_argument(
+    "--control-variates",
+    dest="control_variates",
+    action="store_true",
+    help="estimate the treatment effects with control variates whose expected "
+    "values are computed exactly with the Markov model",
 )
-state_trace_df_social_framework_NT.to_csv(
-    f"{overall_folder}/results/framework/nt/DNH_state.csv", index=False
+parser.add_argument(
+    "--append",
+    dest="append",
+    action="store_true",
+    help="only simulate the individuals added to the cohort since the last run "
+    "(develop_cohort.py --append) and merge them into its results",
 )
-total_trace_social_framework_NT.to_csv(
-    f"{overall_folder}/results/framework/nt/total_trace.csv", index=False
+parser.add_argument(
+    "--max-memory",
+    dest="max_memory",
+    type=float,
+    default=None,
+    help="memory budget in MB: simulate and write the cohort in chunks sized "
+    "to stay under it, and report the peak memory in results/memory.json "
+    "(default: simulate the whole cohort at once)",
 )
+
+args = parser.parse_args()
+if (args.shard_index is None) != (args.shard_count is None):
+    parser.error("--shard-index and --shard-count must be used together")
+if args.jobs < 1:
+    parser.error("--jobs must be at least 1")
+if args.checkpoint_size < 0:
+    parser.error("--checkpoint-size must be at least 0")
+if args.resume and args.checkpoint_size == 0:
+    # checkpoints cost a second write of every result, so runs opt in to them
+    parser.error("--resume needs the --checkpoint-size of the interrupted run")
+if args.engine not in ENGINES:
+    parser.error(f"unknown engine '{args.engine}' (available: {', '.join(ENGINES)})")
+if args.append and args.shard_count is not None:
+    parser.error("--append cannot be used with --shard-index and --shard-count")
+if args.append and args.control_variates and args.trace_format != "dense":
+    parser.error("--append with --control-variates needs --trace-format dense")
+if args.max_memory is not None and args.max_memory <= 0:
+    parser.error("--max-memory must be positive")
+if args.max_memory is not None and args.control_variates:
+    parser.error("--max-memory cannot be used with --control-variates")
+if args.max_memory is not None and args.trace_format == "unique":
+    # unique trajectories are combined across chunks by reading them whole
+    parser.error("--max-memory cannot be used with --trace-format unique")
+if args.max_memory is not None and args.jobs > 1:
+    # every worker process would hold its own copy of a chunk, outside of the
+    # memory measured to size the chunks
+    parser.error("--max-memory cannot be used with more than one job (--jobs)")
+
+# identify overall folder directory for reading/saving files
+current_directory = os.path.dirname(__file__)
+parent_directory = os.path.dirname(current_directory)
+overall_folder = os.path.dirname(parent_directory)
+
+cohort_path = args.cohort_path
+if cohort_path is None:
+    cohort_path = f"{overall_folder}/results/cohort.csv"
+population_df = read_cohort(cohort_path)
+cohort_df = population_df
+# the traces cover the youngest starting age of the whole cohort, so shards,
+# chunks and appended individuals all have the same trace columns
+# (definition in functions.py)
+try:
+    n_cycles = trace_cycles(cohort_df["starting_age"])
+except ValueError as error:
+    parser.error(str(error))
+results_folder = f"{overall_folder}/results"
+
+# when appending, only simulate the individuals added to the cohort since the
+# last run (definitions in append_functions.py)
+if args.append:
+    try:
+        population_df = appended_individuals(
+            cohort_df,
+            read_run_manifest(results_folder),
+            args.engine,
+            args.trace_format,
+            results_folder,
+        )
+    except ValueError as error:
+        parser.error(str(error))
+    if not os.path.exists(f"{results_folder}/{SUMMARY_FILE}"):
+        parser.error(f"--append needs the {SUMMARY_FILE} of the last run")
+
+# when running a shard, only simulate its individuals and write the
+# results into their own folder (combined later with merge_shards.py)
+if args.shard_count is not None:
+    population_df = get_shard(population_df, args.shard_index, args.shard_count)
+    results_folder = (
+        f"{overall_folder}/results/shards/"
+        f"{shard_folder_name(args.shard_index, args.shard_count)}"
+    )
+
+# completed chunks of every model arm are saved here until the run finishes
+# (with --checkpoint-size)
+checkpoints_folder = f"{results_folder}/checkpoints"
+cohort_hash = hash_file(cohort_path)
+
+# optional per-phase timers of the simulation loop of every model arm
+profilers = {
+    f"{model}/{arm}": create_profiler(n_cycles) if args.profile else None
+    for model, arm, new_treatment in ARM_RUNS
+}
+
+if args.max_memory is None:
+    # Runs the four model arms: the standard model and the model with our
+    # social factors framework, each with the standard of care (sc) and the new
+    # treatment (nt). These functions are defined in model_functions_standard
+    # and model_functions_social_framework (reference engine), engine_functions
+    # and orchestration_functions
+    arms = run_all_arms(
+        args.engine,
+        population_df,
+        checkpoints_folder,
+        args.checkpoint_size,
+        cohort_hash,
+        args.resume,
+        profilers,
+        args.jobs,
+        n_cycles,
+    )
+
+    # export the results of every model arm (definition in event_functions.py)
+    # e.g., standard model with the standard of care: results/standard/sc
+    for arm, (HS_state_trace_df, state_trace_df, total_trace) in arms.items():
+        write_traces(
+            f"{results_folder}/{arm}",
+            population_df,
+            HS_state_trace_df,
+            state_trace_df,
+            total_trace,
+            args.trace_format,
+            args.append,
+        )
+        if args.append and args.trace_format == "unique":
+            # trajectories of the new individuals already found are combined
+            trajectory_path = f"{results_folder}/{arm}/{TRAJECTORY_FILE}"
+            read_trajectories(trajectory_path).to_csv(trajectory_path, index=False)
+
+    # aggregate results for reports (definitions in summary_functions.py)
+    summary = create_summary(population_df, arms)
+else:
+    # the same, chunk by chunk within the memory budget: every chunk is
+    # written before the next is simulated (definitions in memory_functions.py)
+    try:
+        summary, memory_report = run_cohort_within_memory(
+            args.engine,
+            population_df,
+            args.max_memory,
+            results_folder,
+            args.trace_format,
+            args.append,
+            checkpoints_folder,
+            args.checkpoint_size,
+            cohort_hash,
+            args.resume,
+            profilers,
+            n_cycles,
+        )
+    except ValueError as error:
+        parser.error(str(error))
+if args.append:
+    summary = combine_summaries(
+        [read_summary(f"{results_folder}/{SUMMARY_FILE}"), summary]
+    )
+
+# all results are written, so the checkpoints are no longer needed
+if os.path.exists(checkpoints_folder):
+    shutil.rmtree(checkpoints_folder)
+
+# export the time spent in each phase of the simulation loop
+if args.profile:
+    write_profile_report(f"{results_folder}/profile.json", profilers)
+
+if args.shard_count is not None:
+    write_summary(f"{results_folder}/{SUMMARY_FILE}", summary)
+    # the manifest is written last: a shard without one is incomplete
+    write_shard_manifest(
+        results_folder,
+        create_shard_manifest(
+            population_df,
+            args.shard_index,
+            args.shard_count,
+            cohort_path,
+            args.trace_format,
+            args.engine,
+        ),
+    )
+else:
+    # export the treatment effect of the new treatment in each model
+    # (definitions in functions.py, markov_functions.py and
+    # trajectory_functions.py)
+    treatment_effects = dict()
+    for model in ["standard", "framework"]:
+        if args.max_memory is not None:
+            # read block by block (definition in streaming_functions.py)
+            treatment_effects[model] = stream_treatment_effect(
+                results_folder, model, memory_report["chunk_size"], args.trace_format
+            )
+        elif args.append and not args.control_variates:
+            # the treatment effect of the whole cohort, from its result files
+            treatment_effects[model] = create_treatment_effect(
+                read_treatment_effect_trace(results_folder, model, args.trace_format)
+            )
+        else:
+            if args.append:
+                total_trace_SC, total_trace_NT = read_total_traces(
+                    results_folder, model
+                )
+            else:
+                total_trace_SC = arms[f"{model}/sc"][2]
+                total_trace_NT = arms[f"{model}/nt"][2]
+            if args.control_variates:
+                total_trace_SC = add_control_variates(total_trace_SC, model, False)
+                total_trace_NT = add_control_variates(total_trace_NT, model, True)
+            trace = combine_treatment_arms(total_trace_SC, total_trace_NT)
+            if args.trace_format == "unique":
+                # evaluate each unique pair of trajectories once, weighted by
+                # its count
+                trace = deduplicate_treatment_effect_trace(trace)
+            treatment_effects[model] = create_treatment_effect(trace)
+        treatment_effects[model].to_csv(
+            f"{results_folder}/{model}/treatment_effect.csv", index=False
+        )
+    # small aggregate of all results, e.g., to render the manuscript from
+    write_summary(f"{results_folder}/{SUMMARY_FILE}", summary, treatment_effects)
+    # the manifest lets later runs append new individuals to these results
+    write_run_manifest(
+        results_folder, create_run_manifest(cohort_df, args.engine, args.trace_format)
+    )
+
+# export the peak memory of a memory-bounded run, at its very end
+if args.max_memory is not None:
+    memory_report["peak_memory_mb"] = peak_memory_mb()
+    write_memory_report(f"{results_folder}/{MEMORY_REPORT_FILE}", memory_report)
+    print(
+        f"peak memory {memory_report['peak_memory_mb']:.0f} MB "
+        f"(budget {args.max_memory:g} MB, {memory_report['chunks']} chunks of "
+        f"up to {memory_report['chunk_size']} individuals)"
+    )
@@ -0,0 +1,175 @@
+import os
+from argparse import ArgumentParser
+from functions import *
+from develop_cohort import develop_cohort, parse_oversampling
+from pipeline_functions import *
+
+parser = ArgumentParser()
+parser.add_argument(
+    "-n",
+    dest="cohort_size",
+    type=int,
+    default=None,
+    help="generate a cohort of this size chunk by chunk and write it to "
+    "results/cohort.csv (default: read results/cohort.csv)",
+)
+parser.add_argument(
+    "--stratified",
+    dest="stratified",
+    action="store_true",
+    help="allocate the strata of every generated chunk proportionally",
+)
+parser.add_argument(
+    "--antithetic",
+    dest="antithetic",
+    action="store_true",
+    help="generate individuals in antithetic pairs (even chunk size)",
+)
+parser.add_argument(
+    "--oversample",
+    dest="oversample",
+    nargs="+",
+    default=None,
+    help="oversampling rates of strata as race/sex/insurance/place=rate "
+    "(see develop_cohort.py)",
+)
+parser.add_argument(
+    "--ages",
+    dest="ages",
+    type=int,
+    nargs=2,
+    default=None,
+    metavar=("YOUNGEST", "OLDEST"),
+    help="draw the starting ages of the generated cohort uniformly between the "
+    "youngest and oldest age (see develop_cohort.py)",
+)
+parser.add_argument(
+    "--chunk-size",
+    dest="chunk_size",
+    type=int,
+    default=10000,
+    help="individuals per chunk",
+)
+parser.add_argument(
+    "--jobs",
+    dest="jobs",
+    type=int,
+    default=1,
+    help="number of worker processes simulating chunks",
+)
+parser.add_argument(
+    "--queue-depth",
+    dest="queue_depth",
+    type=int,
+    default=2,
+    help="maximum number of chunks waiting between two stages",
+)
+parser.add_argument(
+    "--engine",
+    dest="engine",
+    default="reference",
+    help=f"simulation engine ({', '.join(ENGINES)})",
+)
+parser.add_argument(
+    "--trace-format",
+    dest="trace_format",
+    choices=TRACE_FORMATS,
+    default="dense",
+    help="format of the results of every model arm (see run_model.py)",
+)
+parser.add_argument(
+    "--control-variates",
+    dest="control_variates",
+    action="store_true",
+    help="estimate the treatment effects with control variates",
+)
+
+args = parser.parse_args()
+if args.chunk_size < 1 or args.jobs < 1 or args.queue_depth < 1:
+    parser.error("--chunk-size, --jobs and --queue-depth must be at least 1")
+if args.engine not in ENGINES:
+    parser.error(f"unknown engine '{args.engine}' (available: {', '.join(ENGINES)})")
+if args.cohort_size is None and (
+    args.stratified
+    or args.antithetic
+    or args.oversample is not None
+    or args.ages is not None
+):
+    parser.error("--stratified, --antithetic, --oversample and --ages need -n")
+if args.ages is not None and not 0 <= args.ages[0] <= args.ages[1] <= 100:
+    parser.error("starting ages must be between 0 and 100, youngest first")
+if args.antithetic and args.chunk_size % 2 != 0:
+    parser.error("--antithetic needs an even --chunk-size")
+oversampling = None
+if args.oversample is not None:
+    try:
+        oversampling = parse_oversampling(args.oversample)
+    except ValueError as error:
+        parser.error(str(error))
+if args.cohort_size is not None and (args.stratified or oversampling is not None):
+    # every chunk, including the smallest (last) one, needs one individual (or
+    # antithetic pair) per stratum
+    smallest_chunk = args.cohort_size % args.chunk_size or min(
+        args.chunk_size, args.cohort_size
+    )
+    try:
+        develop_cohort(
+            smallest_chunk,
+            stratified=args.stratified,
+            antithetic=args.antithetic,
+            oversampling=oversampling,
+        )
+    except ValueError as error:
+        parser.error(f"chunks of {smallest_chunk} individuals: {error}")
+
+# identify overall folder directory for reading/saving files
+current_directory = os.path.dirname(__file__)
+parent_directory = os.path.dirname(current_directory)
+overall_folder = os.path.dirname(parent_directory)
+
+results_folder = f"{overall_folder}/results"
+cohort_path = f"{results_folder}/cohort.csv"
+os.makedirs(results_folder, exist_ok=True)
+
+# generate the cohort chunk by chunk, or stream an existing cohort file
+# (definitions in pipeline_functions.py). The traces of every chunk cover the
+# youngest starting age of the cohort (trace_cycles in functions.py): the
+# youngest age that can be drawn, or the youngest age of the cohort file
+if args.cohort_size is not None:
+    chunks = generated_cohort_chunks(
+        args.cohort_size,
+        args.chunk_size,
+        stratified=args.stratified,
+        antithetic=args.antithetic,
+        oversampling=oversampling,
+        ages=args.ages,
+    )
+    written_cohort_path = cohort_path
+    n_cycles = trace_cycles([starting_age if args.ages is None else args.ages[0]])
+else:
+    chunks = csv_cohort_chunks(cohort_path, args.chunk_size)
+    written_cohort_path = None
+    try:
+        n_cycles = trace_cycles(
+            pd.read_csv(cohort_path, usecols=["starting_age"])["starting_age"]
+        )
+    except ValueError as error:
+        parser.error(str(error))
+
+treatment_effects = run_pipeline(
+    chunks,
+    results_folder,
+    args.engine,
+    args.trace_format,
+    args.jobs,
+    args.queue_depth,
+    written_cohort_path,
+    args.control_variates,
+    n_cycles,
+)
+
+# export the treatment effect of the new treatment in each model
+for model, treatment_effect_df in treatment_effects.items():
+    treatment_effect_df.to_csv(
+        f"{results_folder}/{model}/treatment_effect.csv", index=False
+    )
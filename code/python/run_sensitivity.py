@@ -0,0 +1,59 @@
+import os
+from argparse import ArgumentParser
+from functions import *
+from cohort_functions import read_cohort
+from sensitivity_functions import *
+
+parser = ArgumentParser()
+parser.add_argument(
+    "--parameter",
+    dest="parameters",
+    nargs="+",
+    required=True,
+    help="parameter values as name=v1,v2,... or name=start:stop:number, one "
+    "parameter varied at a time (e.g., rrOI_no_ins=0.1:1:10 "
+    f"treatment_HR_NT=0.1,0.25,0.5); parameters: {', '.join(SENSITIVITY_PARAMETERS)}",
+)
+parser.add_argument(
+    "--model",
+    dest="models",
+    nargs="+",
+    choices=["standard", "framework"],
+    default=["standard", "framework"],
+    help="models to analyze",
+)
+parser.add_argument(
+    "--cohort",
+    dest="cohort_path",
+    default=None,
+    help="cohort to simulate (default: results/cohort.csv)",
+)
+parser.add_argument(
+    "--threshold-column",
+    dest="threshold_column",
+    default="discounted_QALY",
+    help="outcome whose racial gap in the treatment effect is searched for "
+    "sign changes",
+)
+
+args = parser.parse_args()
+try:
+    points = [point for text in args.parameters for point in parse_parameter_grid(text)]
+except ValueError as error:
+    parser.error(str(error))
+
+# identify overall folder directory for reading/saving files
+current_directory = os.path.dirname(__file__)
+parent_directory = os.path.dirname(current_directory)
+overall_folder = os.path.dirname(parent_directory)
+
+population_df = read_cohort(args.cohort_path)
+sensitivity_df = pd.concat(
+    [run_sensitivity(model, points, population_df) for model in args.models],
+    ignore_index=True,
+)
+sensitivity_df.to_csv(f"{overall_folder}/results/{SENSITIVITY_FILE}", index=False)
+sensitivity_thresholds(sensitivity_df, args.threshold_column).to_csv(
+    f"{overall_folder}/results/{THRESHOLD_FILE}", index=False
+)
+print(f"wrote {SENSITIVITY_FILE} ({len(points) + 1} grid points per model)")
@@ -0,0 +1,133 @@
+from bisect import bisect_right
+import numpy as np
+
+# Categorical sampling from precomputed cumulative distribution tables. A table
+# holds one row per distinct transition probability array of a run, indexed by
+# a transition-row id, so the probabilities of a row are computed and summed
+# once instead of in every cycle of every individual. The draws invert the
+# cumulative distribution exactly as np.random.choice does, with one uniform
+# draw each, so they reproduce its random stream state by state
+
+
+def cumulative_distribution(transitions):
+    # Function:
+    #   Computes the normalized cumulative distribution of transition
+    #   probabilities, as np.random.choice does before sampling
+    # Args:
+    #   transitions: array of transition probabilities (... x states)
+    # Returns:
+    #   array of cumulative probabilities whose last value is 1 (... x states)
+
+    cdf = np.cumsum(transitions, axis=-1, dtype=float)
+    cdf /= cdf[..., -1:]
+    return cdf
+
+
+def draw_index(cdf, antithetic=False):
+    # Function:
+    #   Samples one state from a cumulative distribution with one uniform draw
+    #   u of the global random state. The antithetic member of a pair of
+    #   individuals sharing a random seed uses 1 - u
+    # Args:
+    #   cdf: cumulative distribution (list or array, output from
+    #   cumulative_distribution)
+    #   antithetic: whether to use the antithetic draw (True or False)
+    # Returns:
+    #   index of the sampled state
+
+    u = np.random.random_sample()
+    if antithetic:
+        u = 1 - u
+    return min(bisect_right(cdf, u), len(cdf) - 1)
+
+
+def table_state(table, row, u):
+    # Function:
+    #   Finds the state of a row of a sampling table at a given uniform draw,
+    #   e.g., to sample several transitions with the same draw
+    # Args:
+    #   table: sampling table (output from create_sampling_table)
+    #   row: row id (output from table_row)
+    #   u: uniform draw
+    # Returns:
+    #   integer code of the state (its index in the table's states)
+
+    cdf = table["cdf"][row]
+    return min(bisect_right(cdf, u), len(cdf) - 1)
+
+
+def create_sampling_table(states):
+    # Function:
+    #   Creates an empty table of cumulative distributions over a list of states
+    # Args:
+    #   states: list of states (e.g., ["H", "S", "D"])
+    # Returns:
+    #   dictionary with the states, the row id of every transition key and the
+    #   cumulative distribution of every row (as lists, the fastest to search
+    #   one value at a time)
+
+    return {"states": list(states), "rows": {}, "cdf": []}
+
+
+def table_row(table, generate_transitions, *key):
+    # Function:
+    #   Finds the row of a transition key in a sampling table, computing its
+    #   cumulative distribution the first time the key is seen
+    # Args:
+    #   table: sampling table (output from create_sampling_table)
+    #   generate_transitions: transition probability function
+    #   (e.g., generate_transitions_HS_standard)
+    #   key: arguments of generate_transitions, which the transition
+    #   probabilities depend on only
+    # Returns:
+    #   row id of the transition probabilities
+
+    row = table["rows"].get(key)
+    if row is None:
+        row = len(table["cdf"])
+        table["cdf"].append(
+            cumulative_distribution(generate_transitions(*key)).tolist()
+        )
+        table["rows"][key] = row
+    return row
+
+
+def draw_state(table, row, antithetic=False):
+    # Function:
+    #   Samples the next state of one individual from a row of a sampling table
+    # Args:
+    #   table: sampling table (output from create_sampling_table)
+    #   row: row id (output from table_row)
+    #   antithetic: whether to use the antithetic draw (True or False)
+    # Returns:
+    #   integer code of the next state (its index in the table's states)
+
+    return draw_index(table["cdf"][row], antithetic)
+
+
+def cumulative_table(table):
+    # Function:
+    #   Stacks the rows of a sampling table into one array for batched draws
+    # Args:
+    #   table: sampling table (output from create_sampling_table)
+    # Returns:
+    #   array of cumulative distributions (rows x states)
+
+    return np.array(table["cdf"], dtype=float).reshape(-1, len(table["states"]))
+
+
+def sample_rows(cdf_table, rows, uniforms):
+    # Function:
+    #   Samples the next state of many individuals at once by inverting the
+    #   cumulative distributions of their rows, as draw_state does for one
+    #   individual
+    # Args:
+    #   cdf_table: array of cumulative distributions (rows x states, output from
+    #   cumulative_table or cumulative_distribution)
+    #   rows: array of row ids (...)
+    #   uniforms: array of uniform draws (...)
+    # Returns:
+    #   array of integer codes of the next states (...)
+
+    next_states = (cdf_table[rows] <= uniforms[..., None]).sum(axis=-1)
+    return np.minimum(next_states, cdf_table.shape[-1] - 1)
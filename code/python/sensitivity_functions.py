@@ -0,0 +1,458 @@
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+from functions import *
+import model_functions_standard
+import model_functions_social_framework
+from markov_functions import HS_STATES, DNH_STATES, MODEL_CHARACTERISTICS
+from paired_functions import generate_transitions
+from cohort_functions import read_cohort, stratum_index, stratum_characteristics
+
+# parameters varied by the sensitivity analysis and what they change: the
+# health system ("HS") or disease natural history ("DNH") transitions, or only
+# the outcomes
+SENSITIVITY_PARAMETERS = {
+    "pOI": "HS",
+    "rrOI_no_ins": "HS",
+    "pDT": "HS",
+    "rrDT_no_ins": "HS",
+    "pDTUT": "HS",
+    "rrDTUT_no_ins": "HS",
+    "pHS": "DNH",
+    "rr_SD_not_dt": "DNH",
+    "treatment_HR_SC": "DNH",
+    "treatment_HR_NT": "DNH",
+    "COST_DT_SC": "outcomes",
+    "COST_DT_NT": "outcomes",
+}
+# probabilities of the social framework model derived from a probability of the
+# insured and the rate ratio of the uninsured (as in functions.py)
+NO_INSURANCE_RATIOS = {
+    "pOI": "rrOI_no_ins",
+    "pDT": "rrDT_no_ins",
+    "pDTUT": "rrDTUT_no_ins",
+}
+# grid point of the base case (every parameter at its value in functions.py)
+BASE_POINT = ("base", np.nan)
+SENSITIVITY_FILE = "sensitivity.csv"
+THRESHOLD_FILE = "sensitivity_thresholds.csv"
+
+# transition tables already computed, by table, model, treatment, varied
+# parameter and characteristics
+sensitivity_cache = dict()
+
+
+def parse_parameter_grid(text):
+    # Function:
+    #   Parses the values of one parameter of a one-way sensitivity analysis
+    # Args:
+    #   text: "name=v1,v2,..." or "name=start:stop:number" (evenly spaced
+    #   values), e.g. "rrOI_no_ins=0.1:1:10"
+    # Returns:
+    #   list of (name, value) grid points (raises ValueError if malformed)
+
+    name, _, values = text.partition("=")
+    if name not in SENSITIVITY_PARAMETERS:
+        raise ValueError(
+            f"unknown parameter '{name}' (available: "
+            f"{', '.join(SENSITIVITY_PARAMETERS)})"
+        )
+    try:
+        if ":" in values:
+            start, stop, number = values.split(":")
+            grid = np.linspace(float(start), float(stop), int(number)).tolist()
+        else:
+            grid = [float(value) for value in values.split(",")]
+    except ValueError:
+        raise ValueError(
+            f"invalid values in '{text}' (expected name=v1,v2,... or "
+            "name=start:stop:number)"
+        )
+    if not grid:
+        raise ValueError(f"no values in '{text}'")
+    return [(name, value) for value in grid]
+
+
+def model_parameter_overrides(parameters):
+    # Function:
+    #   Model parameters changed by setting several parameters at once,
+    #   including the probabilities of the uninsured derived from them
+    # Args:
+    #   parameters: dictionary of parameter names (keys of
+    #   SENSITIVITY_PARAMETERS) and values
+    # Returns:
+    #   dictionary of parameter names and values
+
+    overrides = dict(parameters)
+    for probability, ratio in NO_INSURANCE_RATIOS.items():
+        if probability in parameters or ratio in parameters:
+            p_ins = parameters.get(probability, globals()[probability])
+            rr = parameters.get(ratio, globals()[ratio])
+            overrides[f"{probability}_ins"] = p_ins
+            overrides[f"{probability}_no_ins"] = convert_to_prob(
+                convert_to_rate(p_ins) * rr
+            )
+    return overrides
+
+
+def parameter_overrides(name, value):
+    # Function:
+    #   Model parameters changed by setting one parameter, including the
+    #   probabilities of the uninsured derived from it
+    # Args:
+    #   name: parameter name (a key of SENSITIVITY_PARAMETERS, or "base")
+    #   value: parameter value
+    # Returns:
+    #   dictionary of parameter names and values
+
+    if name == BASE_POINT[0]:
+        return dict()
+    return model_parameter_overrides({name: value})
+
+
+@contextmanager
+def model_parameters(overrides):
+    # Function:
+    #   Temporarily sets parameters of the transition functions of both models
+    #   (model_functions_standard.py and model_functions_social_framework.py)
+    # Args:
+    #   overrides: dictionary of parameter names and values (output from
+    #   parameter_overrides)
+    # Returns:
+    #   context manager restoring the original values on exit
+
+    modules = [model_functions_standard, model_functions_social_framework]
+    saved = [
+        (module, name, getattr(module, name))
+        for module in modules
+        for name in overrides
+        if hasattr(module, name)
+    ]
+    try:
+        for module, name, _ in saved:
+            setattr(module, name, overrides[name])
+        yield
+    finally:
+        for module, name, value in saved:
+            setattr(module, name, value)
+
+
+def transition_table(model, table, age, characteristics, new_treatment):
+    # Function:
+    #   Transition probabilities of one table from every current (health
+    #   system, disease natural history) state, at the current parameters
+    # Args:
+    #   model: "standard" or "framework"
+    #   table: "HS" (health system) or "DNH" (disease natural history)
+    #   age: current age
+    #   characteristics: dictionary of the characteristics in
+    #   MODEL_CHARACTERISTICS[model]
+    #   new_treatment: new treatment (True or False)
+    # Returns:
+    #   array (HS states x DNH states x next states)
+
+    return np.array(
+        [
+            [
+                generate_transitions(
+                    model, h, d, age, characteristics, new_treatment
+                )[0 if table == "HS" else 1]
+                for d in DNH_STATES
+            ]
+            for h in HS_STATES
+        ],
+        dtype=float,
+    )
+
+
+def sensitivity_tables(model, new_treatment, point, strata, ages):
+    # Function:
+    #   Health system and disease natural history transition probabilities of
+    #   every stratum, age and current (health system, disease natural history)
+    #   state at one grid point, from the transition functions of the model.
+    #   Tables a parameter does not change are shared with the base case
+    # Args:
+    #   model: "standard" or "framework"
+    #   new_treatment: new treatment (True or False)
+    #   point: (name, value) grid point
+    #   strata: array of stratum indices (stratum_index in cohort_functions.py)
+    #   ages: array of ages
+    # Returns:
+    #   HS_table: array (strata x ages x HS states x DNH states x HS states)
+    #   DNH_table: array (strata x ages x HS states x DNH states x DNH states)
+
+    tables = []
+    for table, states in [("HS", HS_STATES), ("DNH", DNH_STATES)]:
+        # only the parameters changing this table make it differ from the base
+        if SENSITIVITY_PARAMETERS.get(point[0]) == table:
+            varied = point
+        else:
+            varied = BASE_POINT
+        values = np.zeros(
+            (len(strata), len(ages), len(HS_STATES), len(DNH_STATES), len(states))
+        )
+        for s, stratum in enumerate(strata):
+            characteristics = stratum_characteristics(stratum)
+            key = (table, model, bool(new_treatment)) + tuple(
+                characteristics[c] for c in MODEL_CHARACTERISTICS[model][:-1]
+            )
+            if varied != BASE_POINT:
+                key += varied
+            cached = sensitivity_cache.setdefault(key, dict())
+            with model_parameters(parameter_overrides(*varied)):
+                # health system transitions do not depend on age
+                for age in ages if table == "DNH" else ages[:1]:
+                    if int(age) not in cached:
+                        cached[int(age)] = transition_table(
+                            model, table, int(age), characteristics, new_treatment
+                        )
+            if table == "DNH":
+                values[s] = np.stack([cached[int(age)] for age in ages])
+            else:
+                values[s] = cached[int(ages[0])]
+        tables.append(values)
+    return tables
+
+
+def cohort_uniforms(population_df):
+    # Function:
+    #   Uniform draws of every individual in the order of the reference engine
+    #   (run_cohort_standard and run_cohort_social_framework): the health
+    #   system and then the disease natural history draw of every cycle, from
+    #   the individual's own random seed (1 - u for antithetic individuals)
+    # Args:
+    #   population_df: cohort dataframe
+    # Returns:
+    #   array of uniform draws (individuals x trace cycles x 2, trace_cycles in
+    #   functions.py)
+
+    n_cycles = trace_cycles(population_df["starting_age"])
+    uniforms = np.zeros((len(population_df), n_cycles, 2))
+    seeds = population_df["seed"].to_numpy()
+    for i, seed in enumerate(seeds):
+        np.random.seed(seed)
+        uniforms[i] = np.random.random_sample((n_cycles, 2))
+    if "antithetic" in population_df.columns:
+        antithetic = (population_df["antithetic"] == 1).to_numpy()
+        uniforms[antithetic] = 1 - uniforms[antithetic]
+    return uniforms
+
+
+def sample_states(transitions, uniforms):
+    # Function:
+    #   Samples the next state of many individuals at once by inverting the
+    #   cumulative distribution of their transition probabilities, as
+    #   sample_state does for one individual
+    # Args:
+    #   transitions: array of transition probabilities (... x states)
+    #   uniforms: array of uniform draws (...)
+    # Returns:
+    #   array of indices of the next states (...)
+
+    cdf = cumulative_distribution(transitions)
+    next_states = (cdf <= uniforms[..., None]).sum(axis=-1)
+    return np.minimum(next_states, transitions.shape[-1] - 1)
+
+
+def simulate_grid(model, new_treatment, population_df, points, uniforms):
+    # Function:
+    #   Simulates a cohort at every grid point at once, with the grid points as
+    #   an extra dimension of the states. Every individual uses the same
+    #   uniform draws at every grid point (common random numbers), so the base
+    #   case matches the reference engine and differences between grid points
+    #   come from the parameters, not from sampling noise
+    # Args:
+    #   model: "standard" or "framework"
+    #   new_treatment: new treatment (True or False)
+    #   population_df: cohort dataframe
+    #   points: list of (name, value) grid points
+    #   uniforms: uniform draws of the cohort (output from cohort_uniforms)
+    # Returns:
+    #   dictionary mapping each of OUTCOME_COLUMNS to an array of outcomes
+    #   (grid points x individuals), as computed by compute_outcomes
+
+    N = len(population_df)
+    strata, stratum_rows = np.unique(stratum_index(population_df), return_inverse=True)
+    starting_ages = population_df["starting_age"].to_numpy(dtype=int)
+    # every individual is simulated until age 101 (definition in functions.py)
+    horizons = individual_horizons(starting_ages)
+    ages = np.arange(starting_ages.min(), 101)
+    tables = [
+        sensitivity_tables(model, new_treatment, point, strata, ages)
+        for point in points
+    ]
+    HS_tables = np.stack([HS_table for HS_table, DNH_table in tables])
+    DNH_tables = np.stack([DNH_table for HS_table, DNH_table in tables])
+    grid = np.arange(len(points))[:, None]
+    if model == "standard":
+        # everyone starts in the health system
+        initial_HS = np.full(N, HS_STATES.index("IHS"))
+    else:
+        initial_HS = np.array([HS_STATES.index(p) for p in population_df["place"]])
+
+    COST_DT_name = "COST_DT_NT" if new_treatment else "COST_DT_SC"
+    COST_DT = np.array(
+        [
+            parameter_overrides(*point).get(COST_DT_name, globals()[COST_DT_name])
+            for point in points
+        ]
+    )[:, None]
+    LY = np.array([mapping[d] for d in DNH_STATES], dtype=float)
+    QALY = np.array([QALY_mapping[d] for d in DNH_STATES], dtype=float)
+    COST = np.array([COST_mapping[d] for d in DNH_STATES], dtype=float)
+    sick, treated = DNH_STATES.index("S"), HS_STATES.index("DT")
+
+    HS = np.repeat(initial_HS[None, :], len(points), axis=0)
+    DNH = np.zeros((len(points), N), dtype=int)
+    totals = {
+        c: np.zeros((len(points), N))
+        for c in [
+            "years_to_death",
+            "discounted_LY",
+            "QALY",
+            "discounted_QALY",
+            "cost",
+            "discounted_cost",
+            "years_sick",
+            "years_sick_treated",
+        ]
+    }
+    ever_treated = np.zeros((len(points), N), dtype=bool)
+    n_cycles = uniforms.shape[1]
+    for t in range(n_cycles + 1):
+        # outcomes of the states of cycle t
+        sick_treated = (DNH == sick) & (HS == treated)
+        cost = COST[DNH] + COST_DT * sick_treated
+        for column, value in [
+            ("years_to_death", LY[DNH]),
+            ("QALY", QALY[DNH]),
+            ("cost", cost),
+        ]:
+            totals[column] += value
+        totals["discounted_LY"] += LY[DNH] * v_disc[t]
+        totals["discounted_QALY"] += QALY[DNH] * v_disc[t]
+        totals["discounted_cost"] += cost * v_disc[t]
+        totals["years_sick"] += DNH == sick
+        totals["years_sick_treated"] += sick_treated
+        ever_treated |= HS == treated
+        if t == n_cycles:
+            break
+        # both states of cycle t + 1 are drawn from the states of cycle t, for
+        # the individuals within their horizon (the others keep their states)
+        active = np.flatnonzero(horizons > t)
+        age_rows = starting_ages[active] + t - ages[0]
+        HS_active, DNH_active = HS[:, active], DNH[:, active]
+        HS_transitions = HS_tables[
+            grid, stratum_rows[active], age_rows, HS_active, DNH_active
+        ]
+        DNH_transitions = DNH_tables[
+            grid, stratum_rows[active], age_rows, HS_active, DNH_active
+        ]
+        HS[:, active] = sample_states(HS_transitions, uniforms[active, t, 0])
+        DNH[:, active] = sample_states(DNH_transitions, uniforms[active, t, 1])
+
+    outcomes = dict(totals)
+    outcomes["death_age"] = starting_ages + totals["years_to_death"]
+    outcomes["years_sick_untreated"] = (
+        totals["years_sick"] - totals["years_sick_treated"]
+    )
+    outcomes["was_sick"] = (totals["years_sick"] > 0).astype(int)
+    outcomes["was_treated"] = ever_treated.astype(int)
+    return {c: outcomes[c] for c in OUTCOME_COLUMNS}
+
+
+def run_sensitivity(model, points, population_df=None):
+    # Function:
+    #   One-way sensitivity analysis of one model: the treatment effect table
+    #   at every grid point, from one vectorized simulation of both treatment
+    #   arms of a shared cohort (simulate_grid)
+    # Args:
+    #   model: "standard" or "framework"
+    #   points: list of (name, value) grid points (e.g., from
+    #   parse_parameter_grid); the base case is added first
+    #   population_df: cohort to simulate (defaults to results/cohort.csv)
+    # Returns:
+    #   pandas dataframe with the model, parameter and value of every grid point
+    #   followed by its create_treatment_effect table
+
+    if model not in MODEL_CHARACTERISTICS:
+        raise ValueError(f"unknown model '{model}' (expected standard or framework)")
+    if population_df is None:
+        population_df = read_cohort()
+    points = [BASE_POINT] + [point for point in points if point != BASE_POINT]
+    uniforms = cohort_uniforms(population_df)
+    cohort_columns = [
+        c
+        for c in ["race", "stratum", "antithetic_pair", "weight"]
+        if c in population_df.columns
+    ]
+    arms = [
+        simulate_grid(model, new_treatment, population_df, points, uniforms)
+        for new_treatment in [False, True]
+    ]
+    sensitivity_arr = []
+    for g, (name, value) in enumerate(points):
+        total_traces = []
+        for outcomes in arms:
+            total_trace = population_df[cohort_columns].copy()
+            for column in OUTCOME_COLUMNS:
+                total_trace[column] = outcomes[column][g]
+            total_traces.append(total_trace)
+        treatment_effect_df = create_treatment_effect(
+            combine_treatment_arms(*total_traces)
+        )
+        treatment_effect_df.insert(0, "value", value)
+        treatment_effect_df.insert(0, "parameter", name)
+        treatment_effect_df.insert(0, "model", model)
+        sensitivity_arr.append(treatment_effect_df)
+    return pd.concat(sensitivity_arr, ignore_index=True)
+
+
+def sensitivity_thresholds(sensitivity_df, column="discounted_QALY", statistic="Diff"):
+    # Function:
+    #   Finds the parameter values at which the racial gap (NHB - NHW) of a
+    #   statistic changes sign (e.g., the new treatment stops benefiting one
+    #   race group more than the other), interpolating linearly between the
+    #   grid points around every sign change. Grid points where the gap is 0
+    #   are thresholds only between gaps of opposite signs
+    # Args:
+    #   sensitivity_df: output from run_sensitivity
+    #   column: outcome column of the treatment effect table
+    #   statistic: "SC", "NT" or "Diff"
+    # Returns:
+    #   pandas dataframe with the model, parameter, column, statistic and
+    #   threshold value of every sign change
+
+    rows = sensitivity_df[
+        (sensitivity_df["column"] == column)
+        & (sensitivity_df["parameter"] != BASE_POINT[0])
+    ]
+    gaps = rows.pivot_table(
+        index=["model", "parameter", "value"],
+        columns="race",
+        values=f"{statistic} mean",
+    )
+    gaps = (gaps["NHB"] - gaps["NHW"]).rename("gap").reset_index()
+    threshold_arr = []
+    for (model, name), group in gaps.groupby(["model", "parameter"], sort=False):
+        group = group.sort_values("value")
+        values = group["value"].to_numpy()
+        gap = group["gap"].to_numpy()
+        # grid points where the gap is exactly 0 are only thresholds between
+        # gaps of opposite signs (e.g., not where both arms have no effect)
+        nonzero = np.flatnonzero(gap != 0)
+        for k, j in zip(nonzero[:-1], nonzero[1:]):
+            if not gap[k] * gap[j] < 0:
+                continue
+            if j == k + 1:
+                threshold = values[k] + (values[j] - values[k]) * gap[k] / (
+                    gap[k] - gap[j]
+                )
+            else:
+                # middle of the grid points with a gap of 0
+                threshold = (values[k + 1] + values[j - 1]) / 2
+            threshold_arr.append([model, name, column, statistic, threshold])
+    return pd.DataFrame(
+        threshold_arr,
+        columns=["model", "parameter", "column", "statistic", "threshold"],
+    )
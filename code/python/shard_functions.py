@@ -0,0 +1,419 @@
+import hashlib
+import json
+import os
+import pandas as pd
+import numpy as np
+from functions import *
+from event_functions import *
+from cohort_functions import cohort_file_size
+from summary_functions import *
+from streaming_functions import *
+
+# identify overall folder directory for reading/saving files
+current_directory = os.path.dirname(__file__)
+parent_directory = os.path.dirname(current_directory)
+overall_folder = os.path.dirname(parent_directory)
+
+# models and treatment arms written by run_model.py (their files are listed by
+# trace_files in event_functions.py)
+MODELS = ["standard", "framework"]
+ARMS = ["sc", "nt"]
+MANIFEST_FILE = "manifest.json"
+
+# columns of the total trace needed by create_treatment_effect
+TREATMENT_EFFECT_COLUMNS = [
+    "race",
+    "years_to_death",
+    "discounted_LY",
+    "QALY",
+    "discounted_QALY",
+    "cost",
+    "discounted_cost",
+    "years_sick_treated",
+    "years_sick_untreated",
+    "years_sick",
+    "was_sick",
+    "was_treated",
+]
+
+
+def hash_file(path):
+    # Function:
+    #   Computes the SHA-256 hash of a file, reading it in blocks so that
+    #   large cohort and trace files never have to fit in memory
+    # Args:
+    #   path: path to the file
+    # Returns:
+    #   hexadecimal SHA-256 digest
+
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def scenario_parameters():
+    # Function:
+    #   Collects the model parameters (defined in functions.py) that determine
+    #   the simulated trajectories and outcomes of a cohort
+    # Args:
+    #   None
+    # Returns:
+    #   dictionary of parameter names and values
+
+    return {
+        "starting_age": starting_age,
+        "cycles": cycles,
+        "HAZARD_RATIO": HAZARD_RATIO,
+        "NHW_non_insurance_prop": NHW_non_insurance_prop,
+        "NHB_non_insurance_prop": NHB_non_insurance_prop,
+        "pOI": pOI,
+        "pDT": pDT,
+        "pDTUT": pDTUT,
+        "pHS": pHS,
+        "rrOI_no_ins": rrOI_no_ins,
+        "rrDT_no_ins": rrDT_no_ins,
+        "rrDTUT_no_ins": rrDTUT_no_ins,
+        "rr_SD_not_dt": rr_SD_not_dt,
+        "treatment_HR_SC": treatment_HR_SC,
+        "treatment_HR_NT": treatment_HR_NT,
+        "disc_rate": disc_rate,
+        "QALY_mapping": QALY_mapping,
+        "COST_mapping": COST_mapping,
+        "COST_DT_SC": COST_DT_SC,
+        "COST_DT_NT": COST_DT_NT,
+    }
+
+
+def hash_scenario():
+    # Function:
+    #   Computes a hash of the scenario: the model parameters and the
+    #   life tables used to derive mortality rates
+    # Args:
+    #   None
+    # Returns:
+    #   hexadecimal SHA-256 digest
+
+    life_table_folder = f"{overall_folder}/data_and_inputs/2021_life_tables"
+    scenario = {
+        "parameters": scenario_parameters(),
+        "life_tables": {
+            name: hash_file(f"{life_table_folder}/{name}")
+            for name in sorted(os.listdir(life_table_folder))
+        },
+    }
+    encoded = json.dumps(scenario, sort_keys=True, default=float).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def shard_folder_name(shard_index, shard_count):
+    # Function:
+    #   Name of the folder holding the results of one shard
+    # Args:
+    #   shard_index: index k of the shard (0 to K - 1)
+    #   shard_count: total number of shards K
+    # Returns:
+    #   folder name (e.g., "shard_0_of_4")
+
+    return f"shard_{shard_index}_of_{shard_count}"
+
+
+def get_shard(population_df, shard_index, shard_count):
+    # Function:
+    #   Selects shard k of K of the cohort. Shards are contiguous ranges of
+    #   the cohort id, so concatenating the shards in order reproduces the cohort
+    # Args:
+    #   population_df: cohort dataframe (output from develop_cohort)
+    #   shard_index: index k of the shard (0 to K - 1)
+    #   shard_count: total number of shards K
+    # Returns:
+    #   cohort dataframe restricted to the individuals in the shard
+
+    if shard_count < 1 or not 0 <= shard_index < shard_count:
+        raise ValueError(
+            f"invalid shard {shard_index} of {shard_count}: "
+            "the shard index must be between 0 and the shard count - 1"
+        )
+    if not population_df["id"].is_monotonic_increasing:
+        raise ValueError("cohort ids must be sorted to split the cohort into shards")
+
+    N = len(population_df)
+    start = shard_index * N // shard_count
+    end = (shard_index + 1) * N // shard_count
+    return population_df.iloc[start:end]
+
+
+def create_shard_manifest(
+    shard_df,
+    shard_index,
+    shard_count,
+    cohort_path,
+    trace_format="dense",
+    engine="reference",
+):
+    # Function:
+    #   Describes a shard so that shards can be validated before merging
+    # Args:
+    #   shard_df: cohort dataframe restricted to the shard (output from get_shard)
+    #   shard_index: index k of the shard (0 to K - 1)
+    #   shard_count: total number of shards K
+    #   cohort_path: path to the full cohort file (csv or .npz)
+    #   trace_format: format of the shard results ("dense", "events" or "unique")
+    #   engine: simulation engine of the shard (a key of ENGINES)
+    # Returns:
+    #   dictionary with the shard position, cohort hash, scenario hash,
+    #   id range, engine, engine version and trace format
+
+    return {
+        "shard_index": shard_index,
+        "shard_count": shard_count,
+        "cohort_hash": hash_file(cohort_path),
+        "cohort_size": cohort_file_size(cohort_path),
+        "scenario_hash": hash_scenario(),
+        "engine": engine,
+        "engine_version": ENGINE_VERSION,
+        "trace_format": trace_format,
+        "id_min": int(shard_df["id"].min()) if len(shard_df) > 0 else None,
+        "id_max": int(shard_df["id"].max()) if len(shard_df) > 0 else None,
+        "n_individuals": len(shard_df),
+    }
+
+
+def write_shard_manifest(shard_folder, manifest):
+    # Function:
+    #   Records the hash of every output of a shard in its manifest and writes
+    #   the manifest last, so only shards that finished writing have one
+    # Args:
+    #   shard_folder: folder with the shard results
+    #   manifest: shard manifest (output from create_shard_manifest)
+    # Returns:
+    #   None
+
+    manifest["outputs"] = {
+        f"{model}/{arm}/{file_name}": hash_file(
+            f"{shard_folder}/{model}/{arm}/{file_name}"
+        )
+        for model in MODELS
+        for arm in ARMS
+        for file_name in trace_files(manifest["trace_format"])
+    }
+    temporary_path = f"{shard_folder}/{MANIFEST_FILE}.tmp"
+    with open(temporary_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(temporary_path, f"{shard_folder}/{MANIFEST_FILE}")
+
+
+def read_shard_manifests(shards_folder):
+    # Function:
+    #   Reads the manifests of all shards in a folder
+    # Args:
+    #   shards_folder: folder with one subfolder per shard
+    # Returns:
+    #   list of (shard folder, manifest) tuples sorted by shard index
+
+    shards = []
+    for name in sorted(os.listdir(shards_folder)):
+        manifest_path = f"{shards_folder}/{name}/{MANIFEST_FILE}"
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r") as f:
+                shards.append((f"{shards_folder}/{name}", json.load(f)))
+    return sorted(shards, key=lambda shard: shard[1]["shard_index"])
+
+
+def validate_shards(manifests):
+    # Function:
+    #   Checks that a set of shards can be merged: they come from the same
+    #   cohort, scenario and engine version, and together cover the cohort
+    #   exactly once
+    # Args:
+    #   manifests: list of shard manifests sorted by shard index
+    # Returns:
+    #   None (raises ValueError if the shards do not match)
+
+    if len(manifests) == 0:
+        raise ValueError("no shard manifests found")
+
+    first = manifests[0]
+    for key in [
+        "cohort_hash",
+        "scenario_hash",
+        "engine",
+        "engine_version",
+        "trace_format",
+        "shard_count",
+    ]:
+        values = sorted({str(m[key]) for m in manifests})
+        if len(values) > 1:
+            raise ValueError(f"shards have mismatched {key}: {', '.join(values)}")
+
+    shard_count = first["shard_count"]
+    indices = [m["shard_index"] for m in manifests]
+    if indices != list(range(shard_count)):
+        missing = sorted(set(range(shard_count)) - set(indices))
+        raise ValueError(
+            f"expected shards 0 to {shard_count - 1} exactly once, "
+            f"found {indices} (missing {missing})"
+        )
+
+    previous_id_max = None
+    for m in manifests:
+        if m["id_min"] is None:
+            continue
+        if previous_id_max is not None and m["id_min"] <= previous_id_max:
+            raise ValueError(
+                f"id range of shard {m['shard_index']} overlaps the previous shard"
+            )
+        previous_id_max = m["id_max"]
+
+    n_individuals = sum(m["n_individuals"] for m in manifests)
+    if n_individuals != first["cohort_size"]:
+        raise ValueError(
+            f"shards cover {n_individuals} individuals "
+            f"but the cohort has {first['cohort_size']}"
+        )
+
+
+def merge_shard_file(shards, relative_path, output_path):
+    # Function:
+    #   Concatenates one result file across shards by streaming the csv rows,
+    #   so the merged file is byte-for-byte the file a single-node run writes.
+    #   Each shard file is checked against the hash in its manifest
+    # Args:
+    #   shards: list of (shard folder, manifest) tuples sorted by shard index
+    #   relative_path: path of the file inside each shard folder
+    #   (e.g., "standard/sc/total_trace.csv")
+    #   output_path: path to the merged file
+    # Returns:
+    #   None (raises ValueError if a shard file is corrupted)
+
+    temporary_path = output_path + ".tmp"
+    header = None
+    with open(temporary_path, "wb") as out:
+        for shard_folder, manifest in shards:
+            file_hash = hashlib.sha256()
+            with open(f"{shard_folder}/{relative_path}", "rb") as f:
+                this_header = f.readline()
+                file_hash.update(this_header)
+                if header is None:
+                    header = this_header
+                    out.write(header)
+                elif this_header != header:
+                    raise ValueError(
+                        f"columns of {shard_folder}/{relative_path} differ"
+                    )
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    file_hash.update(block)
+                    out.write(block)
+            if file_hash.hexdigest() != manifest["outputs"][relative_path]:
+                raise ValueError(
+                    f"{shard_folder}/{relative_path} does not match its manifest"
+                )
+    os.replace(temporary_path, output_path)
+
+
+def read_treatment_effect_trace(results_folder, model, trace_format="dense"):
+    # Function:
+    #   Reads the columns of the standard of care and new treatment total traces
+    #   needed to compute the treatment effect of one model (outcomes, race and
+    #   the sampling design columns, if any)
+    # Args:
+    #   results_folder: results folder (e.g., results/)
+    #   model: "standard" or "framework"
+    #   trace_format: format of the results ("dense", "events" or "unique");
+    #   outcomes of event logs are computed from the event ages, and those of
+    #   unique trajectories once per trajectory
+    # Returns:
+    #   combined total trace (output from combine_treatment_arms; with a
+    #   'count' column of individuals per row for unique trajectories)
+
+    if trace_format == "unique":
+        return trajectory_treatment_effect_trace(
+            read_trajectories(f"{results_folder}/{model}/sc/{TRAJECTORY_FILE}"),
+            read_trajectories(f"{results_folder}/{model}/nt/{TRAJECTORY_FILE}"),
+        )
+    if trace_format == "events":
+        total_traces = []
+        for arm, new_treatment in [("sc", False), ("nt", True)]:
+            events_df = read_event_log(f"{results_folder}/{model}/{arm}/{EVENT_FILE}")
+            design_columns = [c for c in DESIGN_COLUMNS if c in events_df.columns]
+            total_traces.append(
+                pd.concat(
+                    [
+                        events_df[["race"] + design_columns],
+                        compute_outcomes_from_events(events_df, new_treatment),
+                    ],
+                    axis=1,
+                )[TREATMENT_EFFECT_COLUMNS + design_columns]
+            )
+        return combine_treatment_arms(*total_traces)
+
+    total_trace_SC = pd.read_csv(
+        f"{results_folder}/{model}/sc/total_trace.csv",
+        usecols=lambda c: c in TREATMENT_EFFECT_COLUMNS + DESIGN_COLUMNS,
+        float_precision="round_trip",
+    )
+    total_trace_NT = pd.read_csv(
+        f"{results_folder}/{model}/nt/total_trace.csv",
+        usecols=lambda c: c in TREATMENT_EFFECT_COLUMNS + DESIGN_COLUMNS,
+        float_precision="round_trip",
+    )
+    return combine_treatment_arms(total_trace_SC, total_trace_NT)
+
+
+def merge_shards(shards_folder, results_folder, chunk_size=None):
+    # Function:
+    #   Validates the shards in a folder and combines them into the final
+    #   traces, treatment effect tables and summary
+    # Args:
+    #   shards_folder: folder with one subfolder per shard
+    #   results_folder: folder to write the merged results to (e.g., results/)
+    #   chunk_size: if given, computes the treatment effects out of core,
+    #   reading this many individuals at a time (stream_treatment_effect in
+    #   streaming_functions.py); otherwise both arms are loaded at once
+    # Returns:
+    #   manifest of the first shard (cohort hash, engine and trace format of
+    #   the merged results)
+
+    shards = read_shard_manifests(shards_folder)
+    validate_shards([manifest for shard_folder, manifest in shards])
+    trace_format = shards[0][1]["trace_format"]
+
+    treatment_effects = dict()
+    for model in MODELS:
+        for arm in ARMS:
+            os.makedirs(f"{results_folder}/{model}/{arm}", exist_ok=True)
+            for file_name in trace_files(trace_format):
+                merge_shard_file(
+                    shards,
+                    f"{model}/{arm}/{file_name}",
+                    f"{results_folder}/{model}/{arm}/{file_name}",
+                )
+            if trace_format == "unique":
+                # trajectories found in several shards are combined
+                trajectory_path = f"{results_folder}/{model}/{arm}/{TRAJECTORY_FILE}"
+                read_trajectories(trajectory_path).to_csv(
+                    trajectory_path, index=False
+                )
+        if chunk_size is None:
+            treatment_effects[model] = create_treatment_effect(
+                read_treatment_effect_trace(results_folder, model, trace_format)
+            )
+        else:
+            treatment_effects[model] = stream_treatment_effect(
+                results_folder, model, chunk_size, trace_format
+            )
+        treatment_effects[model].to_csv(
+            f"{results_folder}/{model}/treatment_effect.csv", index=False
+        )
+
+    # the summaries of the shards add up (shards written before summaries
+    # existed have none)
+    summary_paths = [f"{shard_folder}/{SUMMARY_FILE}" for shard_folder, _ in shards]
+    if all(os.path.exists(path) for path in summary_paths):
+        write_summary(
+            f"{results_folder}/{SUMMARY_FILE}",
+            combine_summaries([read_summary(path) for path in summary_paths]),
+            treatment_effects,
+        )
+    return shards[0][1]
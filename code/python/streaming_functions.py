@@ -0,0 +1,953 @@
+from itertools import zip_longest
+import numpy as np
+import pandas as pd
+from functions import *
+from event_functions import *
+from trajectory_functions import *
+from adaptive_functions import (
+    RACE_GROUPS,
+    EFFECT_COLUMNS,
+    SICK_ONLY_COLUMNS,
+    EFFECT_STATISTICS,
+    create_running_effect,
+    update_running_effect,
+    running_treatment_effect,
+)
+
+# columns of the sampling design of develop_cohort (see design_se)
+DESIGN_COLUMNS = ["stratum", "antithetic_pair", "weight"]
+# sums kept for every stratum of a design mean (see create_design_moments)
+DESIGN_SUMS = ["rows", "units", "a", "b", "aa", "ab", "bb"]
+
+
+def trace_chunks(arm_folder, chunk_size, trace_format="dense", columns=None):
+    # Function:
+    #   Reads the stored results of one model arm in blocks of rows, so that
+    #   analyses never hold more than one block in memory
+    # Args:
+    #   arm_folder: folder of the model arm (e.g., results/standard/sc)
+    #   chunk_size: number of rows per block
+    #   trace_format: "dense" (total_trace.csv), "events" (events.csv) or
+    #   "unique" (trajectories.csv, one row per unique trajectory)
+    #   columns: optional list of the columns to read from a total trace
+    # Returns:
+    #   generator of blocks (pandas dataframes)
+
+    if chunk_size < 1:
+        raise ValueError(f"the chunk size must be at least 1 (got {chunk_size})")
+    if trace_format == "dense":
+        path = f"{arm_folder}/total_trace.csv"
+        options = dict(float_precision="round_trip")
+    elif trace_format == "events":
+        path = f"{arm_folder}/{EVENT_FILE}"
+        options = dict(
+            keep_default_na=False,
+            na_values={column: [""] for column in EVENT_AGE_COLUMNS},
+            dtype={column: "Int64" for column in EVENT_AGE_COLUMNS},
+            float_precision="round_trip",
+        )
+    elif trace_format == "unique":
+        path = f"{arm_folder}/{TRAJECTORY_FILE}"
+        options = dict(
+            keep_default_na=False,
+            dtype={"trajectory": str, "ids": str},
+            float_precision="round_trip",
+        )
+    else:
+        raise ValueError(
+            f"unknown trace format '{trace_format}' "
+            f"(available: {', '.join(TRACE_FORMATS)})"
+        )
+    if columns is not None:
+        header = pd.read_csv(path, nrows=0).columns
+        options["usecols"] = [c for c in header if c in columns]
+    with pd.read_csv(path, chunksize=chunk_size, **options) as reader:
+        yield from reader
+
+
+def paired_chunks(chunks):
+    # Function:
+    #   Moves the members of an antithetic pair split between two blocks into
+    #   the later block, so every block holds whole pairs (design_se uses the
+    #   pair as the unit)
+    # Args:
+    #   chunks: iterable of blocks of a total trace
+    # Returns:
+    #   generator of blocks
+
+    carried = None
+    for chunk in chunks:
+        if carried is not None:
+            chunk = pd.concat([carried, chunk])
+            carried = None
+        if "antithetic_pair" in chunk.columns and len(chunk) > 0:
+            pairs = chunk["antithetic_pair"].to_numpy()
+            last = pairs == pairs[-1]
+            carried = chunk[last]
+            chunk = chunk[~last]
+        if len(chunk) > 0:
+            yield chunk
+    if carried is not None and len(carried) > 0:
+        yield carried
+
+
+def create_occupancy(states, n_cycles=cycles):
+    # Function:
+    #   Creates the running sums behind the state proportions (and standard
+    #   errors) of run_DNS_state_graph and run_HS_state_graph
+    # Args:
+    #   states: list of states
+    #   n_cycles: number of cycles of the traces (output from arm_cycles)
+    # Returns:
+    #   dictionary of running sums per cycle: number of individuals, sum of
+    #   weights and of squared weights among those counted, and for every
+    #   state the sums of weights and squared weights of its members (squared
+    #   weights of the individuals, so a row standing for c individuals adds
+    #   its squared weight divided by c)
+
+    zeros = lambda: np.zeros(n_cycles + 1)
+    return {
+        "n": zeros(),
+        "w": zeros(),
+        "ww": zeros(),
+        "states": {state: {"w": zeros(), "ww": zeros()} for state in states},
+    }
+
+
+def update_occupancy(occupancy, trace, weights, counted=None, counts=None):
+    # Function:
+    #   Adds a block of individuals to running state occupancy sums
+    # Args:
+    #   occupancy: running sums (output from create_occupancy)
+    #   trace: array of states (rows x cycles + 1)
+    #   weights: array of weights of the rows (design_weights)
+    #   counted: optional boolean array (rows x cycles + 1) of the rows counted
+    #   at every cycle (e.g., those alive); everyone if None
+    #   counts: optional array of the number of individuals every row stands
+    #   for (trajectory_counts); 1 for every row if None
+    # Returns:
+    #   None (occupancy is updated in place)
+
+    if counted is None:
+        counted = np.ones(trace.shape, dtype=bool)
+    if counts is None:
+        counts = np.ones(len(trace))
+    squared_weights = weights**2 / counts
+    occupancy["n"] += counts @ counted
+    occupancy["w"] += weights @ counted
+    occupancy["ww"] += squared_weights @ counted
+    for state, sums in occupancy["states"].items():
+        member = (trace == state) & counted
+        sums["w"] += weights @ member
+        sums["ww"] += squared_weights @ member
+
+
+def occupancy_proportions(occupancy, return_se=False):
+    # Function:
+    #   State proportions from running occupancy sums, with the standard errors
+    #   of proportion_se
+    # Args:
+    #   occupancy: running sums (output from create_occupancy)
+    #   return_se: if True, also returns the standard errors
+    # Returns:
+    #   list of proportion lists (one per state, 0 when nobody is counted),
+    #   followed by the lists of standard errors if return_se = True
+
+    n, w = occupancy["n"], occupancy["w"]
+    proportions = []
+    ses = []
+    for sums in occupancy["states"].values():
+        with np.errstate(divide="ignore", invalid="ignore"):
+            p = np.where(n > 0, sums["w"] / w, 0.0)
+            # sum of (w * (indicator - p))^2, as in proportion_se
+            squares = (1 - 2 * p) * sums["ww"] + p**2 * occupancy["ww"]
+            se = np.where(n >= 2, np.sqrt(n / (n - 1) * squares) / w, np.nan)
+        proportions.append([float(x) for x in p])
+        ses.append([float(x) for x in se])
+    if return_se:
+        return proportions + ses
+    return proportions
+
+
+def arm_cycles(arm_folder, chunk_size, trace_format="dense"):
+    # Function:
+    #   Number of cycles of the traces of the stored results of one model arm:
+    #   from the columns of dense traces and unique trajectories, or from the
+    #   youngest starting age of an event log (trace_cycles in functions.py)
+    # Args:
+    #   arm_folder: folder of the model arm (e.g., results/standard/sc)
+    #   chunk_size: number of rows read at a time
+    #   trace_format: "dense", "events" or "unique"
+    # Returns:
+    #   number of cycles
+
+    if trace_format == "events":
+        youngest = [
+            chunk["starting_age"].min()
+            for chunk in trace_chunks(
+                arm_folder, chunk_size, trace_format, ["starting_age"]
+            )
+            if len(chunk) > 0
+        ]
+        return trace_cycles(youngest)
+    chunks = trace_chunks(arm_folder, 1, trace_format)
+    columns = trace_columns(next(chunks))
+    chunks.close()
+    return len(columns) - 1
+
+
+def arm_traces(chunk, trace_format, n_cycles=cycles):
+    # Function:
+    #   Disease natural history and health system utilization traces of a block
+    # Args:
+    #   chunk: block of stored results (output from trace_chunks)
+    #   trace_format: "dense", "events" or "unique"
+    #   n_cycles: number of cycles of the traces (output from arm_cycles)
+    # Returns:
+    #   DNH_trace: array of disease natural history states
+    #   HS_trace: array of health system utilization states
+
+    if trace_format == "events":
+        HS_state_trace_df, state_trace_df = events_to_traces(chunk, n_cycles)
+        return state_trace_df.to_numpy(), HS_state_trace_df.to_numpy()
+    return (
+        chunk[["Year" + str(x) for x in range(0, n_cycles + 1)]].to_numpy(),
+        chunk[["HSYear" + str(x) for x in range(0, n_cycles + 1)]].to_numpy(),
+    )
+
+
+def stream_DNS_state_graph(
+    arm_folder, chunk_size, trace_format="dense", return_se=False
+):
+    # Function:
+    #   Out-of-core version of run_DNS_state_graph: proportion of individuals
+    #   in each disease natural history state at every cycle, weighted by the
+    #   sampling weights, read block by block
+    # Args:
+    #   arm_folder: folder of the model arm (e.g., results/standard/sc)
+    #   chunk_size: number of rows read at a time
+    #   trace_format: "dense", "events" or "unique"
+    #   return_se: if True, also returns the standard errors of the proportions
+    # Returns:
+    #   same as run_DNS_state_graph
+
+    n_cycles = arm_cycles(arm_folder, chunk_size, trace_format)
+    occupancy = create_occupancy(["H", "S", "D"], n_cycles)
+    for chunk in trace_chunks(arm_folder, chunk_size, trace_format):
+        DNH_trace, HS_trace = arm_traces(chunk, trace_format, n_cycles)
+        weights = np.asarray(design_weights(chunk), dtype=float)
+        update_occupancy(
+            occupancy, DNH_trace, weights, counts=trajectory_counts(chunk)
+        )
+    return tuple(occupancy_proportions(occupancy, return_se))
+
+
+def stream_HS_state_graph(
+    arm_folder, chunk_size, trace_format="dense", return_se=False
+):
+    # Function:
+    #   Out-of-core version of run_HS_state_graph: proportion of the individuals
+    #   alive in each health system utilization state at every cycle, weighted
+    #   by the sampling weights, read block by block
+    # Args:
+    #   arm_folder: folder of the model arm (e.g., results/standard/sc)
+    #   chunk_size: number of rows read at a time
+    #   trace_format: "dense", "events" or "unique"
+    #   return_se: if True, also returns the standard errors of the proportions
+    # Returns:
+    #   same as run_HS_state_graph
+
+    n_cycles = arm_cycles(arm_folder, chunk_size, trace_format)
+    occupancy = create_occupancy(["OHS", "IHS", "DT", "DUT"], n_cycles)
+    for chunk in trace_chunks(arm_folder, chunk_size, trace_format):
+        DNH_trace, HS_trace = arm_traces(chunk, trace_format, n_cycles)
+        weights = np.asarray(design_weights(chunk), dtype=float)
+        update_occupancy(
+            occupancy, HS_trace, weights, DNH_trace != "D", trajectory_counts(chunk)
+        )
+    return tuple(occupancy_proportions(occupancy, return_se))
+
+
+def create_design_moments():
+    # Function:
+    #   Creates the running sums behind design_mean and design_se. For every
+    #   unit u (individual, or antithetic pair) of a stratum, a_u is the sum of
+    #   weight * (value - shift) and b_u the sum of weights of its members; the
+    #   sums of a, b, a^2, a * b and b^2 by stratum give the linearized variance
+    #   exactly. The shift (first weighted mean seen) keeps the sums small
+    # Args:
+    #   None
+    # Returns:
+    #   dictionary with the shift and the sums (DESIGN_SUMS) of every stratum
+
+    return {"shift": None, "strata": dict()}
+
+
+def update_design_moments(moments, values, weights, strata, units=None):
+    # Function:
+    #   Adds a block of individuals to running design sums
+    # Args:
+    #   moments: running sums (output from create_design_moments)
+    #   values: array of values
+    #   weights: array of sampling weights
+    #   strata: array of strata
+    #   units: optional array of antithetic pairs (every pair must be whole in
+    #   the block, see paired_chunks); every individual is a unit if None
+    # Returns:
+    #   None (moments are updated in place)
+
+    values = np.asarray(values, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    if len(values) == 0:
+        return
+    if moments["shift"] is None:
+        moments["shift"] = float((weights * values).sum() / weights.sum())
+    sums = pd.DataFrame(
+        {
+            "rows": 1.0,
+            "a": weights * (values - moments["shift"]),
+            "b": weights,
+            "stratum": strata,
+        }
+    )
+    if units is not None:
+        sums = sums.groupby(np.asarray(units)).agg(
+            rows=("rows", "sum"),
+            a=("a", "sum"),
+            b=("b", "sum"),
+            stratum=("stratum", "first"),
+        )
+    sums["units"] = 1.0
+    sums["aa"] = sums["a"] ** 2
+    sums["ab"] = sums["a"] * sums["b"]
+    sums["bb"] = sums["b"] ** 2
+    for stratum, row in sums.groupby("stratum")[DESIGN_SUMS].sum().iterrows():
+        total = moments["strata"].get(stratum, np.zeros(len(DESIGN_SUMS)))
+        moments["strata"][stratum] = total + row.to_numpy()
+
+
+def design_moments_mean_se(moments):
+    # Function:
+    #   Mean and standard error of running design sums, as design_mean and
+    #   design_se of all the values added
+    # Args:
+    #   moments: running sums (output from create_design_moments)
+    # Returns:
+    #   (weighted) mean and its standard error
+
+    if not moments["strata"]:
+        return np.nan, np.nan
+    strata = pd.DataFrame(moments["strata"], index=DESIGN_SUMS).T
+    total = strata.sum()
+    mean = total["a"] / total["b"]
+    if total["rows"] < 2:
+        return moments["shift"] + mean, np.nan
+    # strata with a single unit are pooled to estimate their variance
+    single = strata["units"] < 2
+    if single.any():
+        strata = pd.concat(
+            [strata[~single], strata[single].sum().to_frame("pooled").T]
+        )
+    variance = 0.0
+    for _, stratum in strata.iterrows():
+        n_h = stratum["units"]
+        if n_h > 1:
+            # residuals e_u = a_u - mean * b_u around the mean
+            e = stratum["a"] - mean * stratum["b"]
+            ee = stratum["aa"] - 2 * mean * stratum["ab"] + mean**2 * stratum["bb"]
+            variance += n_h / (n_h - 1) * (ee - e**2 / n_h)
+    return moments["shift"] + mean, np.sqrt(max(variance, 0.0)) / total["b"]
+
+
+def create_running_design_effect():
+    # Function:
+    #   Creates the running design sums needed to compute the treatment effect
+    #   table of create_treatment_effect for stratified, antithetic or
+    #   oversampled cohorts block by block
+    # Args:
+    #   None
+    # Returns:
+    #   dictionary mapping (race, column) to the running design sums of the
+    #   standard of care, new treatment and paired difference
+
+    return {
+        (r, c): {
+            statistic: create_design_moments() for statistic in EFFECT_STATISTICS
+        }
+        for r in RACE_GROUPS
+        for c in EFFECT_COLUMNS
+    }
+
+
+def update_running_design_effect(running_effect, total_trace_SC, total_trace_NT):
+    # Function:
+    #   Adds one block (the same individuals under both treatments, whole
+    #   antithetic pairs) to the running design treatment effect, following
+    #   the design branch of create_treatment_effect
+    # Args:
+    #   running_effect: output from create_running_design_effect
+    #   total_trace_SC: block of the total trace under the standard of care
+    #   total_trace_NT: block of the total trace under the new treatment
+    # Returns:
+    #   None (running_effect is updated in place)
+
+    weights = np.asarray(design_weights(total_trace_SC), dtype=float)
+    if "stratum" in total_trace_SC.columns:
+        strata = total_trace_SC["stratum"].to_numpy()
+    else:
+        strata = np.full(len(total_trace_SC), "all", dtype=object)
+    if "antithetic_pair" in total_trace_SC.columns:
+        units = total_trace_SC["antithetic_pair"].to_numpy()
+    else:
+        units = None
+    for r in RACE_GROUPS:
+        race_SC = (total_trace_SC["race"] == r).to_numpy()
+        race_NT = (total_trace_NT["race"] == r).to_numpy()
+        sick_SC = race_SC & (total_trace_SC["was_sick"] == 1).to_numpy()
+        sick_NT = race_NT & (total_trace_NT["was_sick"] == 1).to_numpy()
+        for c in EFFECT_COLUMNS:
+            values_SC = total_trace_SC[c].to_numpy(dtype=float)
+            values_NT = total_trace_NT[c].to_numpy(dtype=float)
+            if c in SICK_ONLY_COLUMNS:
+                in_SC, in_NT, in_both = sick_SC, sick_NT, sick_SC & sick_NT
+            else:
+                in_SC, in_NT, in_both = race_SC, race_NT, race_SC & race_NT
+            for statistic, values, members in [
+                ("SC", values_SC, in_SC),
+                ("NT", values_NT, in_NT),
+                ("Diff", values_NT - values_SC, in_both),
+            ]:
+                update_design_moments(
+                    running_effect[(r, c)][statistic],
+                    values[members],
+                    weights[members],
+                    strata[members],
+                    None if units is None else units[members],
+                )
+
+
+def running_design_treatment_effect(running_effect):
+    # Function:
+    #   Computes the treatment effect table from the running design sums
+    # Args:
+    #   running_effect: output from create_running_design_effect
+    # Returns:
+    #   treatment_effect_df: pandas dataframe with the same columns as the
+    #   output of create_treatment_effect
+
+    total_arr = []
+    for r in RACE_GROUPS:
+        for c in EFFECT_COLUMNS:
+            arr = [r, c]
+            for statistic in EFFECT_STATISTICS:
+                arr.extend(design_moments_mean_se(running_effect[(r, c)][statistic]))
+            total_arr.append(arr)
+    return pd.DataFrame(
+        total_arr,
+        columns=[
+            "race",
+            "column",
+            "SC mean",
+            "SC se",
+            "NT mean",
+            "NT se",
+            "Diff mean",
+            "Diff se",
+        ],
+    )
+
+
+def arm_outcomes(chunk, trace_format, new_treatment):
+    # Function:
+    #   Cohort columns and outcomes of a block, as needed by
+    #   create_treatment_effect
+    # Args:
+    #   chunk: block of stored results (output from trace_chunks)
+    #   trace_format: "dense" or "events"
+    #   new_treatment: new treatment (True or False)
+    # Returns:
+    #   pandas dataframe of the cohort columns and outcomes of the block
+
+    if trace_format == "events":
+        return pd.concat(
+            [
+                chunk.drop(columns=EVENT_COLUMNS),
+                compute_outcomes_from_events(chunk, new_treatment),
+            ],
+            axis=1,
+        )
+    return chunk
+
+
+def create_linear_design_moments():
+    # Function:
+    #   Creates the running sums behind design_mean and design_se of values
+    #   that are a linear combination of features whose coefficients are only
+    #   known once every block is added (e.g., control-variate adjusted values,
+    #   with a coefficient fitted on the whole cohort). For every unit u
+    #   (individual, or antithetic pair) of a stratum, z_u is the sum of
+    #   weight * (1, features - shift) of its members; the sums of z_u and
+    #   z_u z_u' by stratum give the mean and linearized variance of any
+    #   combination exactly. The shift (first weighted means seen) keeps the
+    #   sums small
+    # Args:
+    #   None
+    # Returns:
+    #   dictionary with the shift of the features and the sums of every stratum
+
+    return {"shift": None, "strata": dict()}
+
+
+def update_linear_design_moments(moments, features, weights, strata, units=None):
+    # Function:
+    #   Adds a block of individuals to running linear design sums
+    # Args:
+    #   moments: running sums (output from create_linear_design_moments)
+    #   features: array of features (individuals x features)
+    #   weights: array of sampling weights
+    #   strata: array of strata
+    #   units: optional array of antithetic pairs (every pair must be whole in
+    #   the block, see paired_chunks); every individual is a unit if None
+    # Returns:
+    #   None (moments are updated in place)
+
+    features = np.asarray(features, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    strata = np.asarray(strata)
+    if len(features) == 0:
+        return
+    if moments["shift"] is None:
+        moments["shift"] = weights @ features / weights.sum()
+    z = weights[:, np.newaxis] * np.column_stack(
+        [np.ones(len(features)), features - moments["shift"]]
+    )
+    rows = np.ones(len(z))
+    if units is not None:
+        units = np.asarray(units)
+        z = pd.DataFrame(z).groupby(units, sort=False).sum().to_numpy()
+        rows = pd.Series(rows).groupby(units, sort=False).sum().to_numpy()
+        strata = pd.Series(strata).groupby(units, sort=False).first().to_numpy()
+    for stratum in pd.unique(strata):
+        members = strata == stratum
+        z_h = z[members]
+        sums = moments["strata"].setdefault(
+            stratum, {"rows": 0.0, "units": 0.0, "z": 0.0, "zz": 0.0}
+        )
+        sums["rows"] += rows[members].sum()
+        sums["units"] += members.sum()
+        sums["z"] = sums["z"] + z_h.sum(axis=0)
+        sums["zz"] = sums["zz"] + z_h.T @ z_h
+
+
+def linear_design_weight(moments):
+    # Function:
+    #   Sum of the sampling weights of the individuals of running linear design
+    #   sums
+    # Args:
+    #   moments: running sums (output from create_linear_design_moments)
+    # Returns:
+    #   sum of weights (0 if no individual was added)
+
+    return float(sum(sums["z"][0] for sums in moments["strata"].values()))
+
+
+def linear_design_mean_se(moments, coefficients):
+    # Function:
+    #   Mean and standard error of the values features @ coefficients of
+    #   running linear design sums, as design_mean and design_se of the values
+    # Args:
+    #   moments: running sums (output from create_linear_design_moments)
+    #   coefficients: array of coefficients of the features
+    # Returns:
+    #   (weighted) mean and its standard error
+
+    if not moments["strata"]:
+        return np.nan, np.nan
+    coefficients = np.asarray(coefficients, dtype=float)
+    # a_u = z_u @ phi is the sum of weight * value of the members of unit u
+    phi = np.concatenate([[moments["shift"] @ coefficients], coefficients])
+    strata = list(moments["strata"].values())
+    total_z = sum(sums["z"] for sums in strata)
+    mean = total_z @ phi / total_z[0]
+    if sum(sums["rows"] for sums in strata) < 2:
+        return mean, np.nan
+    # strata with a single unit are pooled to estimate their variance
+    single = [sums for sums in strata if sums["units"] < 2]
+    if single:
+        strata = [sums for sums in strata if sums["units"] >= 2] + [
+            {key: sum(sums[key] for sums in single) for key in single[0]}
+        ]
+    # residuals e_u = a_u - mean * b_u = z_u @ psi around the mean
+    psi = phi.copy()
+    psi[0] -= mean
+    variance = 0.0
+    for sums in strata:
+        n_h = sums["units"]
+        if n_h > 1:
+            e = sums["z"] @ psi
+            ee = psi @ sums["zz"] @ psi
+            variance += n_h / (n_h - 1) * (ee - e**2 / n_h)
+    return mean, np.sqrt(max(variance, 0.0)) / total_z[0]
+
+
+def create_regression_moments():
+    # Function:
+    #   Creates the running sums behind the least-squares coefficient of
+    #   control_variate_values (sums of the controls and values and of their
+    #   products, around the first means seen)
+    # Args:
+    #   None
+    # Returns:
+    #   dictionary with the shift, number of individuals and sums
+
+    return {"shift": None, "n": 0.0, "q": 0.0, "qq": 0.0}
+
+
+def update_regression_moments(moments, controls, values):
+    # Function:
+    #   Adds a block of individuals to running regression sums
+    # Args:
+    #   moments: running sums (output from create_regression_moments)
+    #   controls: array of control variates (individuals x controls)
+    #   values: array of values of the same individuals
+    # Returns:
+    #   None (moments are updated in place)
+
+    q = np.column_stack([controls, values]).astype(float)
+    if len(q) == 0:
+        return
+    if moments["shift"] is None:
+        moments["shift"] = q.mean(axis=0)
+    q = q - moments["shift"]
+    moments["n"] += len(q)
+    moments["q"] = moments["q"] + q.sum(axis=0)
+    moments["qq"] = moments["qq"] + q.T @ q
+
+
+def regression_coefficients(moments, n_controls):
+    # Function:
+    #   Least-squares coefficient of the values on the controls of running
+    #   regression sums, as control_variate_values (0 with fewer than two
+    #   individuals, which leaves the values unadjusted)
+    # Args:
+    #   moments: running sums (output from create_regression_moments)
+    #   n_controls: number of controls
+    # Returns:
+    #   array of coefficients
+
+    n = moments["n"]
+    if n < 2:
+        return np.zeros(n_controls)
+    mean = moments["q"] / n
+    covariance = moments["qq"] - n * np.outer(mean, mean)
+    return np.linalg.lstsq(
+        covariance[:n_controls, :n_controls],
+        covariance[:n_controls, n_controls],
+        rcond=None,
+    )[0]
+
+
+def create_running_control_effect(control_variates):
+    # Function:
+    #   Creates the running sums needed to compute the control-variate
+    #   treatment effect table of create_treatment_effect block by block: for
+    #   the standard of care, the new treatment and the difference, the
+    #   regression sums of the controls and linear design sums of the values and
+    #   the controls minus their expected values. For the years sick, the
+    #   difference uses linear design sums of the features of the linearized
+    #   difference over everyone in the race group
+    # Args:
+    #   control_variates: names of the control variates (the 'control_'
+    #   columns of the total traces, without the prefix)
+    # Returns:
+    #   dictionary with the control variates and the running sums of every
+    #   (race, column)
+
+    return {
+        "control_variates": control_variates,
+        "sums": {
+            (r, c): {
+                statistic: {
+                    "regression": create_regression_moments(),
+                    "design": create_linear_design_moments(),
+                }
+                for statistic in EFFECT_STATISTICS
+            }
+            for r in RACE_GROUPS
+            for c in EFFECT_COLUMNS
+        },
+    }
+
+
+def update_running_control_effect(running_effect, total_trace_SC, total_trace_NT):
+    # Function:
+    #   Adds one block (the same individuals under both treatments, whole
+    #   antithetic pairs) to the running control-variate treatment effect,
+    #   following the control-variate branch of create_treatment_effect
+    # Args:
+    #   running_effect: output from create_running_control_effect
+    #   total_trace_SC: block of the total trace under the standard of care,
+    #   with control variates (add_control_variates in markov_functions.py)
+    #   total_trace_NT: block of the total trace under the new treatment
+    # Returns:
+    #   None (running_effect is updated in place)
+
+    weights = np.asarray(design_weights(total_trace_SC), dtype=float)
+    if "stratum" in total_trace_SC.columns:
+        strata = total_trace_SC["stratum"].to_numpy()
+    else:
+        strata = np.full(len(total_trace_SC), "all", dtype=object)
+    if "antithetic_pair" in total_trace_SC.columns:
+        units = total_trace_SC["antithetic_pair"].to_numpy()
+    else:
+        units = None
+    control_variates = running_effect["control_variates"]
+    controls = [f"control_{x}" for x in control_variates]
+    for r in RACE_GROUPS:
+        race = (total_trace_SC["race"] == r).to_numpy()
+        sick_SC = race & (total_trace_SC["was_sick"] == 1).to_numpy()
+        sick_NT = race & (total_trace_NT["was_sick"] == 1).to_numpy()
+        for c in EFFECT_COLUMNS:
+            sums = running_effect["sums"][(r, c)]
+            if_sick = "_if_sick" if c in SICK_ONLY_COLUMNS else ""
+            expected = [f"expected_{x}{if_sick}" for x in control_variates]
+            arms = dict()
+            for statistic, total_trace, members in [
+                ("SC", total_trace_SC, sick_SC if if_sick else race),
+                ("NT", total_trace_NT, sick_NT if if_sick else race),
+            ]:
+                values = total_trace[c].to_numpy(dtype=float)
+                X = total_trace[controls].to_numpy(dtype=float)
+                M = total_trace[expected].to_numpy(dtype=float)
+                arms[statistic] = (values, X, M, members)
+                update_regression_moments(
+                    sums[statistic]["regression"], X[members], values[members]
+                )
+                update_linear_design_moments(
+                    sums[statistic]["design"],
+                    np.column_stack([values, X - M])[members],
+                    weights[members],
+                    strata[members],
+                    None if units is None else units[members],
+                )
+            if if_sick:
+                # features of the linearized difference of the adjusted means
+                # over everyone in the race group (membership, values and
+                # controls minus expected values of those sick in every arm)
+                features = []
+                for statistic in ["NT", "SC"]:
+                    values, X, M, members = arms[statistic]
+                    features.extend(
+                        [
+                            members,
+                            np.where(members, values, 0),
+                            np.where(members[:, np.newaxis], X - M, 0),
+                        ]
+                    )
+                features = np.column_stack(features)
+            else:
+                values_SC, X_SC, M_SC, members = arms["SC"]
+                values_NT, X_NT, M_NT, members = arms["NT"]
+                update_regression_moments(
+                    sums["Diff"]["regression"],
+                    np.column_stack([X_NT, X_SC])[members],
+                    (values_NT - values_SC)[members],
+                )
+                features = np.column_stack(
+                    [values_NT - values_SC, X_NT - M_NT, X_SC - M_SC]
+                )
+            update_linear_design_moments(
+                sums["Diff"]["design"],
+                features[race],
+                weights[race],
+                strata[race],
+                None if units is None else units[race],
+            )
+
+
+def running_control_treatment_effect(running_effect):
+    # Function:
+    #   Computes the control-variate treatment effect table from the running
+    #   sums: the coefficients are fitted on the whole cohort, then applied to
+    #   the linear design sums
+    # Args:
+    #   running_effect: output from create_running_control_effect
+    # Returns:
+    #   treatment_effect_df: pandas dataframe with the same columns as the
+    #   output of create_treatment_effect
+
+    k = len(running_effect["control_variates"])
+    total_arr = []
+    for r in RACE_GROUPS:
+        for c in EFFECT_COLUMNS:
+            sums = running_effect["sums"][(r, c)]
+            arr = [r, c]
+            coefficients = dict()
+            means = dict()
+            for statistic in ["SC", "NT"]:
+                beta = regression_coefficients(sums[statistic]["regression"], k)
+                coefficients[statistic] = np.concatenate([[1.0], -beta])
+                mean, se = linear_design_mean_se(
+                    sums[statistic]["design"], coefficients[statistic]
+                )
+                means[statistic] = mean
+                arr.extend([mean, se])
+            if c in SICK_ONLY_COLUMNS:
+                # influence of every individual of the race group on the
+                # difference of the adjusted means (create_treatment_effect)
+                total_weight = linear_design_weight(sums["Diff"]["design"])
+                influence = []
+                for statistic, sign in [("NT", 1.0), ("SC", -1.0)]:
+                    arm_weight = linear_design_weight(sums[statistic]["design"])
+                    if arm_weight > 0:
+                        influence.append(
+                            sign
+                            * total_weight
+                            / arm_weight
+                            * np.concatenate(
+                                [[-means[statistic]], coefficients[statistic]]
+                            )
+                        )
+                    else:
+                        influence.append(np.zeros(k + 2))
+                se = linear_design_mean_se(
+                    sums["Diff"]["design"], np.concatenate(influence)
+                )[1]
+                arr.extend([means["NT"] - means["SC"], se])
+            else:
+                beta = regression_coefficients(sums["Diff"]["regression"], 2 * k)
+                arr.extend(
+                    linear_design_mean_se(
+                        sums["Diff"]["design"], np.concatenate([[1.0], -beta])
+                    )
+                )
+            total_arr.append(arr)
+    return pd.DataFrame(
+        total_arr,
+        columns=[
+            "race",
+            "column",
+            "SC mean",
+            "SC se",
+            "NT mean",
+            "NT se",
+            "Diff mean",
+            "Diff se",
+        ],
+    )
+
+
+def create_block_effect(total_trace):
+    # Function:
+    #   Creates the running sums behind the treatment effect table of
+    #   create_treatment_effect computed block by block, for the branch of
+    #   create_treatment_effect the columns of the total trace select: control
+    #   variates, the sampling design (stratified, antithetic or oversampled
+    #   cohorts) or independent individuals (adaptive_functions.py)
+    # Args:
+    #   total_trace: first block of a total trace
+    # Returns:
+    #   dictionary with the method and its running sums
+
+    control_variates = [
+        x[len("control_") :] for x in total_trace.columns if x.startswith("control_")
+    ]
+    if control_variates:
+        return {
+            "method": "control",
+            "sums": create_running_control_effect(control_variates),
+        }
+    if any(c in total_trace.columns for c in DESIGN_COLUMNS):
+        return {"method": "design", "sums": create_running_design_effect()}
+    return {"method": "independent", "sums": create_running_effect()}
+
+
+def update_block_effect(running_effect, total_trace_SC, total_trace_NT):
+    # Function:
+    #   Adds one block (the same individuals under both treatments, whole
+    #   antithetic pairs) to the running treatment effect
+    # Args:
+    #   running_effect: output from create_block_effect
+    #   total_trace_SC: block of the total trace under the standard of care
+    #   total_trace_NT: block of the total trace under the new treatment
+    # Returns:
+    #   None (running_effect is updated in place)
+
+    update = {
+        "control": update_running_control_effect,
+        "design": update_running_design_effect,
+        "independent": update_running_effect,
+    }[running_effect["method"]]
+    update(running_effect["sums"], total_trace_SC, total_trace_NT)
+
+
+def block_treatment_effect(running_effect):
+    # Function:
+    #   Computes the treatment effect table from the running sums
+    # Args:
+    #   running_effect: output from create_block_effect
+    # Returns:
+    #   treatment_effect_df: same as create_treatment_effect, up to rounding
+
+    result = {
+        "control": running_control_treatment_effect,
+        "design": running_design_treatment_effect,
+        "independent": running_treatment_effect,
+    }[running_effect["method"]]
+    return result(running_effect["sums"])
+
+
+def stream_treatment_effect(results_folder, model, chunk_size, trace_format="dense"):
+    # Function:
+    #   Out-of-core version of create_treatment_effect for the stored results
+    #   of one model: reads both treatment arms block by block, in step, and
+    #   merges running moments (independent individuals, adaptive_functions.py)
+    #   or design sums (stratified, antithetic or oversampled cohorts), so
+    #   memory is bounded by the block size. Unique trajectories are read whole
+    #   and use create_treatment_effect directly, so their memory is not
+    #   bounded (their ids grow with the cohort)
+    # Args:
+    #   results_folder: results folder (e.g., results/)
+    #   model: "standard" or "framework"
+    #   chunk_size: number of individuals read at a time
+    #   trace_format: "dense", "events" or "unique"
+    # Returns:
+    #   treatment_effect_df: same as create_treatment_effect (without control
+    #   variates, which are not stored with the results)
+
+    if trace_format == "unique":
+        return create_treatment_effect(
+            trajectory_treatment_effect_trace(
+                read_trajectories(f"{results_folder}/{model}/sc/{TRAJECTORY_FILE}"),
+                read_trajectories(f"{results_folder}/{model}/nt/{TRAJECTORY_FILE}"),
+            )
+        )
+    columns = (
+        ["id", "race", "starting_age"] + EFFECT_COLUMNS + DESIGN_COLUMNS + EVENT_COLUMNS
+    )
+    chunks = {
+        arm: paired_chunks(
+            trace_chunks(
+                f"{results_folder}/{model}/{arm}", chunk_size, trace_format, columns
+            )
+        )
+        for arm in ["sc", "nt"]
+    }
+    running_effect = None
+    for chunk_SC, chunk_NT in zip_longest(chunks["sc"], chunks["nt"]):
+        if (
+            chunk_SC is None
+            or chunk_NT is None
+            or not np.array_equal(chunk_SC["id"].to_numpy(), chunk_NT["id"].to_numpy())
+        ):
+            raise ValueError(
+                "both treatment arms must hold the same individuals in the same order"
+            )
+        total_trace_SC = arm_outcomes(chunk_SC, trace_format, False)
+        total_trace_NT = arm_outcomes(chunk_NT, trace_format, True)
+        if running_effect is None:
+            running_effect = create_block_effect(total_trace_SC)
+        update_block_effect(running_effect, total_trace_SC, total_trace_NT)
+    if running_effect is None:
+        raise ValueError(f"the results of the {model} model are empty")
+    return block_treatment_effect(running_effect)
@@ -0,0 +1,273 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+from functions import *
+from cohort_functions import COHORT_CATEGORIES, stratum_index, stratum_labels
+
+# aggregate results written next to the model arms (e.g., results/summary.json)
+SUMMARY_FILE = "summary.json"
+# states whose occupancy is summarized: disease natural history states among
+# everyone, health system utilization states among those alive
+SUMMARY_DNH_STATES = ["H", "S", "D"]
+SUMMARY_HS_STATES = ["OHS", "IHS", "DT", "DUT"]
+
+
+def summary_subgroups(population_df):
+    # Function:
+    #   Subgroups of the cohort summarized separately: everyone and every value
+    #   of the categorical characteristics (e.g., "race=NHB", "insurance=N")
+    # Args:
+    #   population_df: cohort dataframe
+    # Returns:
+    #   dictionary mapping each subgroup name to a boolean array of its members
+
+    subgroups = {"all": np.ones(len(population_df), dtype=bool)}
+    for column, categories in COHORT_CATEGORIES.items():
+        values = population_df[column].to_numpy()
+        for category in categories:
+            subgroups[f"{column}={category}"] = values == category
+    return subgroups
+
+
+def create_summary(population_df, arms):
+    # Function:
+    #   Aggregates the model arms of a cohort into the sums a report needs:
+    #   individuals per stratum, and for every arm and subgroup the (weighted)
+    #   sums and sums of squares of the outcomes and the (weighted) number of
+    #   individuals in every state at every cycle and at every age (with the
+    #   number who entered the cohort by every age, for cohorts with mixed
+    #   starting ages). Sums of several chunks or shards of a cohort add up
+    #   (combine_summaries)
+    # Args:
+    #   population_df: cohort dataframe
+    #   arms: dictionary mapping "model/arm" to the (HS_state_trace_df,
+    #   state_trace_df, total_trace) of the arm (output from run_all_arms)
+    # Returns:
+    #   summary dictionary (without treatment effects, see write_summary)
+
+    strata = stratum_index(population_df)
+    cohort_weights = design_weights(population_df)
+    labels = stratum_labels()
+    # cycles of the traces (trace_cycles of the whole cohort, in functions.py)
+    n_cycles = next(iter(arms.values()))[1].shape[1] - 1
+    summary = {
+        "cycles": n_cycles,
+        "cohort": {
+            "individuals": {
+                label: int((strata == index).sum())
+                for index, label in enumerate(labels)
+            },
+            "weight": {
+                label: float(cohort_weights[strata == index].sum())
+                for index, label in enumerate(labels)
+            },
+        },
+        "arms": dict(),
+    }
+    subgroups = summary_subgroups(population_df)
+    # cycle of every individual at every age (definition in functions.py)
+    age_cycle, entered = age_alignment(population_df["starting_age"], n_cycles)
+    for arm, (HS_state_trace_df, state_trace_df, total_trace) in arms.items():
+        weights = design_weights(total_trace)
+        DNH_trace = state_trace_df.to_numpy()
+        HS_trace = HS_state_trace_df.to_numpy()
+        alive = DNH_trace != "D"
+        occupancy = {state: DNH_trace == state for state in SUMMARY_DNH_STATES}
+        for state in SUMMARY_HS_STATES:
+            occupancy[state] = (HS_trace == state) & alive
+        occupancy_by_age = {
+            state: np.take_along_axis(indicator, age_cycle, axis=1) & entered
+            for state, indicator in occupancy.items()
+        }
+        outcomes = total_trace[OUTCOME_COLUMNS].to_numpy(dtype=float)
+        summary["arms"][arm] = dict()
+        for subgroup, members in subgroups.items():
+            w = weights[members]
+            summary["arms"][arm][subgroup] = {
+                "individuals": int(members.sum()),
+                "weight": float(w.sum()),
+                "outcomes": {
+                    column: {
+                        "sum": float(w @ outcomes[members, j]),
+                        "sum_squares": float(w @ outcomes[members, j] ** 2),
+                    }
+                    for j, column in enumerate(OUTCOME_COLUMNS)
+                },
+                "occupancy": {
+                    state: (w @ indicator[members]).tolist()
+                    for state, indicator in occupancy.items()
+                },
+                "occupancy_by_age": {
+                    state: (w @ indicator[members]).tolist()
+                    for state, indicator in occupancy_by_age.items()
+                },
+                "entered_by_age": (w @ entered[members]).tolist(),
+            }
+    return summary
+
+
+def combine_summaries(summaries):
+    # Function:
+    #   Adds up the summaries of disjoint parts of a cohort (e.g., the chunks of
+    #   run_pipeline.py or the shards of run_model.py)
+    # Args:
+    #   summaries: list of summaries (output from create_summary)
+    # Returns:
+    #   summary of the whole cohort
+
+    def add(a, b):
+        if isinstance(a, dict):
+            return {key: add(a[key], b[key]) for key in a}
+        if isinstance(a, list):
+            return [x + y for x, y in zip(a, b)]
+        return a + b
+
+    if not summaries:
+        raise ValueError("there are no summaries to combine")
+    summary = summaries[0]
+    for other in summaries[1:]:
+        if other["cycles"] != summary["cycles"] or set(other["arms"]) != set(
+            summary["arms"]
+        ):
+            raise ValueError("the summaries do not describe the same model arms")
+        summary = {
+            "cycles": summary["cycles"],
+            "cohort": add(summary["cohort"], other["cohort"]),
+            "arms": add(summary["arms"], other["arms"]),
+        }
+    return summary
+
+
+def write_summary(path, summary, treatment_effects=None):
+    # Function:
+    #   Writes a summary, with the treatment effect tables of the models, to a
+    #   json file
+    # Args:
+    #   path: path to the summary file (e.g., results/summary.json)
+    #   summary: summary dictionary (output from create_summary)
+    #   treatment_effects: optional dictionary mapping each model to its
+    #   treatment effect dataframe (output from create_treatment_effect)
+    # Returns:
+    #   None
+
+    summary = dict(summary)
+    if treatment_effects is not None:
+        summary["treatment_effects"] = {
+            model: treatment_effect_df.to_dict(orient="records")
+            for model, treatment_effect_df in treatment_effects.items()
+        }
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w") as f:
+        json.dump(summary, f)
+    os.replace(temporary_path, path)
+
+
+def read_summary(path):
+    # Function:
+    #   Reads a summary file
+    # Args:
+    #   path: path to the summary file (e.g., results/summary.json)
+    # Returns:
+    #   summary dictionary
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def summary_treatment_effect(summary, model):
+    # Function:
+    #   Treatment effect table of one model, as written by run_model.py
+    # Args:
+    #   summary: summary dictionary (output from read_summary)
+    #   model: "standard" or "framework"
+    # Returns:
+    #   treatment effect dataframe (as output from create_treatment_effect)
+
+    if model not in summary.get("treatment_effects", {}):
+        raise ValueError(f"the summary has no treatment effect of the {model} model")
+    return pd.DataFrame(summary["treatment_effects"][model])
+
+
+def summary_outcome(summary, arm, column, subgroup="all"):
+    # Function:
+    #   Mean and standard error of an outcome in one arm and subgroup, treating
+    #   individuals as independent (as mean and std / sqrt(N) of the total trace)
+    # Args:
+    #   summary: summary dictionary (output from read_summary)
+    #   arm: "model/arm" (e.g., "framework/nt")
+    #   column: outcome column (one of OUTCOME_COLUMNS)
+    #   subgroup: subgroup name (summary_subgroups), e.g. "insurance=Y"
+    # Returns:
+    #   dictionary with the 'mean' and 'se' of the outcome
+
+    group = summary["arms"][arm][subgroup]
+    n = group["individuals"]
+    if n == 0:
+        return {"mean": np.nan, "se": np.nan}
+    total = group["outcomes"][column]
+    mean = total["sum"] / group["weight"]
+    if n < 2:
+        return {"mean": mean, "se": np.nan}
+    variance = max(total["sum_squares"] / group["weight"] - mean**2, 0.0) * n / (n - 1)
+    return {"mean": mean, "se": np.sqrt(variance / n)}
+
+
+def summary_occupancy(summary, arm, subgroup="all", by_age=False):
+    # Function:
+    #   Proportion of individuals in every state at every cycle, as
+    #   run_DNS_state_graph (everyone) and run_HS_state_graph (those alive)
+    # Args:
+    #   summary: summary dictionary (output from read_summary)
+    #   arm: "model/arm" (e.g., "framework/nt")
+    #   subgroup: subgroup name (summary_subgroups), e.g. "insurance=Y"
+    #   by_age: if True, the proportions at every age from the youngest age the
+    #   traces cover, among the individuals who entered the cohort by that age
+    # Returns:
+    #   dataframe with one row per cycle (or age, indexed by age) and one
+    #   column per state
+
+    group = summary["arms"][arm][subgroup]
+    if by_age:
+        occupancy = pd.DataFrame(group["occupancy_by_age"])
+        occupancy.index = 101 - summary["cycles"] + occupancy.index
+        entered = pd.Series(group["entered_by_age"], index=occupancy.index)
+    else:
+        occupancy = pd.DataFrame(group["occupancy"])
+        entered = pd.Series(group["weight"], index=occupancy.index)
+    alive = occupancy["H"] + occupancy["S"]
+    proportions = pd.DataFrame(index=occupancy.index)
+    for state in SUMMARY_DNH_STATES:
+        proportions[state] = occupancy[state] / entered.where(entered > 0)
+    for state in SUMMARY_HS_STATES:
+        proportions[state] = (occupancy[state] / alive.where(alive > 0)).fillna(0.0)
+    return proportions
+
+
+def summary_cohort_share(summary, characteristics, among=None):
+    # Function:
+    #   Share of the simulated individuals with some characteristics, among
+    #   the individuals with others
+    # Args:
+    #   summary: summary dictionary (output from read_summary)
+    #   characteristics: dictionary of characteristic values (e.g.,
+    #   {"insurance": "Y"})
+    #   among: optional dictionary of characteristic values of the reference
+    #   group (e.g., {"race": "NHB"}); everyone if None
+    # Returns:
+    #   share of individuals
+
+    columns = list(COHORT_CATEGORIES)
+
+    def count(values):
+        return sum(
+            n
+            for label, n in summary["cohort"]["individuals"].items()
+            if all(
+                label.split("/")[columns.index(column)] == value
+                for column, value in values.items()
+            )
+        )
+
+    among = among or dict()
+    return count(dict(among, **characteristics)) / count(among)
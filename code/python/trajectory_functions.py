@@ -0,0 +1,247 @@
+import numpy as np
+import pandas as pd
+from functions import *
+
+# unique trajectories written instead of the dense traces
+# (run_model.py --trace-format unique)
+TRAJECTORY_FILE = "trajectories.csv"
+# cohort columns kept with every unique trajectory: the race groups of
+# create_treatment_effect, the starting age (the outcomes depend on it) and the
+# sampling design columns of develop_cohort, if any. Individuals are only
+# merged if they agree on these columns
+TRAJECTORY_COHORT_COLUMNS = [
+    "race",
+    "starting_age",
+    "stratum",
+    "weight",
+    "antithetic_pair",
+]
+
+
+def row_hashes(df):
+    # Function:
+    #   Hashes every row of a dataframe (64-bit hash of all its values)
+    # Args:
+    #   df: pandas dataframe
+    # Returns:
+    #   array of hashes (one per row)
+
+    return pd.util.hash_pandas_object(df, index=False).to_numpy()
+
+
+def deduplicate_trajectories(population_df, HS_state_trace_df, state_trace_df):
+    # Function:
+    #   Keeps one copy of every unique (health system, disease natural history)
+    #   trajectory pair of a model arm, with the number of individuals who
+    #   follow it and their ids. Individuals with different
+    #   TRAJECTORY_COHORT_COLUMNS are kept apart
+    # Args:
+    #   population_df: simulated cohort
+    #   HS_state_trace_df: health system utilization trace
+    #   state_trace_df: disease natural history trace
+    # Returns:
+    #   pandas dataframe with one row per unique trajectory (in order of first
+    #   appearance): 'trajectory' (hash of the trajectory), 'count', 'ids'
+    #   (space-separated), the TRAJECTORY_COHORT_COLUMNS of the cohort and
+    #   both traces
+
+    cohort_columns = [
+        c for c in TRAJECTORY_COHORT_COLUMNS if c in population_df.columns
+    ]
+    trajectories = pd.concat(
+        [population_df[cohort_columns], HS_state_trace_df, state_trace_df], axis=1
+    )
+    hashes = row_hashes(trajectories)
+    codes, unique_hashes = pd.factorize(hashes)
+    first = np.unique(codes, return_index=True)[1]
+
+    trajectories_df = trajectories.iloc[first].reset_index(drop=True)
+    trajectories_df.insert(0, "trajectory", [f"{h:016x}" for h in unique_hashes])
+    trajectories_df.insert(1, "count", np.bincount(codes))
+    trajectories_df.insert(
+        2,
+        "ids",
+        population_df["id"].astype(str).groupby(codes).agg(" ".join).to_numpy(),
+    )
+    return trajectories_df
+
+
+def read_trajectories(path):
+    # Function:
+    #   Reads a file of unique trajectories. Trajectories repeated in the file
+    #   (e.g., found in several shards merged by merge_shards) are combined
+    # Args:
+    #   path: path to the trajectory file
+    # Returns:
+    #   pandas dataframe of unique trajectories (output from
+    #   deduplicate_trajectories)
+
+    trajectories_df = pd.read_csv(
+        path,
+        keep_default_na=False,
+        dtype={"trajectory": str, "ids": str},
+        float_precision="round_trip",
+    )
+    if trajectories_df["trajectory"].is_unique:
+        return trajectories_df
+    # the first copy keeps its position, and the ids stay in order
+    aggregations = {c: "first" for c in trajectories_df.columns}
+    aggregations["count"] = "sum"
+    aggregations["ids"] = " ".join
+    return (
+        trajectories_df.groupby("trajectory", sort=False)
+        .agg(aggregations)
+        .reset_index(drop=True)
+    )
+
+
+def trajectory_rows(trajectories_df):
+    # Function:
+    #   Finds the unique trajectory every individual follows
+    # Args:
+    #   trajectories_df: unique trajectories (output from deduplicate_trajectories)
+    # Returns:
+    #   pandas series mapping every id to the row of its trajectory
+
+    ids = trajectories_df["ids"].astype(str).str.split(" ").explode()
+    return pd.Series(np.arange(len(trajectories_df))[ids.index], index=ids.astype(int))
+
+
+def trajectory_outcomes(trajectories_df, new_treatment):
+    # Function:
+    #   Computes the outcomes of every unique trajectory once (compute_outcomes)
+    # Args:
+    #   trajectories_df: unique trajectories (output from deduplicate_trajectories)
+    #   new_treatment: new treatment (True or False)
+    # Returns:
+    #   pandas dataframe with the OUTCOME_COLUMNS (one row per unique trajectory)
+
+    HS_trace = trajectories_df[trace_columns(trajectories_df, "HSYear")].to_numpy()
+    DNH_trace = trajectories_df[trace_columns(trajectories_df)].to_numpy()
+    starting_ages = trajectories_df["starting_age"].tolist()
+    return pd.DataFrame(
+        [
+            compute_outcomes(HS_trace[i], DNH_trace[i], new_treatment, starting_ages[i])
+            for i in range(len(trajectories_df))
+        ],
+        columns=OUTCOME_COLUMNS,
+        index=trajectories_df.index,
+    )
+
+
+def trajectories_to_total_trace(trajectories_df, population_df, new_treatment):
+    # Function:
+    #   Rebuilds the traces and total trace of a model arm from its unique
+    #   trajectories, computing the outcomes once per unique trajectory
+    # Args:
+    #   trajectories_df: unique trajectories (output from deduplicate_trajectories)
+    #   population_df: simulated cohort (the trajectory file only keeps the
+    #   TRAJECTORY_COHORT_COLUMNS)
+    #   new_treatment: new treatment (True or False)
+    # Returns:
+    #   HS_state_trace_df: health system utilization trace
+    #   state_trace_df: disease natural history trace
+    #   total_trace: cohort columns, both traces and the outcomes (as returned
+    #   by run_cohort_standard and run_cohort_social_framework)
+
+    rows = trajectory_rows(trajectories_df).loc[population_df["id"]].to_numpy()
+    HS_state_trace_df = trajectories_df[
+        trace_columns(trajectories_df, "HSYear")
+    ].iloc[rows]
+    HS_state_trace_df.index = population_df.index
+    state_trace_df = trajectories_df[trace_columns(trajectories_df)].iloc[rows]
+    state_trace_df.index = population_df.index
+    outcomes = trajectory_outcomes(trajectories_df, new_treatment).iloc[rows]
+    outcomes.index = population_df.index
+    total_trace = pd.concat(
+        [population_df, state_trace_df, HS_state_trace_df, outcomes], axis=1
+    )
+    return HS_state_trace_df, state_trace_df, total_trace
+
+
+def trajectory_treatment_effect_trace(trajectories_SC, trajectories_NT):
+    # Function:
+    #   Builds the input of create_treatment_effect from the unique trajectories
+    #   of both treatment arms without going through the individuals' traces:
+    #   one row per unique pair of standard of care and new treatment
+    #   trajectories, with the number of individuals who follow it
+    # Args:
+    #   trajectories_SC: unique trajectories under the standard of care
+    #   trajectories_NT: unique trajectories under the new treatment
+    # Returns:
+    #   combined total trace (as from combine_treatment_arms) of the cohort
+    #   columns of the trajectories, the outcomes and a 'count' column
+
+    rows = pd.DataFrame(
+        {
+            "SC": trajectory_rows(trajectories_SC),
+            "NT": trajectory_rows(trajectories_NT),
+        }
+    )
+    if rows.isna().any().any():
+        raise ValueError("the trajectories of both arms must cover the same ids")
+    pairs = rows.value_counts(sort=False)
+    arms = []
+    for arm, trajectories_df, new_treatment in [
+        ("SC", trajectories_SC, False),
+        ("NT", trajectories_NT, True),
+    ]:
+        cohort_columns = [
+            c for c in TRAJECTORY_COHORT_COLUMNS if c in trajectories_df.columns
+        ]
+        arm_rows = pairs.index.get_level_values(arm).to_numpy(dtype=int)
+        total_trace = pd.concat(
+            [
+                trajectories_df[cohort_columns],
+                trajectory_outcomes(trajectories_df, new_treatment),
+            ],
+            axis=1,
+        ).iloc[arm_rows]
+        total_trace.index = np.arange(len(pairs))
+        total_trace["count"] = pairs.to_numpy()
+        arms.append(total_trace)
+    return combine_treatment_arms(*arms)
+
+
+def deduplicate_treatment_effect_trace(trace):
+    # Function:
+    #   Merges the individuals of a combined total trace whose rows of both
+    #   treatment arms are identical in every column create_treatment_effect
+    #   reads, so create_treatment_effect evaluates each of them once,
+    #   weighted by their number ('count' column)
+    # Args:
+    #   trace: combined total trace (output from combine_treatment_arms)
+    # Returns:
+    #   combined total trace with one row per unique pair of rows and a
+    #   'count' column
+
+    columns = [
+        c
+        for c in trace.columns
+        if c in TRAJECTORY_COHORT_COLUMNS
+        or c in OUTCOME_COLUMNS
+        or c.startswith("control_")
+        or c.startswith("expected_")
+    ]
+    total_trace_SC = trace[trace["treatment_type"] == "Standard of Care"]
+    total_trace_NT = trace[trace["treatment_type"] == "New Treatment"].loc[
+        total_trace_SC.index
+    ]
+    hashes = row_hashes(
+        pd.concat(
+            [
+                total_trace_SC[columns].add_prefix("SC "),
+                total_trace_NT[columns].add_prefix("NT "),
+            ],
+            axis=1,
+        )
+    )
+    codes, unique_hashes = pd.factorize(hashes)
+    first = np.unique(codes, return_index=True)[1]
+    counts = np.bincount(codes, weights=trajectory_counts(total_trace_SC))
+    arms = []
+    for total_trace in [total_trace_SC, total_trace_NT]:
+        total_trace = total_trace[columns].iloc[first].reset_index(drop=True)
+        total_trace["count"] = counts.astype(int)
+        arms.append(total_trace)
+    return combine_treatment_arms(*arms)